@@ -29,6 +29,15 @@ test_advancedgraph = TestTask('advancedgraph', 'advanced graph operations')
 test_inheritance = TestTask('inheritance', 'inheritance')
 test_memory = TestTask('memory', 'memory-backed graphs')
 test_ontology = TestTask('ontology', 'basic ontology functionality')
+test_query = TestTask('query', 'lazy queries and indexes')
+test_serialization = TestTask('serialization', 'graph serialization')
+test_mmap = TestTask('mmap', 'memory-mapped read-only graphs')
+test_mutationlog = TestTask('mutationlog', 'mutation log and recovery')
+test_sqlite = TestTask('sqlite', 'SQLite-backed graphs')
+test_export = TestTask('export', 'streaming exporters')
+test_neo4j = TestTask('neo4j', 'Neo4j-backed graphs')
+test_asyncgraph = TestTask('asyncgraph', 'asynchronous graph facade')
+test_cachedobjectgraph = TestTask('cachedobjectgraph', 'read-through / write-back cache over graphs')
 
 @task
 def unittests():
@@ -42,6 +51,12 @@ def unittests():
         testcase.run()
 
 
+@task
+def benchmark_snapshot(nseries = 200):
+    """Compare saving and loading graphs as snapshots and as pickle files"""
+    local('PYTHONPATH=. python tests/benchmark_snapshot.py %s' % nseries)
+
+
 @task
 def tests():
     """Run both the doctests and the unittests"""
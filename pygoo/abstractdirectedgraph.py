@@ -20,7 +20,7 @@
 
 from pygoo.utils import enum
 import sys
-import envoy
+import os
 import logging
 
 log = logging.getLogger(__name__)
@@ -74,6 +74,27 @@ class AbstractDirectedGraph(object):
         """Return an iterable on the nodes of a given class."""
         raise NotImplementedError
 
+    def get_node(self, node_id):
+        """Return the node with the given id.
+
+        :raises KeyError: If there is no node with this id in the graph.
+        """
+        raise NotImplementedError
+
+    def scan_nodes(self, after = None):
+        """Return an iterable over the (node_id, node) pairs of the graph, in increasing
+        order of node id, starting after the given node id if it is not None."""
+        raise NotImplementedError
+
+    def restore_node(self, node_id, props, _classes, trusted = False):
+        """Create a node with the given properties and classes when deserializing a graph.
+        Backends which can should keep the given node id for it.
+
+        If trusted is True, the properties are only literals and the classes are known to
+        be valid for them (the graph has been saved with the same ontology), so backends
+        can store them directly without validating them."""
+        return self.create_node(props, _classes)
+
 
     def add_directed_edge(self, node, name, other_node):
         # other_node should always be a valid node
@@ -103,27 +124,22 @@ class AbstractDirectedGraph(object):
         """Convert a graph in a tuple (nodes, edges, classes).
 
         This is used for serializing a graph, as the resulting tuple is picklable,
-        for instance.
+        for instance. Nodes are identified by their node id.
         """
         nodes = {}
         classes = {}
-        rnodes = {}
         edges = []
 
-        i = 0
-        for n in self.nodes():
+        for i, n in self.scan_nodes():
             nodes[i] = list(n.literal_items())
-            rnodes[id(n)] = i
-            classes[i] = [ cls.__name__ for cls in n._classes ]
-            i += 1
+            classes[i] = [ cls.__name__ for cls in n.classes() ]
 
-        for n in self.nodes():
+        for i, n in self.scan_nodes():
             for prop, links in n.edge_items():
                 for other_node in links:
-                    try:
-                        edges.append((rnodes[id(n)], prop, rnodes[id(other_node)]))
-                    except KeyError:
-                        raise KeyError('Node %s (id: 0x%x) has prop %s that links to Node %s (id: 0x%x), which is not in graph...' % (n, id(n), prop, other_node, id(other_node)))
+                    if not self.contains(other_node):
+                        raise KeyError('Node %s (id: %d) has prop %s that links to Node %s (id: 0x%x), which is not in graph...' % (n, i, prop, other_node, id(other_node)))
+                    edges.append((i, prop, other_node.node_id()))
 
         return nodes, edges, classes
 
@@ -134,8 +150,9 @@ class AbstractDirectedGraph(object):
         self.clear()
         idmap = {}
         for _id, node in nodes.items():
-            idmap[_id] = self.create_node(props = ((prop, value, None) for prop, value in node),
-                                          _classes = (ontology.get_class(cls) for cls in classes[_id]))
+            idmap[_id] = self.restore_node(_id,
+                                           props = ((prop, value, None) for prop, value in node),
+                                           _classes = (ontology.get_class(cls) for cls in classes[_id]))
 
         for node, name, other_node in edges:
             idmap[node].add_directed_edge(name, idmap[other_node])
@@ -146,13 +163,35 @@ class AbstractDirectedGraph(object):
 
 
     def save(self, filename):
-        """Saves the graph to the given filename."""
-        import cPickle as pickle
-        pickle.dump(self.to_nodes_and_edges(), open(filename, 'w'))
+        """Saves the graph to the given filename, as a binary snapshot (see pygoo.snapshot)."""
+        from pygoo import snapshot
+        with open(filename, 'wb') as f:
+            snapshot.write_snapshot(self, f)
+
+    def load(self, filename, classes = None):
+        """Loads the graph from the given filename, which can be either a binary snapshot
+        or a pickle file written by previous versions of PyGoo.
 
-    def load(self, filename):
-        import cPickle as pickle
-        self.from_nodes_and_edges(*pickle.load(open(filename)))
+        If classes is given, only the nodes which are instances of one of them (and the
+        edges between those nodes) are loaded.
+
+        example:
+          g.load('library.db', classes = [ Series, Episode ])
+        """
+        from pygoo import snapshot
+        if snapshot.is_snapshot(filename):
+            with open(filename, 'rb') as f:
+                snapshot.read_snapshot(self, f, classes)
+        else:
+            import cPickle as pickle
+            nodes, edges, node_classes = pickle.load(open(filename))
+            wanted = snapshot.class_names(classes)
+            if wanted is not None:
+                nodes = dict((_id, node) for _id, node in nodes.items()
+                             if not wanted.isdisjoint(node_classes[_id]))
+                edges = [ (node, name, other_node) for node, name, other_node in edges
+                          if node in nodes and other_node in nodes ]
+            self.from_nodes_and_edges(nodes, edges, node_classes)
 
     # __getstate__ and __setstate__ are needed for the cache to be able to work
     def __getstate__(self):
@@ -167,43 +206,142 @@ class AbstractDirectedGraph(object):
 
     ### Utility methods
 
-    def display_graph(self, title = ''):
-        import tempfile
+    def display_nodes(self, root = None, depth = 2, max_nodes = None, sample = None):
+        """Return the list of (node_id, node) pairs to display with display_graph.
 
-        nodes, edges, classes = self.to_nodes_and_edges()
-        _, filename = tempfile.mkstemp()
-        filename = filename + '.png'
+        If root is given (a node or a BaseObject), only the nodes at most depth edges
+        away from it are returned, closest ones first. Otherwise, if sample is given,
+        a random sample of that many nodes is taken from the whole graph, and if not
+        all the nodes are returned. In all cases, at most max_nodes nodes are returned.
+        """
+        import random
+
+        if root is not None:
+            root = getattr(root, 'node', root)
+            seen = set([ root.node_id() ])
+            result = [ (root.node_id(), root) ]
+            frontier = [ root ]
+            for _ in range(depth):
+                next_frontier = []
+                for node in frontier:
+                    for name, other_nodes in node.edge_items():
+                        for other_node in other_nodes:
+                            other_id = other_node.node_id()
+                            if other_id in seen:
+                                continue
+                            if max_nodes is not None and len(result) >= max_nodes:
+                                return result
+                            seen.add(other_id)
+                            result.append((other_id, other_node))
+                            next_frontier.append(other_node)
+                frontier = next_frontier
+            return result
 
-        dg = []
-        dg += [ 'digraph G {' ]
-        dg += [ '  label="%s"' % title ]
+        if sample is not None:
+            if max_nodes is not None:
+                sample = min(sample, max_nodes)
+            # reservoir sampling, so that only the sample is kept in memory
+            result = []
+            for i, (node_id, node) in enumerate(self.scan_nodes()):
+                if i < sample:
+                    result.append((node_id, node))
+                else:
+                    j = random.randint(0, i)
+                    if j < sample:
+                        result[j] = (node_id, node)
+            return sorted(result)
+
+        result = []
+        for node_id, node in self.scan_nodes():
+            if max_nodes is not None and len(result) >= max_nodes:
+                break
+            result.append((node_id, node))
+        return result
+
+    def write_dot(self, f, nodes, title = ''):
+        """Write the given (node_id, node) pairs and the edges between them to the given
+        file-like object in the DOT language, one line at a time."""
+        from xml.sax.saxutils import escape
+
+        def write(line):
+            f.write(line.encode('utf-8') + b'\n')
 
         def tostring(prop):
-            if isinstance(prop, list):
-                result = u', '.join([ unicode(p) for p in prop ])
-            else:
-                result = unicode(prop)
-
-            # appply html chars transformation
-            result = result.replace('&', '&amp;')
-
-            return result
-
-        for _id, n in nodes.items():
-            label = '<FONT COLOR="#884444">%s</FONT><BR/>' % (', '.join(cls for cls in classes[_id] if cls != 'BaseObject') or 'BaseObject')
-            label += '<BR/>'.join([ '%s: %s' % (name, tostring(prop)[:32].encode('utf-8')) for name, prop in n ])
-            dg += [ 'node_%d [shape=polygon,sides=4,label=<%s>];' % (_id, label) ]
+            return escape(unicode(prop)[:32])
+
+        def quoted(s):
+            return s.replace('\\', '\\\\').replace('"', '\\"')
+
+        write('digraph G {')
+        write('  label="%s"' % quoted(title))
+
+        ids = set(node_id for node_id, node in nodes)
+        for node_id, node in nodes:
+            class_names = sorted(cls.__name__ for cls in node.classes() if cls.__name__ != 'BaseObject')
+            label = '<FONT COLOR="#884444">%s</FONT><BR/>' % (', '.join(class_names) or 'BaseObject')
+            label += '<BR/>'.join('%s: %s' % (escape(name), tostring(prop))
+                                  for name, prop in sorted(node.literal_items()))
+            write('node_%d [shape=polygon,sides=4,label=<%s>];' % (node_id, label))
+
+        for node_id, node in nodes:
+            for name, other_nodes in node.edge_items():
+                for other_node in other_nodes:
+                    if other_node.node_id() in ids:
+                        write('node_%d -> node_%d [label="%s"];' % (node_id, other_node.node_id(), quoted(name)))
+
+        write('}')
+
+    def display_graph(self, title = '', root = None, depth = 2, max_nodes = 500, sample = None,
+                      filename = None, headless = False):
+        """Render the graph with Graphviz and open the resulting image in the default
+        image viewer. Return the name of the rendered file.
+
+        As Graphviz can't lay out big graphs, only a part of the graph can be rendered:
+        the neighbourhood of a root node up to the given depth, or a random sample
+        of nodes (see display_nodes()), and at most max_nodes nodes in any case
+        (None for no limit).
+
+        If filename is given, the graph is rendered to it, in the format given by its
+        extension. Filenames ending with '.dot' or '.gv' get the DOT source itself,
+        which doesn't need Graphviz to be installed. If headless is True, the viewer
+        is not opened.
+
+        example:
+          g.display_graph(root = series, depth = 2, max_nodes = 200)
+          g.display_graph(sample = 100, filename = 'sample.svg', headless = True)
+        """
+        import tempfile
+        import subprocess
 
-        for node, name, other_node in edges:
-            dg += [ 'node_%d -> node_%d [label="%s"];' % (node, other_node, name) ]
+        if filename is None:
+            fd, filename = tempfile.mkstemp(suffix = '.png')
+            os.close(fd)
 
-        dg += [ '}' ]
+        nodes = self.display_nodes(root, depth, max_nodes, sample)
+        ext = os.path.splitext(filename)[1][1:].lower()
 
-        r = envoy.run('dot -Tpng -o %s' % filename, data='\n'.join(dg))
-        if sys.platform == 'linux2':
-            envoy.run('gwenview "%s"' % filename)
+        if ext in ('dot', 'gv'):
+            with open(filename, 'wb') as f:
+                self.write_dot(f, nodes, title)
         else:
-            envoy.run('open "%s"' % filename)
+            # stream the DOT source directly to Graphviz
+            p = subprocess.Popen([ 'dot', '-T%s' % (ext or 'png'), '-o', filename ], stdin = subprocess.PIPE)
+            try:
+                self.write_dot(p.stdin, nodes, title)
+            finally:
+                p.stdin.close()
+            if p.wait() != 0:
+                raise RuntimeError('Graphviz could not render %s' % filename)
+
+        if not headless:
+            if sys.platform.startswith('linux'):
+                subprocess.Popen([ 'xdg-open', filename ])
+            elif sys.platform == 'darwin':
+                subprocess.Popen([ 'open', filename ])
+            elif sys.platform == 'win32':
+                os.startfile(filename)
+            else:
+                log.warning('Don\'t know how to open an image viewer on %s, graph written to %s' %
+                            (sys.platform, filename))
 
-        # do not remove file other preview on mac os crashes
-        #os.remove(filename)
+        return filename
@@ -70,6 +70,13 @@ class AbstractNode(object):
     def __hash__(self):
         raise NotImplementedError
 
+    def node_id(self):
+        """Return the integer id of this node in its graph.
+
+        Ids are unique inside a graph and never change during the lifetime of a node
+        (see AbstractDirectedGraph.get_node and AbstractDirectedGraph.scan_nodes)."""
+        raise NotImplementedError
+
     ## Methods needed for storing the nodes ontology (caching)
     ## Note: this could be implemented only using literal values, but it is left
     ##       as part of the API as this is something which is used a lot and
@@ -111,6 +118,13 @@ class AbstractNode(object):
         This method can assume that value is always one of the valid literal types."""
         raise NotImplementedError
 
+    def del_literal(self, name):
+        """Remove the literal with the given name.
+
+        :raises AttributeError: If the given name doesn't correspond to a literal property of this node.
+        """
+        raise NotImplementedError
+
     def literal_keys(self):
         """Return an iterable over the literal names."""
         raise NotImplementedError
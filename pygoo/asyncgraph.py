@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Non-blocking access to a graph, for event-driven applications.
+
+An AsyncGraph runs all the operations on its graph in a background worker thread,
+and returns immediately a multiprocessing.pool.AsyncResult for each of them, whose
+callback is called with the result when it is available (use it to wake up the
+event loop, eg: with tornado's IOLoop.add_callback).
+
+Graphs are not thread-safe, so the operations on a graph are executed one at a
+time, in the order they were submitted. A single worker thread (and thus a single
+connection to a remote backend) is shared by all the users of an AsyncGraph,
+whatever the number of concurrent requests. To use several connections, use
+several AsyncGraphs, each with its own graph.
+
+The objects returned by an AsyncGraph are AsyncObjects, proxies which read and
+modify the properties of the objects in the worker too (blocking until it has
+done so), as they might need to access the backend. Use QuerySet.values() with
+a ResultStream to get plain values in a single operation instead.
+
+NB: asyncio is not available in Python 2, which is why this module is built on
+the thread pool of the multiprocessing module instead.
+"""
+
+from pygoo.objectgraph import ObjectGraph
+from pygoo.utils import is_literal
+from multiprocessing.pool import ThreadPool
+import collections
+import itertools
+import threading
+import operator
+import numbers
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# number of results fetched at once by a ResultStream
+STREAM_BATCH_SIZE = 100
+
+
+class AsyncObject(object):
+    """A proxy for an object returned by an AsyncGraph (eg: a BaseObject), which reads
+    and modifies the object in the worker of the graph, so that the backend is never
+    used by another thread.
+
+    Attributes, method calls, items, iteration and comparisons are forwarded to the
+    worker, and their results are returned as AsyncObjects too, unless they are plain
+    values. Iterators (eg: the objects pointed by an edge) are consumed in the worker,
+    and returned as lists.
+
+    example:
+      ep = ag.afind_one(Episode, title = 'Ebb Tide').get()
+      print ep.series.title  # both the edge and the literal are read in the worker
+    """
+    __slots__ = [ '_agraph', '_object' ]
+
+    def __init__(self, agraph, obj):
+        object.__setattr__(self, '_agraph', agraph)
+        object.__setattr__(self, '_object', obj)
+
+    def __getattr__(self, name):
+        return self._agraph._call(getattr, self._object, name)
+
+    def __setattr__(self, name, value):
+        self._agraph._call(setattr, self._object, name, value)
+
+    def __delattr__(self, name):
+        self._agraph._call(delattr, self._object, name)
+
+    def __call__(self, *args, **kwargs):
+        return self._agraph._call(self._object, *args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._agraph._call(operator.getitem, self._object, key)
+
+    def __setitem__(self, key, value):
+        self._agraph._call(operator.setitem, self._object, key, value)
+
+    def __contains__(self, item):
+        return self._agraph._call(operator.contains, self._object, item)
+
+    def __iter__(self):
+        return iter(self._agraph._call(list, self._object))
+
+    def __len__(self):
+        return self._agraph._call(len, self._object)
+
+    def __nonzero__(self):
+        return self._agraph._call(bool, self._object)
+
+    def __eq__(self, other):
+        return self._agraph._call(operator.eq, self._object, other)
+
+    def __ne__(self, other):
+        return self._agraph._call(operator.ne, self._object, other)
+
+    def __hash__(self):
+        return self._agraph._call(hash, self._object)
+
+    def __str__(self):
+        return self._agraph._call(str, self._object)
+
+    def __unicode__(self):
+        return self._agraph._call(unicode, self._object)
+
+    def __repr__(self):
+        return self._agraph._call(repr, self._object)
+
+
+def _unwrap(value):
+    """Return the objects proxied by the given value, for the arguments of the
+    operations executed in the worker."""
+    if isinstance(value, AsyncObject):
+        return value._object
+    if type(value) in (list, tuple):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+
+class ResultStream(object):
+    """A stream over the results of an iterable (eg: a QuerySet), which are fetched
+    by batches by the worker of an AsyncGraph.
+
+    example:
+      stream = ag.stream(g.query(Episode, season = 2).values('title'))
+      stream.next_batch(callback = on_titles)
+    """
+
+    def __init__(self, agraph, iterable, batch_size = STREAM_BATCH_SIZE):
+        self._agraph = agraph
+        self._iterable = iterable
+        self._iterator = None
+        self.batch_size = batch_size
+
+    def _next_batch(self):
+        # the iteration is started in the worker too, as it might query the backend
+        if self._iterator is None:
+            self._iterator = iter(self._iterable)
+        return self._agraph._proxy(list(itertools.islice(self._iterator, self.batch_size)))
+
+    def next_batch(self, callback = None):
+        """Return an AsyncResult for the list of the next results, which is empty when
+        there are no more of them."""
+        return self._agraph.apply(self._next_batch, callback = callback)
+
+    def __iter__(self):
+        """Iterate over the results, blocking while waiting for them. The next batch
+        is always fetched while the current one is being consumed."""
+        pending = self.next_batch()
+        while True:
+            batch = pending.get()
+            if not batch:
+                return
+            pending = self.next_batch()
+            for result in batch:
+                yield result
+
+
+class AsyncGraph(object):
+    """A non-blocking facade over a graph (see the module documentation).
+
+    graph can be either a graph, or a function which creates it, in which case it is
+    called in the worker thread (this is needed for a SQLiteObjectGraph, as a SQLite
+    connection can only be used by the thread which created it).
+
+    example:
+      ag = AsyncGraph(Neo4jObjectGraph('http://localhost:7474/db/data/'))
+      ag.afind_all(Episode, series_title = 'Monk', callback = on_episodes)
+      ag.awrite(lambda g: g.Series(title = 'The Wire'))
+      ag.close()
+    """
+
+    def __init__(self, graph):
+        self._pool = ThreadPool(1)
+        self._worker = self._pool.apply(threading.current_thread)
+        if isinstance(graph, ObjectGraph):
+            self._graph = graph
+        else:
+            self._graph = self._pool.apply(graph)
+
+    @property
+    def graph(self):
+        return self._graph
+
+    def close(self):
+        """Wait for all the submitted operations to finish, and stop the worker."""
+        self._pool.close()
+        self._pool.join()
+
+    def apply(self, func, args = (), kwargs = None, callback = None):
+        """Call func(*args, **kwargs) in the worker, and return an AsyncResult for its
+        result. If callback is given, it is called with the result in the worker
+        thread (and not if func raised an exception, which is raised again by the
+        get() method of the AsyncResult).
+
+        The result is returned as is, it should only contain plain values or objects
+        which are not attached to the graph."""
+        if callback is None:
+            return self._pool.apply_async(func, args, kwargs or {})
+
+        # the pool would call the callback in its result handler thread
+        def call():
+            result = func(*args, **(kwargs or {}))
+            callback(result)
+            return result
+        return self._pool.apply_async(call)
+
+    def _apply_proxied(self, func, args, kwargs, callback):
+        """Same as apply, with the result returned as AsyncObjects."""
+        def call():
+            return self._proxy(func(*_unwrap(args), **dict((k, _unwrap(v)) for k, v in kwargs.items())))
+        return self.apply(call, callback = callback)
+
+    def _call(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in the worker (or directly if this is the
+        worker), wait for its result and return it as AsyncObjects."""
+        def call():
+            result = func(*_unwrap(args), **dict((k, _unwrap(v)) for k, v in kwargs.items()))
+            if isinstance(result, collections.Iterator):
+                result = list(result)
+            return result
+
+        if threading.current_thread() is self._worker:
+            return self._proxy(call())
+        return self._proxy(self._pool.apply(call))
+
+    def _proxy(self, value):
+        """Return the given value, with the objects it contains wrapped in AsyncObjects."""
+        if value is None or is_literal(value) or isinstance(value, (basestring, numbers.Number, AsyncObject)):
+            return value
+        if type(value) in (list, tuple):
+            return type(value)(self._proxy(v) for v in value)
+        return AsyncObject(self, value)
+
+    def afind_all(self, node_type = None, callback = None, **kwargs):
+        """Asynchronous version of ObjectGraph.find_all."""
+        return self._apply_proxied(self._graph.find_all, (node_type,), kwargs, callback)
+
+    def afind_one(self, node_type = None, callback = None, **kwargs):
+        """Asynchronous version of ObjectGraph.find_one."""
+        return self._apply_proxied(self._graph.find_one, (node_type,), kwargs, callback)
+
+    def stream(self, iterable, batch_size = STREAM_BATCH_SIZE):
+        """Return a ResultStream over the given iterable, which should be lazy (eg: a
+        QuerySet, or one of its values() generators), so that only batch_size results
+        are fetched at a time."""
+        return ResultStream(self, iterable, batch_size)
+
+    def awrite(self, func, callback = None):
+        """Call func(graph) in the worker, and return an AsyncResult for its result
+        (see AsyncObject).
+
+        If the graph supports transactions (eg: Neo4jObjectGraph), func is called in
+        one, so that all its writes are sent together to the backend."""
+        def write():
+            transaction = getattr(self._graph, 'transaction', None)
+            if transaction is None:
+                return func(self._graph)
+            with transaction():
+                return func(self._graph)
+
+        return self._apply_proxied(write, (), {}, callback)
@@ -286,7 +286,7 @@ class BaseObject(object):
 
     def __delattr__(self, name):
         if name in self.node.literal_keys():
-            del self.node._props[name] # FIXME: this is only valid for MemoryObjectNodes (no Neo4jNode)...
+            self.node.del_literal(name)
 
         # FIXME: implement me completely (ie: for links too)
         pass
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pygoo.objectgraph import ObjectGraph
+from pygoo.cachedobjectnode import CachedObjectNode
+from pygoo.baseobject import BaseObject
+import collections
+import threading
+import weakref
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# default number of node objects kept in the cache
+CACHE_SIZE = 10000
+
+# default number of pending changes after which they are written to the backend
+WRITE_BUFFER_SIZE = 1000
+
+
+# value of the literals which have been deleted, in frozen changes
+_DELETED = object()
+
+class _Changes(object):
+    """The changes of a CachedObjectGraph which have not been written to its backend yet."""
+    __slots__ = [ 'pinned', 'literals', 'classes', 'edges', 'deleted', 'count' ]
+
+    def __init__(self):
+        # the nodes with pending changes are kept in pinned until they are written to
+        # the backend, with the names of their modified literals in literals and the
+        # ids of the nodes whose classes changed in classes
+        self.pinned = {}
+        self.literals = collections.OrderedDict()
+        self.classes = set()
+        self.edges = []
+        self.deleted = []
+        self.count = 0
+
+    def freeze(self):
+        """Copy the current values of the modified literals and classes, so that they
+        can be written while the nodes are modified again. literals becomes a dict of
+        name to value (or _DELETED) for each node id, and classes a dict of node id
+        to its classes."""
+        for node_id, names in self.literals.items():
+            literals = self.pinned[node_id]._literals
+            self.literals[node_id] = dict((name, literals.get(name, _DELETED)) for name in names)
+        self.classes = dict((node_id, set(self.pinned[node_id]._classes)) for node_id in self.classes)
+
+
+class CachedObjectGraph(ObjectGraph):
+    """A CachedObjectGraph is an ObjectGraph which caches the nodes of another graph
+    (its backend, which can be any ObjectGraph, eg: a SQLiteObjectGraph or a
+    Neo4jObjectGraph), so that all backends get the same caching behaviour.
+
+    Reads go through the cache: the classes, literals and edges of the last
+    cache_size nodes used are kept in memory, and the other nodes are read from the
+    backend when they are accessed (see hits and misses for the cache statistics).
+    Node objects are kept in a weak identity map, so that a node never has more than
+    one node object.
+
+    Writes are only applied to the cache, and buffered until they are written to the
+    backend by flush(), which happens:
+     - when calling flush() explicitly
+     - when there are flush_every pending changes, if flush_every is not None
+     - before any query over the whole graph, which is answered by the backend
+       (iterating over nodes, finding objects)
+    The changes are written in a single transaction when the backend supports it.
+
+    If background_flush is True, reaching flush_every pending changes writes them
+    in a background thread instead, while the graph keeps recording the next
+    changes in a new buffer, so that the writes don't block the application. The
+    accesses to the backend are serialized, so that the backend is never used by
+    two threads at the same time, but it must support being used by another thread
+    than the one which created it (which is not the case of a SQLiteObjectGraph).
+    For the same reason, flush() can be called by another thread than the one
+    which modifies the graph (eg: by the worker of an AsyncGraph).
+
+    New nodes are created in the backend right away (without their properties), so
+    that they get their id from it. The backend should not be dynamic, as the
+    classes of the nodes are computed by the CachedObjectGraph.
+
+    Modifying the backend directly is not seen by the cache, use invalidate() to
+    read the nodes again from the backend.
+
+    example:
+      g = CachedObjectGraph(SQLiteObjectGraph('library.sqlite'), cache_size = 50000)
+      for ep in g.find_all(Episode, series_title = 'Monk'):
+          ep.watched = True
+      g.flush()
+    """
+    _object_node_class = CachedObjectNode
+
+    def __init__(self, backend, dynamic = False, cache_size = CACHE_SIZE, flush_every = WRITE_BUFFER_SIZE,
+                 background_flush = False):
+        super(CachedObjectGraph, self).__init__(dynamic)
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_every = flush_every
+        self.background_flush = background_flush
+
+        # cache statistics: number of node accesses served by the cache, and
+        # number of nodes which had to be read from the backend
+        self.hits = 0
+        self.misses = 0
+
+        # identity map of all the node objects of this graph, by id, so that each
+        # node has only one node object
+        self._nodes = weakref.WeakValueDictionary()
+        # LRU cache of the most recently used node objects, which keeps them alive
+        self._cache = collections.OrderedDict()
+
+        # pending changes, and the changes being written by flush() if any (their
+        # nodes stay pinned until they have been written), both protected by _lock,
+        # which is also held while modifying a node and recording its change
+        self._changes = _Changes()
+        self._flushing = None
+        self._lock = threading.RLock()
+
+        # serializes the accesses to the backend, which is used by the flush thread
+        # too. It is always acquired before _lock when both are needed.
+        self._backend_lock = threading.RLock()
+        # held while starting a flush or waiting for the flush thread
+        self._flush_lock = threading.RLock()
+        self._flush_thread = None
+        self._flush_error = None
+
+    def close(self):
+        """Write the pending changes to the backend and close it."""
+        self.flush()
+        close = getattr(self.backend, 'close', None)
+        if close is not None:
+            with self._backend_lock:
+                close()
+
+
+    ### Cache methods
+
+    def has_pending_changes(self):
+        return self._changes.count > 0 or self._flushing is not None
+
+    def flush(self, background = False):
+        """Write all the pending changes to the backend, in a single transaction if
+        the backend supports it (see Neo4jObjectGraph.transaction).
+
+        If background is True, the changes are written by a background thread, and
+        this returns immediately (see wait_flush). Otherwise, this returns once all the
+        changes, including the ones being written in the background, are written."""
+        with self._flush_lock:
+            self.wait_flush()
+            with self._lock:
+                changes = self._changes
+                if not changes.count:
+                    return
+                changes.freeze()
+                self._changes = _Changes()
+                self._flushing = changes
+
+            # the nodes which have been written and are not in the cache anymore are
+            # not dropped, as another thread might be reading them: they are collected
+            # once they are not used anymore
+            if background:
+                self._flush_thread = threading.Thread(target = self._flush, args = (changes, True))
+                self._flush_thread.daemon = True
+                self._flush_thread.start()
+            else:
+                self._flush(changes)
+
+    def wait_flush(self):
+        """Wait for the end of the background flush currently running, if any.
+
+        :raises: The exception raised by the backend while writing the changes, if any.
+        """
+        with self._flush_lock:
+            if self._flush_thread is not None:
+                self._flush_thread.join()
+                self._flush_thread = None
+            if self._flush_error is not None:
+                error, self._flush_error = self._flush_error, None
+                raise error
+
+    def _flush(self, changes, background = False):
+        with self._backend_lock:
+            try:
+                log.debug('Writing %d changes to %s' % (changes.count, self.backend))
+                transaction = getattr(self.backend, 'transaction', None)
+                if transaction is None:
+                    self._write_back(changes)
+                else:
+                    with transaction():
+                        self._write_back(changes)
+            except Exception as e:
+                if not background:
+                    raise
+                log.error('Could not write %d changes to %s: %s' % (changes.count, self.backend, e))
+                self._flush_error = e
+            finally:
+                with self._lock:
+                    self._flushing = None
+
+    def _write_back(self, changes):
+        backend = self.backend
+        deleted = set(changes.deleted)
+
+        for node_id, literals in changes.literals.items():
+            if node_id in deleted:
+                continue
+            bnode = backend.get_node(node_id)
+            for name, value in literals.items():
+                if value is not _DELETED:
+                    bnode.set_literal(name, value)
+                elif name in bnode.literal_keys():
+                    bnode.del_literal(name)
+
+        for node_id, classes in changes.classes.items():
+            if node_id in deleted:
+                continue
+            bnode = backend.get_node(node_id)
+            current = set(bnode.classes())
+            for cls in current - classes:
+                bnode.remove_class(cls)
+            for cls in classes - current:
+                bnode.add_class(cls)
+
+        for change, node_id, name, other_id in changes.edges:
+            bnode, other = backend.get_node(node_id), backend.get_node(other_id)
+            if change == 'add':
+                backend.add_directed_edge(bnode, name, other)
+            else:
+                backend.remove_directed_edge(bnode, name, other)
+
+        for node_id in changes.deleted:
+            backend.delete_node(backend.get_node(node_id))
+
+    def invalidate(self, node = None):
+        """Drop the cached data of the given node (or object), or of all the nodes if
+        node is None, so that it is read again from the backend the next time it is
+        accessed. Nodes with pending changes are kept as they are, call flush() first
+        to invalidate them too."""
+        if node is None:
+            nodes = list(self._nodes.values())
+            self._cache.clear()
+        else:
+            if isinstance(node, BaseObject):
+                node = node.node
+            nodes = [ node ]
+            self._cache.pop(node._id, None)
+
+        for node in nodes:
+            self._drop(node)
+
+    def _pinned(self, node_id):
+        flushing = self._flushing
+        return (node_id in self._changes.pinned or
+                (flushing is not None and node_id in flushing.pinned))
+
+    def _drop(self, node):
+        if not self._pinned(node._id):
+            node._classes = None
+            node._literals = None
+            node._edges = None
+
+    def _remember(self, node):
+        """Put the given node in the cache, as its most recently used node."""
+        self._cache.pop(node._id, None)
+        self._cache[node._id] = node
+        if len(self._cache) > self.cache_size:
+            self._drop(self._cache.popitem(last = False)[1])
+
+    def _load(self, node_id, bnode):
+        """Return the node object for the given node of the backend, reading its
+        classes and literals from it if they are not cached."""
+        node = self._nodes.get(node_id)
+        if node is None:
+            node = self.__class__._object_node_class.from_id(self, node_id)
+            self._nodes[node_id] = node
+
+        if node._literals is None:
+            self.misses += 1
+            with self._backend_lock:
+                node._classes = set(bnode.classes())
+                node._literals = dict(bnode.literal_items())
+            node._edges = None
+        else:
+            self.hits += 1
+
+        self._remember(node)
+        return node
+
+    def _reload(self, node):
+        """Read again the classes and literals of the given node, which has been
+        evicted from the cache."""
+        with self._backend_lock:
+            bnode = self.backend.get_node(node._id)
+        self._load(node._id, bnode)
+
+    def _load_edges(self, node):
+        with self._backend_lock:
+            bnode = self.backend.get_node(node._id)
+            node._edges = collections.OrderedDict((name, [ other.node_id() for other in others ])
+                                                  for name, others in bnode.edge_items())
+
+    def _backend_iter(self, iterable):
+        """Iterate over the given iterable of the backend, only holding the backend
+        lock while getting each item, as the changes might be flushed in between."""
+        with self._backend_lock:
+            iterator = iter(iterable)
+        while True:
+            with self._backend_lock:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _changed(self):
+        """Flush the pending changes if there are flush_every of them. This must not be
+        called while holding _lock, as flushing waits for the flush thread."""
+        if self.flush_every is not None and self._changes.count >= self.flush_every:
+            self.flush(self.background_flush)
+
+    def _modified(self, node, name = None):
+        """Record that the given literal of the node, or its classes if name is None,
+        have been modified."""
+        with self._lock:
+            changes = self._changes
+            changes.pinned[node._id] = node
+            if name is None:
+                changes.classes.add(node._id)
+            else:
+                changes.literals.setdefault(node._id, set()).add(name)
+            changes.count += 1
+        self._changed()
+
+    def _edge_changed(self, change, node, name, other_node):
+        with self._lock:
+            changes = self._changes
+            changes.pinned[node._id] = node
+            changes.edges.append((change, node._id, name, other_node._id))
+            changes.count += 1
+        self._changed()
+
+
+    ### Node methods
+
+    def _create_backend_node(self, classes, node_id = None):
+        """Create an empty node in the backend, and return its id."""
+        with self._backend_lock:
+            if node_id is None:
+                bnode = self.backend.create_node([], classes)
+            else:
+                bnode = self.backend.restore_node(node_id, [], classes)
+            return bnode.node_id()
+
+    def _add_node(self, node):
+        self._nodes[node._id] = node
+        self._remember(node)
+
+    def clear(self):
+        """Delete all objects in this graph."""
+        self.wait_flush()
+        for node in self._nodes.values():
+            node.graph = None
+        self._nodes.clear()
+        self._cache.clear()
+        with self._lock:
+            self._changes = _Changes()
+        with self._backend_lock:
+            self.backend.clear()
+
+    def create_node(self, props = [], _classes = set(), _id = None):
+        return self.__class__._object_node_class(self, props, _classes, _id)
+
+    def restore_node(self, node_id, props, _classes, trusted = False):
+        return self.create_node(props, _classes, _id = node_id)
+
+    def delete_node(self, node):
+        node.unlink_all()
+        with self._lock:
+            changes = self._changes
+            changes.literals.pop(node._id, None)
+            changes.classes.discard(node._id)
+            changes.deleted.append(node._id)
+            changes.count += 1
+        self._nodes.pop(node._id, None)
+        self._cache.pop(node._id, None)
+        node.graph = None
+        self._changed()
+
+    def get_node(self, node_id):
+        node = self._nodes.get(node_id)
+        if node is not None and node._literals is not None:
+            self.hits += 1
+            self._remember(node)
+            return node
+        flushing = self._flushing
+        if node_id in self._changes.deleted or (flushing is not None and node_id in flushing.deleted):
+            raise KeyError('No node with id %d in graph %s' % (node_id, self))
+        with self._backend_lock:
+            bnode = self.backend.get_node(node_id)
+        return self._load(node_id, bnode)
+
+    def contains(self, node):
+        """Return whether this graph contains the given node (identity)."""
+        return (isinstance(node, CachedObjectNode) and
+                self._nodes.get(node._id) is node)
+
+    def scan_nodes(self, after = None):
+        self.flush()
+        for node_id, bnode in self._backend_iter(self.backend.scan_nodes(after)):
+            yield node_id, self._load(node_id, bnode)
+
+    def nodes(self):
+        for _, node in self.scan_nodes():
+            yield node
+
+    def nodes_from_class(self, cls):
+        self.flush()
+        for bnode in self._backend_iter(self.backend.nodes_from_class(cls)):
+            yield self._load(bnode.node_id(), bnode)
+
+
+    ### Query methods
+
+    def _backend_value(self, value):
+        if isinstance(value, BaseObject):
+            value = value.node
+        if isinstance(value, CachedObjectNode) and self.contains(value):
+            with self._backend_lock:
+                return self.backend.get_node(value._id)
+        return value
+
+    def _candidate_nodes(self, node_type, filters, limit = None):
+        """Let the backend find the candidate nodes, so that queries use its indexes
+        and are pushed down to its storage."""
+        self.flush()
+        bfilters = dict((prop, self._backend_value(value)) for prop, value in filters.items())
+        with self._backend_lock:
+            bnodes, remaining = self.backend._candidate_nodes(node_type, bfilters, limit)
+        nodes = (self._load(bnode.node_id(), bnode) for bnode in self._backend_iter(bnodes))
+        return nodes, dict((prop, filters[prop]) for prop in remaining)
+
+    def _prefetch(self, nodes, names):
+        self.flush()
+        with self._backend_lock:
+            self.backend._prefetch([ self.backend.get_node(node._id) for node in nodes ], names)
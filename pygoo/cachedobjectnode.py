@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pygoo.objectnode import ObjectNode
+from pygoo import ontology
+import collections
+import weakref
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class CachedObjectNode(ObjectNode):
+    """This is a proxy class for the nodes of the backend graph of a CachedObjectGraph.
+
+    The classes and literals of the node are read from the backend when the node is
+    loaded, and its edges (as the ids of the nodes they point to) the first time they
+    are accessed. They are kept until the graph evicts the node from its cache, after
+    which they are read again from the backend when needed.
+
+    Modifications are applied to the cached data directly, and recorded by the graph
+    to be written to the backend when it is flushed (see CachedObjectGraph.flush).
+    """
+
+    def __init__(self, graph, props = [], _classes = None, _id = None):
+        self._classes = set(_classes) if _classes is not None else set()
+        self._id = graph._create_backend_node(self._classes, _id)
+        self._literals = {}
+        self._edges = collections.OrderedDict()
+        graph._add_node(self)
+        super(CachedObjectNode, self).__init__(graph, props)
+
+    @classmethod
+    def from_id(cls, graph, node_id):
+        """Return the node object for a node which already exists in the backend,
+        without loading it."""
+        node = cls.__new__(cls)
+        node._id = node_id
+        node._classes = None
+        node._literals = None
+        node._edges = None
+        node.graph = weakref.ref(graph)
+        return node
+
+    def __eq__(self, other):
+        return (isinstance(other, CachedObjectNode) and
+                self._id == other._id and
+                self.graph() is other.graph())
+
+    def __hash__(self):
+        return hash(self._id)
+
+    def __setattr__(self, name, value):
+        if name in [ '_id', '_classes', '_literals', '_edges' ]:
+            object.__setattr__(self, name, value)
+        else:
+            super(CachedObjectNode, self).__setattr__(name, value)
+
+    def _props(self):
+        if self._literals is None:
+            self.graph()._reload(self)
+        return self._literals
+
+    def _edge_map(self):
+        """Return an ordered dict of edge name to the list of pointed node ids."""
+        if self._edges is None:
+            self._props()
+            self.graph()._load_edges(self)
+        return self._edges
+
+
+    def node_id(self):
+        return self._id
+
+
+    ### Ontology methods
+
+    def classes(self):
+        self._props()
+        return self._classes
+
+    def isinstance(self, cls):
+        return cls in self.classes()
+
+    def add_class(self, cls):
+        if cls not in self.classes():
+            self._classes.add(cls)
+            self.graph()._modified(self)
+
+    def remove_class(self, cls):
+        self.classes().remove(cls)
+        self.graph()._modified(self)
+
+    def clear_classes(self):
+        if self.classes():
+            self._classes.clear()
+            self.graph()._modified(self)
+
+    def update_valid_classes(self):
+        if self.graph()._dynamic:
+            classes = set(cls for cls in ontology._classes.values() if self.is_valid_instance(cls))
+            current = self.classes()
+            for cls in current - classes:
+                self.remove_class(cls)
+            for cls in classes - current:
+                self.add_class(cls)
+
+
+    ### Accessing literal properties
+
+    def get_literal(self, name):
+        try:
+            return self._props()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def set_literal(self, name, value):
+        self._props()[name] = value
+        self.graph()._modified(self, name)
+
+    def del_literal(self, name):
+        props = self._props()
+        if name not in props:
+            raise AttributeError(name)
+        del props[name]
+        self.graph()._modified(self, name)
+
+    def literal_keys(self):
+        return iter(self._props().keys())
+
+    def literal_values(self):
+        return iter(self._props().values())
+
+    def literal_items(self):
+        return iter(self._props().items())
+
+
+    ### Accessing edge properties
+
+    def add_directed_edge(self, name, other_node):
+        self._edge_map().setdefault(name, []).append(other_node._id)
+        self.graph()._edge_changed('add', self, name, other_node)
+
+    def remove_directed_edge(self, name, other_node):
+        # only remove one of the edges if there are multiple ones, as for MemoryObjectNode
+        node_ids = self._edge_map().get(name, [])
+        try:
+            node_ids.remove(other_node._id)
+        except ValueError:
+            raise ValueError('No edge %s from %s to %s' % (name, self, other_node))
+        if not node_ids:
+            del self._edges[name]
+        self.graph()._edge_changed('remove', self, name, other_node)
+
+    def _endpoints(self, node_ids):
+        get_node = self.graph().get_node
+        for node_id in node_ids:
+            yield get_node(node_id)
+
+    def _edge_ids(self, name):
+        return list(self._edge_map().get(name, []))
+
+    def outgoing_edge_endpoints(self, name = None):
+        if name is None:
+            return self._endpoints([ node_id for node_ids in self._edge_map().values()
+                                             for node_id in node_ids ])
+        if name in self._props():
+            raise AttributeError(name)
+        return self._endpoints(self._edge_ids(name))
+
+    def edge_keys(self):
+        return iter(self._edge_map().keys())
+
+    def edge_values(self):
+        return (self._endpoints(list(v)) for v in self._edge_map().values())
+
+    def edge_items(self):
+        return ((k, self._endpoints(list(v))) for k, v in self._edge_map().items())
+
+
+    # The next methods are overriden for efficiency, see MemoryObjectNode
+
+    def keys(self):
+        return self._props().keys() + self._edge_map().keys()
+
+    def get(self, name, default=None):
+        props = self._props()
+        if name in props:
+            return props[name]
+        return self._endpoints(self._edge_ids(name))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Streaming exporters, to feed graphs into other tools.
+
+All the exporters walk the graph with scan_nodes() and write the nodes and edges
+as they go, so that they use a constant amount of memory whatever the size of the
+graph (the only things kept in memory are the property names, edge names and
+classes found in the graph). Nodes are identified by their node id.
+
+Literal values which are not natively supported by the output format (such as
+guessit Language objects) are exported as their unicode representation.
+"""
+
+from __future__ import unicode_literals
+from xml.sax.saxutils import escape, quoteattr
+import json
+import csv
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _export_value(value):
+    if value is None or isinstance(value, (unicode, int, long, float)):
+        return value
+    return unicode(value)
+
+def _class_names(node):
+    return sorted(cls.__name__ for cls in node.classes())
+
+def _edges(node):
+    """Return a generator over the (name, target node id) outgoing edges of a node."""
+    for name, other_nodes in node.edge_items():
+        for other_node in other_nodes:
+            yield name, other_node.node_id()
+
+
+def export_jsonl(graph, f):
+    """Write the given graph to the given file-like object as JSON Lines: one line per
+    node, followed by one line per edge. Return the number of lines written.
+
+    Nodes are written as:
+      {"type": "node", "id": 0, "classes": ["BaseObject", "Series"], "properties": {"title": "Monk"}}
+    and edges as:
+      {"type": "edge", "source": 1, "name": "series", "target": 0}
+    """
+    dumps = json.JSONEncoder(ensure_ascii = False, separators = (',', ':')).encode
+    count = 0
+
+    for node_id, node in graph.scan_nodes():
+        line = dumps({ 'type': 'node', 'id': node_id, 'classes': _class_names(node),
+                       'properties': dict((name, _export_value(value))
+                                          for name, value in node.literal_items()) })
+        f.write(line.encode('utf-8') + b'\n')
+        count += 1
+
+    for node_id, node in graph.scan_nodes():
+        for name, other_id in _edges(node):
+            line = dumps({ 'type': 'edge', 'source': node_id, 'name': name, 'target': other_id })
+            f.write(line.encode('utf-8') + b'\n')
+            count += 1
+
+    return count
+
+
+def _csv_value(value):
+    value = _export_value(value)
+    if value is None:
+        return b''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return repr(value) if isinstance(value, float) else bytes(value)
+
+
+def export_csv(graph, directory):
+    """Write the given graph as CSV files in the given directory, and return the list
+    of filenames written.
+
+    Each node is written to the file of its most specialized class ('Series.csv'),
+    which has an 'id' column, a 'classes' column (space-separated class names) and
+    one column per literal property found in the nodes of this class. Edges are
+    written to one file per edge name ('series.edges.csv') with 'source' and
+    'target' columns.
+
+    Files are utf-8 encoded, empty values mean that the property is not set."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # first pass: find the columns of each file
+    columns = {}
+    edge_names = set()
+    for node_id, node in graph.scan_nodes():
+        columns.setdefault(node.virtual_class().__name__, set()).update(node.literal_keys())
+        edge_names.update(node.edge_keys())
+
+    files = []
+    writers = {}
+    try:
+        for cls, props in sorted(columns.items()):
+            props = sorted(props)
+            f = open(os.path.join(directory, '%s.csv' % cls), 'wb')
+            files.append(f)
+            writer = csv.writer(f)
+            writer.writerow([ b'id', b'classes' ] + [ p.encode('utf-8') for p in props ])
+            writers[cls] = (writer, props)
+
+        for name in sorted(edge_names):
+            f = open(os.path.join(directory, '%s.edges.csv' % name), 'wb')
+            files.append(f)
+            writer = csv.writer(f)
+            writer.writerow([ b'source', b'target' ])
+            writers[(name,)] = writer
+
+        # second pass: write the nodes and their edges
+        for node_id, node in graph.scan_nodes():
+            writer, props = writers[node.virtual_class().__name__]
+            literals = dict(node.literal_items())
+            writer.writerow([ bytes(node_id), ' '.join(_class_names(node)).encode('utf-8') ] +
+                            [ _csv_value(literals.get(p)) for p in props ])
+            for name, other_id in _edges(node):
+                writers[(name,)].writerow([ bytes(node_id), bytes(other_id) ])
+
+    finally:
+        for f in files:
+            f.close()
+
+    return [ f.name for f in files ]
+
+
+_graphml_types = { int: 'int', long: 'long', float: 'double', bool: 'boolean' }
+
+def export_graphml(graph, f):
+    """Write the given graph to the given file-like object as GraphML.
+
+    Literal properties are declared as GraphML keys (with the type of their first
+    value found, 'string' if they have values of different types), the classes of a
+    node are written in its 'classes' data as space-separated class names, and the
+    name of an edge in its 'name' data."""
+    # first pass: declare the keys
+    keys = {}
+    for node_id, node in graph.scan_nodes():
+        for name, value in node.literal_items():
+            if value is None:
+                continue
+            vtype = _graphml_types.get(type(value), 'string')
+            if keys.setdefault(name, vtype) != vtype:
+                keys[name] = 'string'
+
+    key_ids = dict((name, 'p%d' % i) for i, name in enumerate(sorted(keys)))
+
+    def write(s):
+        f.write(s.encode('utf-8'))
+
+    write('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+          '  <key id="classes" for="node" attr.name="classes" attr.type="string"/>\n'
+          '  <key id="name" for="edge" attr.name="name" attr.type="string"/>\n')
+    for name in sorted(keys):
+        write('  <key id="%s" for="node" attr.name=%s attr.type="%s"/>\n' % (key_ids[name], quoteattr(name), keys[name]))
+    write('  <graph id="G" edgedefault="directed">\n')
+
+    # second pass: write the nodes, then the edges
+    for node_id, node in graph.scan_nodes():
+        data = [ '    <node id="n%d">\n' % node_id,
+                 '      <data key="classes">%s</data>\n' % escape(' '.join(_class_names(node))) ]
+        for name, value in sorted(node.literal_items()):
+            if value is None:
+                continue
+            value = _export_value(value)
+            if isinstance(value, float):
+                value = repr(value)
+            data.append('      <data key="%s">%s</data>\n' % (key_ids[name], escape(unicode(value))))
+        data.append('    </node>\n')
+        write(''.join(data))
+
+    for node_id, node in graph.scan_nodes():
+        for name, other_id in _edges(node):
+            write('    <edge source="n%d" target="n%d"><data key="name">%s</data></edge>\n' %
+                  (node_id, other_id, escape(name)))
+
+    write('  </graph>\n'
+          '</graphml>\n')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class HashIndex(object):
+    """A HashIndex maps the values of a literal property to the set of nodes
+    which have this value for that property.
+
+    Indexes are maintained by the graph that owns them (see
+    MemoryObjectGraph.create_index), you should not need to call add() or
+    remove() yourself.
+
+    Note: None values are never indexed, as a node which doesn't have the
+          property at all should also match a None filter.
+    """
+
+    def __init__(self, prop):
+        self.prop = prop
+        self._entries = {}
+
+    def __len__(self):
+        """Return the number of nodes in this index."""
+        return sum(len(nodes) for nodes in self._entries.values())
+
+    def add(self, node, value):
+        if value is None:
+            return
+        self._entries.setdefault(value, set()).add(node)
+
+    def add_all(self, items):
+        """Add all the given (node, value) pairs to the index."""
+        for node, value in items:
+            HashIndex.add(self, node, value)
+
+    def remove(self, node, value):
+        nodes = self._entries.get(value)
+        if nodes is None:
+            return
+        nodes.discard(node)
+        if not nodes:
+            del self._entries[value]
+
+    def clear(self):
+        self._entries.clear()
+
+    def lookup(self, value):
+        """Return the set of nodes for which the property is equal to the given value."""
+        return self._entries.get(value, frozenset())
+
+    def keys(self):
+        return self._entries.keys()
+
+    def items(self):
+        return self._entries.items()
+
+
+class SortedIndex(HashIndex):
+    """A SortedIndex is a HashIndex which also keeps its values sorted, so that the
+    nodes can be walked in the order of their property value (see walk()).
+
+    Adding or removing a node is as fast as for a HashIndex when its value is
+    already present in the index, and O(n) in the number of distinct values when
+    it is not. Use add_all() to add many nodes at once, as it only sorts the values
+    once, in O(n log n).
+    """
+
+    def __init__(self, prop):
+        super(SortedIndex, self).__init__(prop)
+        self._keys = []
+
+    def add(self, node, value):
+        if value is not None and value not in self._entries:
+            bisect.insort(self._keys, value)
+        super(SortedIndex, self).add(node, value)
+
+    def add_all(self, items):
+        super(SortedIndex, self).add_all(items)
+        self._keys = sorted(self._entries)
+
+    def remove(self, node, value):
+        super(SortedIndex, self).remove(node, value)
+        if value is not None and value not in self._entries:
+            i = bisect.bisect_left(self._keys, value)
+            if i < len(self._keys) and self._keys[i] == value:
+                del self._keys[i]
+
+    def clear(self):
+        super(SortedIndex, self).clear()
+        self._keys = []
+
+    def keys(self):
+        return list(self._keys)
+
+    def walk(self, reverse = False):
+        """Return a generator over the indexed nodes, in increasing order of their
+        value (decreasing if reverse is True). Nodes with the same value are
+        returned in no particular order."""
+        keys = list(self._keys)
+        if reverse:
+            keys.reverse()
+        for key in keys:
+            for node in list(self._entries.get(key, ())):
+                yield node
@@ -22,28 +22,97 @@ from pygoo.objectnode import ObjectNode
 from pygoo.abstractdirectedgraph import AbstractDirectedGraph
 from pygoo.memoryobjectnode import MemoryObjectNode
 from pygoo.objectgraph import ObjectGraph
+from pygoo.index import HashIndex, SortedIndex
+from pygoo.utils import is_literal
+from pygoo import snapshot
+import binascii
+import os
 import logging
 
 log = logging.getLogger(__name__)
 
 
 class MemoryObjectGraph(ObjectGraph):
+    """An ObjectGraph where all the nodes are kept in memory.
+
+    Each node is given an integer id when it is added to the graph. Ids are
+    monotonically increasing and never reused, and nodes are stored in a list
+    indexed by their id, which gives O(1) lookup by id (see get_node) and a
+    stable iteration order (see scan).
+
+    A MemoryObjectGraph can also log all its mutations to disk, so that it can be
+    recovered after a crash (see open_log).
+
+    Once a graph has been saved or loaded, it keeps track of the nodes which have
+    been modified since then, so that only those need to be written by the next
+    call to save_incremental.
+    """
     _object_node_class = MemoryObjectNode
 
     def __init__(self, **kwargs):
         super(MemoryObjectGraph, self).__init__(**kwargs)
-        self._nodes = set()
+        self._nodes = []
+        self._indexes = {}
+        self._log = None
+        self._dirty = None
+        self._base = None
+        # file from which only some of the classes have been loaded, if any
+        self._partial = None
 
     def clear(self):
-        self._nodes.clear()
+        self._nodes = []
+        for index in self._indexes.values():
+            index.clear()
+        if self._log is not None:
+            self._log.clear()
+        # node ids will be reused, which can't be expressed in a delta
+        self._base = None
+
+    def create_node(self, props = [], _classes = set(), _id = None):
+        return self.__class__._object_node_class(self, props, _classes, _id)
+
+    def restore_node(self, node_id, props, _classes, trusted = False):
+        if trusted:
+            return self.__class__._object_node_class.restore(self, props, _classes, node_id)
+        return self.create_node(props, _classes, _id = node_id)
+
+    def _add_node(self, node, node_id = None):
+        """Register the given node in this graph, using the given id if not None
+        or the next available one otherwise."""
+        if node_id is None:
+            node_id = len(self._nodes)
+        elif node_id < len(self._nodes):
+            if self._nodes[node_id] is not None:
+                raise ValueError('Node id %d is already used in graph %s' % (node_id, self))
+        else:
+            self._nodes.extend([ None ] * (node_id + 1 - len(self._nodes)))
 
-    def create_node(self, props = [], _classes = set()):
-        return self.__class__._object_node_class(self, props, _classes)
+        if node_id == len(self._nodes):
+            self._nodes.append(node)
+        else:
+            self._nodes[node_id] = node
+        node._id = node_id
+
+        self._mutated(node_id, 'create_node', node)
+
+    def _mutated(self, node_id, mutation, *args):
+        """Mark the given node as modified since the graph has been saved, and write
+        the mutation to the log, where mutation is the name of a MutationLog method."""
+        if self._dirty is not None:
+            self._dirty.add(node_id)
+        if self._log is not None:
+            getattr(self._log, mutation)(*args)
 
     def delete_node(self, node):
         node.unlink_all()
+        for prop, index in self._indexes.items():
+            value = node._props.get(prop)
+            if is_literal(value):
+                index.remove(node, value)
+        self._mutated(node._id, 'delete_node', node)
         node.graph = None
-        self._nodes.remove(node)
+        # keep a hole in the list so that the other ids stay valid
+        self._nodes[node._id] = None
 
         # FIXME: we need to revalidate the nodes touched by unlink_all()
         #        actually, we need to look whether to unlink or not depending
@@ -52,16 +121,216 @@ class MemoryObjectGraph(ObjectGraph):
 
     def nodes(self):
         for node in self._nodes:
-            yield node
+            if node is not None:
+                yield node
 
     def nodes_from_class(self, cls):
-        return (node for node in self._nodes if node.isinstance(cls))
+        return (node for node in self._nodes if node is not None and node.isinstance(cls))
 
     def contains(self, node):
         """Return whether this graph contains the given node (identity)."""
-        return node in self._nodes
+        node_id = getattr(node, '_id', None)
+        return (isinstance(node_id, (int, long)) and
+                0 <= node_id < len(self._nodes) and
+                self._nodes[node_id] is node)
+
+    def get_node(self, node_id):
+        try:
+            node = self._nodes[node_id] if node_id >= 0 else None
+        except IndexError:
+            node = None
+        if node is None:
+            raise KeyError('No node with id %d in graph %s' % (node_id, self))
+        return node
+
+    def scan_nodes(self, after = None):
+        start = after + 1 if after is not None else 0
+        for node_id in xrange(start, len(self._nodes)):
+            node = self._nodes[node_id]
+            if node is not None:
+                yield node_id, node
+
+
+    ### Index methods
+
+    def create_index(self, prop, sorted = False):
+        """Create an index on the given literal property and return it.
+
+        If sorted is True, a SortedIndex is created, which can then also be used
+        for ordering the results of a query (see QuerySet.order_by), otherwise a
+        simple HashIndex is created.
+
+        The index is filled with the nodes currently in the graph, and is then
+        kept up-to-date each time a literal is set on a node."""
+        index = self._indexes.get(prop)
+        if index is not None and (not sorted or isinstance(index, SortedIndex)):
+            return index
+
+        index = SortedIndex(prop) if sorted else HashIndex(prop)
+        index.add_all((node, node._props.get(prop)) for node in self.nodes()
+                      if is_literal(node._props.get(prop)))
+
+        self._indexes[prop] = index
+        return index
+
+    def drop_index(self, prop):
+        del self._indexes[prop]
+
+    def index(self, prop):
+        return self._indexes.get(prop)
+
+    ### Persistence methods
+
+    def save(self, filename):
+        """Saves the graph to the given filename, as a binary snapshot (see pygoo.snapshot).
+
+        The snapshot is written to a temporary file first, so that the previous one
+        is still valid if the save is interrupted.
+
+        If the mutation log of the graph is attached to this file (see open_log), the
+        log is compacted instead, so that it is not replayed again on top of the new
+        snapshot when recovering.
+
+        :raises ValueError: If the graph has been partially loaded from this file (see
+                            load), as the nodes which haven't been loaded would be lost.
+        """
+        self._check_partial(filename)
+        if self._logs_to(filename):
+            return self._log.compact(self, background = False)
+
+        snapshot_id = binascii.hexlify(os.urandom(8)).decode('ascii')
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            snapshot.write_snapshot(self, f, metadata = { 'snapshot_id': snapshot_id })
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, filename)
+
+        # the deltas of the previous snapshot are now obsolete
+        if os.path.exists(filename + '.delta'):
+            os.remove(filename + '.delta')
+
+        self._base = (os.path.abspath(filename), snapshot_id, 0)
+        self._dirty = set()
+
+    def load(self, filename, classes = None):
+        """Loads the graph from the given filename, which can be either a binary snapshot
+        or a pickle file written by previous versions of PyGoo. The delta segments
+        written by save_incremental are applied on top of the snapshot.
+
+        If classes is given, only the nodes which are instances of one of them (and the
+        edges between those nodes) are loaded. Such a partial graph can't be saved to the
+        file it has been loaded from, as that would lose the nodes which haven't been
+        loaded, but it can be saved to another file."""
+        self._dirty = None
+        self._base = None
+        self._partial = os.path.abspath(filename) if classes is not None else None
+        if not snapshot.is_snapshot(filename):
+            return super(MemoryObjectGraph, self).load(filename, classes)
+
+        with open(filename, 'rb') as f:
+            snapshot_id = snapshot.read_snapshot(self, f, classes).get('snapshot_id')
+        if snapshot_id is None:
+            return
+
+        delta_size = 0
+        for changes, delta_size in snapshot.read_deltas(filename, snapshot_id):
+            snapshot.apply_delta(self, changes, classes)
+
+        if classes is None:
+            self._base = (os.path.abspath(filename), snapshot_id, delta_size)
+            self._dirty = set()
+
+    def save_incremental(self, filename, max_delta_ratio = 0.5):
+        """Save only the nodes which have been modified since the graph was last saved to
+        or loaded from the given filename, by appending a delta segment to filename.delta.
+        Loading the snapshot then also applies all the delta segments written after it.
+
+        A full snapshot is written instead if the graph doesn't come from this file, or
+        if the delta file would become bigger than max_delta_ratio times the size of
+        the snapshot, which also removes the delta file.
+
+        example:
+          g.load('library.db')
+          ...
+          g.save_incremental('library.db')  # every hour
+        """
+        self._check_partial(filename)
+        if (self._logs_to(filename) or
+            self._base is None or self._base[0] != os.path.abspath(filename)):
+            return self.save(filename)
+
+        path, snapshot_id, delta_size = self._base
+        delta = filename + '.delta'
+        if (delta_size > max_delta_ratio * os.path.getsize(filename) or
+            (delta_size and not os.path.exists(delta))):
+            return self.save(filename)
+
+        with open(delta, 'r+b' if os.path.exists(delta) else 'wb') as f:
+            # discard an incomplete segment, if any
+            f.truncate(delta_size)
+            f.seek(delta_size)
+            self._dirty.discard(None)
+            snapshot.write_delta(self, f, self._dirty, metadata = { 'base': snapshot_id })
+            f.flush()
+            os.fsync(f.fileno())
+            delta_size = f.tell()
+
+        self._base = (path, snapshot_id, delta_size)
+        self._dirty = set()
+
+    def _check_partial(self, filename):
+        if self._partial is not None and self._partial == os.path.abspath(filename):
+            raise ValueError('Graph %s has been partially loaded from %s, saving it there '
+                             'would lose the nodes which have not been loaded' % (self, filename))
+
+    def _logs_to(self, filename):
+        return (self._log is not None and
+                os.path.abspath(self._log.filename) == os.path.abspath(filename))
+
+    def open_log(self, filename, commit_every = 1000, commit_interval = 1.0):
+        """Load the graph from the snapshot saved in the given file, replay the mutation
+        log written after it, and log all the following mutations of the graph.
+
+        The log is committed to disk every commit_every mutations, or every
+        commit_interval seconds if it is not None, whichever comes first, or when
+        commit() is called. See pygoo.mutationlog for more details.
+
+        example:
+          g = MemoryObjectGraph()
+          g.open_log('library.db')
+          g.Series(title = 'Monk')
+          g.commit()
+          ...
+          g.compact()  # fold the log into a new snapshot
+          g.close_log()
+        """
+        from pygoo.mutationlog import MutationLog
+        if self._log is not None:
+            raise ValueError('Graph %s already has a mutation log' % self)
+        self._log = MutationLog(self, filename, commit_every, commit_interval)
+
+    def commit(self):
+        """Write the pending records of the mutation log to disk."""
+        self._log.commit()
+
+    def compact(self, background = True):
+        """Write a new snapshot of the graph, and remove the mutation log files it
+        makes obsolete. If background is True, this is done in a forked child process
+        (when the platform supports it) and returns immediately."""
+        self._log.compact(self, background)
+
+    def close_log(self):
+        """Commit and close the mutation log. Mutations are not logged anymore afterwards."""
+        self._log.close()
+        self._log = None
 
     # __getstate__ and __setstate__ are needed for the cache to be able to work
     def __setstate__(self, state):
-        self._nodes = set()
+        self._nodes = []
+        self._indexes = {}
+        self._log = None
+        self._dirty = None
+        self._base = None
+        self._partial = None
         super(MemoryObjectGraph, self).__setstate__(state)
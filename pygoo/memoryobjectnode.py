@@ -22,6 +22,7 @@ from pygoo.abstractnode import AbstractNode
 from pygoo.objectnode import ObjectNode
 from pygoo.utils import is_literal
 from pygoo import ontology
+import weakref
 import logging
 
 log = logging.getLogger(__name__)
@@ -33,19 +34,39 @@ class MemoryObjectNode(ObjectNode):
     in the same dictionary, with links to the concerned ``ObjectNode``s.
     """
 
-    def __init__(self, graph, props=None, _classes=None):
+    def __init__(self, graph, props=None, _classes=None, _id=None):
         # NB: this should go before super().__init__() because we need
         #     self._props and self._classes to exist before we can set
         #     attributes
         #log.debug('Creating MemoryObjectNode with props = %s' % props)
         self._props = {}
         self._classes = set(_classes) if _classes is not None else set()
+        self._id = None
         super(MemoryObjectNode, self).__init__(graph, props)
 
         log.debug('MemoryNode.__init__: classes = %s' % list(self._classes))
-        graph._nodes.add(self)
+        graph._add_node(self, _id)
 
 
+    @classmethod
+    def restore(cls, graph, props, _classes, _id):
+        """Create a node directly from its literal properties and classes, without going
+        through ObjectNode.set() and the validation of its classes.
+        See MemoryObjectGraph.restore_node()."""
+        node = cls.__new__(cls)
+        object.__setattr__(node, 'graph', weakref.ref(graph))
+        object.__setattr__(node, '_props', dict((name, value) for name, value, _ in props))
+        object.__setattr__(node, '_classes', set(_classes))
+        object.__setattr__(node, '_id', None)
+
+        for name, index in graph._indexes.items():
+            value = node._props.get(name)
+            if value is not None:
+                index.add(node, value)
+
+        graph._add_node(node, _id)
+        return node
+
     def __eq__(self, other):
         return self is other
 
@@ -54,22 +75,32 @@ class MemoryObjectNode(ObjectNode):
         return id(self)
 
     def __setattr__(self, name, value):
-        if name in [ '_props', '_classes' ]:
+        if name in [ '_props', '_classes', '_id' ]:
             object.__setattr__(self, name, value)
         else:
             super(MemoryObjectNode, self).__setattr__(name, value)
 
 
+    def node_id(self):
+        return self._id
+
+    def _mutated(self, mutation, *args):
+        self.graph()._mutated(self._id, mutation, self, *args)
+
+
     ### Ontology methods
 
     def add_class(self, cls):
         self._classes.add(cls)
+        self._mutated('set_classes')
 
     def remove_class(self, cls):
         self._classes.remove(cls)
+        self._mutated('set_classes')
 
     def clear_classes(self):
         self._classes = set()
+        self._mutated('set_classes')
 
     def classes(self):
         return self._classes
@@ -89,9 +120,29 @@ class MemoryObjectNode(ObjectNode):
         raise AttributeError
 
     def set_literal(self, name, value):
+        graph = self.graph()
+        index = graph._indexes.get(name)
+        if index is not None:
+            old_value = self._props.get(name)
+            if is_literal(old_value):
+                index.remove(self, old_value)
+            index.add(self, value)
+
         self._props[name] = value
+        self._mutated('set_literal', name, value)
+
+    def del_literal(self, name):
+        value = self._props.get(name)
+        if name not in self._props or not is_literal(value):
+            raise AttributeError(name)
 
-    # FIXME: need to implement del_literal here
+        graph = self.graph()
+        index = graph._indexes.get(name)
+        if index is not None:
+            index.remove(self, value)
+
+        del self._props[name]
+        self._mutated('del_literal', name)
 
     def literal_keys(self):
         return (k for k, v in self._props.items() if is_literal(v))
@@ -112,6 +163,8 @@ class MemoryObjectNode(ObjectNode):
         node_list.append(other_node)
         self._props[name] = node_list
 
+        self._mutated('add_edge', name, other_node)
+
     def remove_directed_edge(self, name, other_node):
         # other_node should always be a valid node
         node_list = self._props.get(name) or []
@@ -124,6 +177,8 @@ class MemoryObjectNode(ObjectNode):
         if self._props[name] == []:
             del self._props[name]
 
+        self._mutated('remove_edge', name, other_node)
+
 
     def outgoing_edge_endpoints(self, name=None):
         if name is None:
@@ -164,6 +219,15 @@ class MemoryObjectNode(ObjectNode):
     def keys(self):
         return self._props.keys()
 
+    def get(self, name, default=None):
+        # same result as ObjectNode.get(), but without going through the
+        # exception-driven lookup of ObjectNode.__getattr__
+        # note: as in _outgoing_edge_endpoints(), a missing property is an empty link
+        result = self._props.get(name, [])
+        if is_literal(result):
+            return result
+        return iter(result)
+
     # FIXME: wrong implementation as the values for edges should be iterators
     #def values(self):
     #    return self._props.values()
@@ -172,8 +236,12 @@ class MemoryObjectNode(ObjectNode):
     #    return self._props.items()
 
     def update_valid_classes(self):
-        if self.graph()._dynamic:
-            self._classes = set(cls for cls in ontology._classes.values() if self.is_valid_instance(cls))
+        graph = self.graph()
+        if graph._dynamic:
+            classes = set(cls for cls in ontology._classes.values() if self.is_valid_instance(cls))
+            if classes != self._classes:
+                self._classes = classes
+                self._mutated('set_classes')
         else:
             # no need to do anything
             pass
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pygoo.objectgraph import ObjectGraph
+from pygoo.mmapobjectnode import MmapObjectNode
+from pygoo.snapshot import SnapshotReader, SnapshotIndex, read_metadata, read_deltas
+from pygoo import ontology
+import weakref
+import heapq
+import mmap
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class MmapObjectGraph(ObjectGraph):
+    """A read-only ObjectGraph which reads its nodes directly from a snapshot file
+    (see pygoo.snapshot) mapped in memory.
+
+    Opening the graph only reads the index of the snapshot, and nodes are only
+    decoded when they are accessed, which makes it possible to start answering
+    queries right away even for very big graphs. As the file is mapped read-only,
+    its pages are shared between all the processes which open the same snapshot.
+
+    Nodes are kept in a weak identity map, so that accessing the same node twice
+    returns the same instance as long as it is used somewhere, without keeping all
+    the nodes that have been accessed in memory.
+
+    The delta segments written by MemoryObjectGraph.save_incremental are read when
+    opening the graph, and the nodes they contain take precedence over the ones of
+    the snapshot.
+
+    example:
+      g = MemoryObjectGraph()
+      ...
+      g.save('library.db')
+
+      # in the server processes
+      g = MmapObjectGraph('library.db')
+      g.find_all(Episode, series_title = 'Monk')
+    """
+    _object_node_class = MmapObjectNode
+
+    def __init__(self, filename, dynamic = False):
+        super(MmapObjectGraph, self).__init__(dynamic)
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        try:
+            # check the header
+            SnapshotReader(self._mmap)
+            self._index = SnapshotIndex(self._mmap)
+            self._read_deltas()
+        except:
+            self._mmap.close()
+            raise
+
+        self._cache = weakref.WeakValueDictionary()
+
+    def _read_deltas(self):
+        # node id -> (class names, literals), or None if the node has been deleted
+        self._delta_nodes = {}
+        # node id -> list of (name, target node id) outgoing edges
+        self._delta_edges = {}
+
+        self._mmap.seek(0)
+        snapshot_id = read_metadata(self._mmap).get('snapshot_id')
+        for changes, _ in read_deltas(self.filename, snapshot_id):
+            for tag, change in changes:
+                if tag == b'N':
+                    node_id, class_names, literals = change
+                    self._delta_nodes[node_id] = (class_names, literals)
+                elif tag == b'A':
+                    node_id, edges = change
+                    self._delta_edges[node_id] = edges
+                elif tag == b'K':
+                    self._delta_nodes[change] = None
+                    self._delta_edges.pop(change, None)
+
+        self._node_count = max([ self._index.node_count ] +
+                               [ node_id + 1 for node_id in self._delta_nodes ])
+
+    def close(self):
+        """Release the memory mapping. The graph and its nodes can't be used anymore afterwards."""
+        self._cache.clear()
+        self._mmap.close()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('MmapObjectGraph is read-only, load it in a MemoryObjectGraph to modify it')
+
+    clear = create_node = restore_node = delete_node = load = _read_only
+    add_directed_edge = remove_directed_edge = _read_only
+
+    def revalidate_objects(self):
+        # the valid classes have been computed when the snapshot was written, and
+        # revalidating would need to decode all the nodes
+        pass
+
+
+    def get_node(self, node_id):
+        node = self._cache.get(node_id)
+        if node is None:
+            try:
+                class_names, literals = self._node_record(node_id)
+            except KeyError:
+                raise KeyError('No node with id %d in graph %s' % (node_id, self))
+            node = self.__class__._object_node_class(self, node_id,
+                                                     [ ontology.get_class(cls) for cls in class_names ],
+                                                     literals)
+            self._cache[node_id] = node
+        return node
+
+    def _node_record(self, node_id):
+        if node_id in self._delta_nodes:
+            record = self._delta_nodes[node_id]
+            if record is None:
+                raise KeyError(node_id)
+            return record
+        return self._index.node(node_id)
+
+    def _edges(self, node_id):
+        """Return the list of (name, target node id) outgoing edges of the given node id."""
+        edges = self._delta_edges.get(node_id)
+        if edges is None:
+            edges = self._index.edges(node_id)
+        return edges
+
+    def scan_nodes(self, after = None):
+        index = self._index
+        delta = self._delta_nodes
+        start = after + 1 if after is not None else 0
+        for node_id in xrange(start, self._node_count):
+            if node_id in delta:
+                exists = delta[node_id] is not None
+            else:
+                exists = index.node_offset(node_id) != 0
+            if exists:
+                yield node_id, self.get_node(node_id)
+
+    def nodes(self):
+        for _, node in self.scan_nodes():
+            yield node
+
+    def nodes_from_class(self, cls):
+        name = cls.__name__
+        delta = self._delta_nodes
+        node_ids = self._index.class_node_ids(name)
+        if delta:
+            # both are sorted by node id
+            node_ids = heapq.merge((node_id for node_id in node_ids if node_id not in delta),
+                                   sorted(node_id for node_id, record in delta.items()
+                                          if record is not None and name in record[0]))
+        for node_id in node_ids:
+            yield self.get_node(node_id)
+
+    def contains(self, node):
+        """Return whether this graph contains the given node (identity)."""
+        return isinstance(node, MmapObjectNode) and node.graph() is self
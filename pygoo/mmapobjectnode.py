@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pygoo.objectnode import ObjectNode
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class MmapObjectNode(ObjectNode):
+    """Implementation of a read-only object node backed by a memory-mapped snapshot.
+
+    The classes and literals of the node are decoded when it is created, but its
+    edges are only decoded the first time they are accessed, and are kept as
+    node ids, the pointed nodes being materialized by the graph only when they
+    are actually iterated over.
+
+    Any attempt to modify the node raises a TypeError.
+    """
+
+    def __init__(self, graph, node_id, _classes, literals):
+        self._props = dict(literals)
+        self._classes = frozenset(_classes)
+        self._edges = None
+        self._id = node_id
+        super(MmapObjectNode, self).__init__(graph)
+
+    def __eq__(self, other):
+        return (isinstance(other, MmapObjectNode) and
+                self._id == other._id and
+                self.graph() is other.graph())
+
+    def __hash__(self):
+        return hash(self._id)
+
+    def __setattr__(self, name, value):
+        if name in [ '_props', '_classes', '_edges', '_id' ]:
+            object.__setattr__(self, name, value)
+        else:
+            super(MmapObjectNode, self).__setattr__(name, value)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Cannot modify node %d: MmapObjectGraph is read-only' % self._id)
+
+
+    def node_id(self):
+        return self._id
+
+
+    ### Ontology methods
+
+    add_class = remove_class = clear_classes = _read_only
+
+    def classes(self):
+        return self._classes
+
+    def isinstance(self, cls):
+        return cls in self._classes
+
+    def update_valid_classes(self):
+        # classes have been validated when the snapshot was written
+        pass
+
+
+    ### Accessing literal properties
+
+    def get_literal(self, name):
+        try:
+            return self._props[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    set_literal = del_literal = _read_only
+
+    def literal_keys(self):
+        return iter(self._props.keys())
+
+    def literal_values(self):
+        return iter(self._props.values())
+
+    def literal_items(self):
+        return iter(self._props.items())
+
+
+    ### Accessing edge properties
+
+    add_directed_edge = remove_directed_edge = _read_only
+
+    def _edge_ids(self):
+        """Return a dict of edge name to the list of pointed node ids, decoding it
+        from the snapshot the first time it is needed."""
+        if self._edges is None:
+            edges = {}
+            for name, other_id in self.graph()._edges(self._id):
+                edges.setdefault(name, []).append(other_id)
+            self._edges = edges
+        return self._edges
+
+    def _endpoints(self, node_ids):
+        get_node = self.graph().get_node
+        for node_id in node_ids:
+            yield get_node(node_id)
+
+    def outgoing_edge_endpoints(self, name = None):
+        if name is None:
+            return self._endpoints(node_id for node_ids in self._edge_ids().values()
+                                           for node_id in node_ids)
+        if name in self._props:
+            raise AttributeError(name)
+        return self._endpoints(self._edge_ids().get(name, []))
+
+    def edge_keys(self):
+        return iter(self._edge_ids().keys())
+
+    def edge_values(self):
+        return (self._endpoints(v) for v in self._edge_ids().values())
+
+    def edge_items(self):
+        return ((k, self._endpoints(v)) for k, v in self._edge_ids().items())
+
+
+    # The next methods are overriden for efficiency, see MemoryObjectNode
+
+    def keys(self):
+        return self._props.keys() + self._edge_ids().keys()
+
+    def get(self, name, default=None):
+        result = self._props.get(name)
+        if result is not None or name in self._props:
+            return result
+        return self._endpoints(self._edge_ids().get(name, []))
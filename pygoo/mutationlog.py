@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Write-ahead log of the mutations of a MemoryObjectGraph.
+
+When a log is attached to a graph (see MemoryObjectGraph.open_log), each
+mutation of the graph is appended to a log file as a compact binary record, so
+that a graph can be recovered after a crash by loading its latest snapshot and
+replaying the log written after it.
+
+Log files use the same record format as snapshots (see pygoo.snapshot), with
+a different magic string and the following records:
+
+ - 'S' (string): same as in snapshots, each log file has its own string table
+ - 'N' (create node): same as the node record of snapshots
+ - 'C' (classes): same as a node record without literals, replaces the classes of a node
+ - 'L' (set literal): node id, string number of the name (<II), typed value
+ - 'D' (delete literal): node id, string number of the name (<II)
+ - 'E' (add edge), 'R' (remove edge): node id, string number of the name,
+   target node id (<III)
+ - 'K' (delete node): node id (<I)
+ - 'W' (clear): no payload
+
+Records are buffered and written to disk in groups (group commit): the log is
+committed (written and fsync'ed) each time commit_every records have been
+appended or commit_interval seconds after the first record which hasn't been
+committed yet (by a timer thread, even if no more records are appended), or when
+calling MemoryObjectGraph.commit() explicitly. A crash can thus lose the
+mutations done since the last commit, but never corrupt the graph: a record
+which has only been partially written is discarded when recovering.
+
+For a snapshot saved in graph.db, log files are named graph.db.<n>.log, where
+n is the log generation. Compacting the log (see MemoryObjectGraph.compact)
+starts a new generation, and writes a new snapshot containing all the previous
+ones, after which the old log files can be deleted. The snapshot remembers the
+first log generation which is not included in it in its metadata, so that a
+crash during compaction can never replay the same mutations twice.
+"""
+
+from pygoo.snapshot import (SnapshotWriter, SnapshotReader, read_snapshot, write_snapshot,
+                            read_deltas, apply_delta, is_snapshot, encode_literal,
+                            decode_literal, _header, _record, _uint, _literal, _node)
+from pygoo import ontology
+import threading
+import struct
+import time
+import glob
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+LOG_MAGIC = b'PYGOOLOG'
+
+_pair = struct.Struct(b'<II')
+_triple = struct.Struct(b'<III')
+
+
+class LogWriter(SnapshotWriter):
+    """Write the records of a mutation log (see SnapshotWriter)."""
+
+    magic = LOG_MAGIC
+
+    def write_classes(self, node_id, classes):
+        sid = self.string_id
+        payload = [ _node.pack(node_id, len(classes), 0) ]
+        payload += [ _uint.pack(sid(cls)) for cls in classes ]
+        self.record(b'C', b''.join(payload))
+
+    def write_literal(self, node_id, name, value):
+        self.record(b'L', _pair.pack(node_id, self.string_id(name)) + encode_literal(value))
+
+    def write_del_literal(self, node_id, name):
+        self.record(b'D', _pair.pack(node_id, self.string_id(name)))
+
+    def write_edge(self, tag, node_id, name, other_id):
+        self.record(tag, _triple.pack(node_id, self.string_id(name), other_id))
+
+    def write_delete(self, node_id):
+        self.record(b'K', _uint.pack(node_id))
+
+    def write_clear(self):
+        self.record(b'W', b'')
+
+
+class LogReader(SnapshotReader):
+    """Read the records of a mutation log (see SnapshotReader).
+
+    Contrary to snapshots, a log doesn't have an end record and a truncated last
+    record is not an error, it is simply ignored. After having read all the
+    records, valid_size contains the size of the part of the file that contains
+    complete records."""
+
+    magic = LOG_MAGIC
+
+    def records(self):
+        read = self._f.read
+        strings = self.strings
+        self.valid_size = _header.size
+        while True:
+            header = read(_record.size)
+            if len(header) < _record.size:
+                break
+            tag, size = _record.unpack(header)
+            payload = read(size)
+            if len(payload) != size:
+                break
+            self.valid_size += _record.size + size
+
+            if tag == b'S':
+                strings.append(payload.decode('utf-8'))
+            else:
+                yield tag, payload
+
+        if header:
+            log.warning('Ignoring incomplete record at the end of mutation log')
+
+
+def replay_log(graph, f):
+    """Apply the mutations contained in the given log file-like object to the given
+    graph, and return the LogReader used to read it."""
+    reader = LogReader(f)
+    strings = reader.strings
+    get_node = graph.get_node
+
+    def get_classes(class_names):
+        return [ ontology.get_class(cls) for cls in class_names ]
+
+    for tag, payload in reader.records():
+        if tag == b'N':
+            node_id, class_names, literals = reader.decode_node(payload)
+            graph.restore_node(node_id,
+                               props = [ (name, value, None) for name, value in literals ],
+                               _classes = get_classes(class_names))
+
+        elif tag == b'L':
+            node_id, sid, ltype = _uint.unpack_from(payload, 0) + _literal.unpack_from(payload, 4)
+            value, _ = decode_literal(payload, 4 + _literal.size, ltype)
+            get_node(node_id).set_literal(strings[sid], value)
+
+        elif tag == b'E' or tag == b'R':
+            node_id, sid, other_id = _triple.unpack(payload)
+            node = get_node(node_id)
+            if tag == b'E':
+                node.add_directed_edge(strings[sid], get_node(other_id))
+            else:
+                node.remove_directed_edge(strings[sid], get_node(other_id))
+
+        elif tag == b'C':
+            node_id, class_names, _ = reader.decode_node(payload)
+            node = get_node(node_id)
+            node.clear_classes()
+            for cls in get_classes(class_names):
+                node.add_class(cls)
+
+        elif tag == b'D':
+            node_id, sid = _pair.unpack(payload)
+            get_node(node_id).del_literal(strings[sid])
+
+        elif tag == b'K':
+            node_id, = _uint.unpack(payload)
+            graph.delete_node(get_node(node_id))
+
+        elif tag == b'W':
+            graph.clear()
+
+    return reader
+
+
+def log_files(filename):
+    """Return the sorted list of (generation, log filename) for the given snapshot filename."""
+    result = []
+    for path in glob.glob(filename + '.*.log'):
+        generation = path[len(filename)+1:-len('.log')]
+        if generation.isdigit():
+            result.append((int(generation), path))
+    return sorted(result)
+
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class MutationLog(object):
+    """A MutationLog writes the mutations of a graph to its log file. It is created
+    and attached to a graph by MemoryObjectGraph.open_log, you should not need
+    to use it directly."""
+
+    def __init__(self, graph, filename, commit_every = 1000, commit_interval = 1.0):
+        self.filename = filename
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = []
+        self._compaction = None
+        # records are written by the graph and committed either by the graph or by
+        # the commit timer
+        self._lock = threading.RLock()
+        self._timer = None
+
+        # recover the graph: load the snapshot and replay the logs written after it
+        self.generation = 0
+        if os.path.exists(filename):
+            if is_snapshot(filename):
+                with open(filename, 'rb') as f:
+                    metadata = read_snapshot(graph, f)
+                self.generation = metadata.get('log_generation', 0)
+                # the snapshot may have been saved incrementally before the log was opened
+                for changes, _ in read_deltas(filename, metadata.get('snapshot_id')):
+                    apply_delta(graph, changes)
+            else:
+                graph.load(filename)
+        else:
+            graph.clear()
+
+        strings, valid_size = None, None
+        for generation, path in log_files(filename):
+            if generation < self.generation:
+                # already contained in the snapshot
+                os.remove(path)
+                continue
+
+            self.generation = generation
+            strings, valid_size = None, None
+            if os.path.getsize(path) >= _header.size:
+                with open(path, 'rb') as f:
+                    reader = replay_log(graph, f)
+                strings, valid_size = reader.strings, reader.valid_size
+
+        self._open(strings, valid_size)
+
+    def _log_filename(self, generation):
+        return '%s.%d.log' % (self.filename, generation)
+
+    def _open(self, strings = None, valid_size = None):
+        """Open the log file for the current generation, continuing it if strings
+        and valid_size are given, or starting a new one otherwise."""
+        path = self._log_filename(self.generation)
+        if valid_size is None:
+            self._f = open(path, 'wb')
+        else:
+            self._f = open(path, 'r+b')
+            # discard an incomplete record at the end, if any
+            self._f.truncate(valid_size)
+            self._f.seek(valid_size)
+
+        self._writer = LogWriter(self._f, strings)
+        self._count = 0
+        self.commit()
+
+    def commit(self):
+        """Write all the pending records to disk."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._writer.flush()
+            _fsync(self._f)
+            self._count = 0
+            self._last_commit = time.time()
+
+    def close(self):
+        self.wait_compaction()
+        with self._lock:
+            self.commit()
+            self._f.close()
+
+    def _timed_commit(self):
+        with self._lock:
+            if self._count and not self._f.closed:
+                self.commit()
+
+    def _written(self):
+        self._count += 1
+        if (self._count >= self.commit_every or
+            (self.commit_interval is not None and
+             time.time() - self._last_commit >= self.commit_interval)):
+            self.commit()
+        elif self._timer is None and self.commit_interval is not None:
+            # make sure that this record is committed in time even if no other
+            # record is appended
+            self._timer = threading.Timer(self.commit_interval, self._timed_commit)
+            self._timer.daemon = True
+            self._timer.start()
+
+
+    ### Methods called by the graph and its nodes for each mutation
+
+    def create_node(self, node):
+        with self._lock:
+            self._writer.write_node(node._id,
+                                    [ cls.__name__ for cls in node.classes() ],
+                                    list(node.literal_items()))
+            self._written()
+
+            # write the edges which have been added while the node was being created
+            # (ie: before it had an id)
+            pending, self._pending = self._pending, []
+            for tag, n, name, other_node in pending:
+                if n._id is not None and other_node._id is not None:
+                    self._edge(tag, n, name, other_node)
+
+    def set_classes(self, node):
+        if node._id is not None:
+            with self._lock:
+                self._writer.write_classes(node._id, [ cls.__name__ for cls in node.classes() ])
+                self._written()
+
+    def set_literal(self, node, name, value):
+        # literals set before the node has an id are written with the node itself
+        if node._id is not None:
+            with self._lock:
+                self._writer.write_literal(node._id, name, value)
+                self._written()
+
+    def del_literal(self, node, name):
+        if node._id is not None:
+            with self._lock:
+                self._writer.write_del_literal(node._id, name)
+                self._written()
+
+    def _edge(self, tag, node, name, other_node):
+        if node._id is None or other_node._id is None:
+            self._pending.append((tag, node, name, other_node))
+        else:
+            with self._lock:
+                self._writer.write_edge(tag, node._id, name, other_node._id)
+                self._written()
+
+    def add_edge(self, node, name, other_node):
+        self._edge(b'E', node, name, other_node)
+
+    def remove_edge(self, node, name, other_node):
+        self._edge(b'R', node, name, other_node)
+
+    def delete_node(self, node):
+        with self._lock:
+            self._writer.write_delete(node._id)
+            self._written()
+
+    def clear(self):
+        self._pending = []
+        with self._lock:
+            self._writer.write_clear()
+            self._written()
+
+
+    ### Compaction
+
+    def compact(self, graph, background = True):
+        """Write a new snapshot of the given graph, and delete the log files it makes obsolete.
+
+        If background is True and the platform supports it, the snapshot is written
+        by a forked child process, which works on a copy-on-write image of the graph,
+        so that the graph can still be used and modified while it is written."""
+        self.wait_compaction()
+
+        # start a new log generation, the snapshot will contain everything before it
+        with self._lock:
+            self.commit()
+            self._f.close()
+            self.generation += 1
+            self._open()
+        generation = self.generation
+
+        def write():
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                write_snapshot(graph, f, metadata = { 'log_generation': generation })
+                _fsync(f)
+            os.rename(tmp, self.filename)
+
+        if background and hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                # child process: write the snapshot and exit without running any cleanup
+                status = 1
+                try:
+                    write()
+                    status = 0
+                finally:
+                    os._exit(status)
+
+            def wait():
+                _, status = os.waitpid(pid, 0)
+                if status == 0:
+                    self._remove_logs(generation)
+                else:
+                    log.error('Log compaction of %s failed with status %d' % (self.filename, status))
+
+            self._compaction = threading.Thread(target = wait)
+            self._compaction.daemon = True
+            self._compaction.start()
+
+        else:
+            write()
+            self._remove_logs(generation)
+
+    def wait_compaction(self):
+        """Wait for the end of the compaction currently running, if any."""
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+
+    def _remove_logs(self, generation):
+        for gen, path in log_files(self.filename):
+            if gen < generation:
+                os.remove(path)
+        # the delta segments of the previous snapshot are obsolete too
+        if os.path.exists(self.filename + '.delta'):
+            os.remove(self.filename + '.delta')
@@ -1,61 +1,166 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-
-from neo4jrestclient.client import GraphDatabase
-import subprocess, glob
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Minimal client for the Cypher transactional HTTP endpoint of a Neo4j server.
+
+Only the standard library is used. A request contains a list of Cypher statements
+which are all executed in a single server transaction, so that a whole batch of
+modifications is applied atomically in one round trip (see CypherClient.run).
+"""
+
+import cPickle as pickle
+import urlparse
+import httplib
+import select
+import base64
+import json
 import logging
 
 log = logging.getLogger(__name__)
 
 
-dirname = None
-graph = None
-transaction = None
-
-
-def default_jvm():
-    # make an educated guess on debian-based system
-    java = subprocess.Popen([ 'ls', '-l', '/etc/alternatives/java' ], stdout = subprocess.PIPE).stdout.read().strip().split()[-1]
-    java_rootdir = '/'.join(java.split('/')[:-2])
-    jvms = glob.glob(java_rootdir + '/lib/*/client/libjvm.so')
-
-    if jvms:
-        return jvms[0]
-
-    raise OSError, 'Could not find default JVM'
-
-
-
-def close():
-    global dirname, graph, transaction
-
-    try:
-        graph.shutdown()
-        dirname, graph, transaction = None, None, None
-    except RuntimeError, e:
-        log.error(str(e))
-
-
-def open(dbpath):
-    global dirname, graph, transaction
-
-    if dirname:
-        raise RuntimeError("A Neo4j database is already open. Please close it before opening a new one.")
-
-    dirname = dbpath
-    graph = GraphDatabase("http://localhost:7474/db/data/")
-    #NeoService(dbpath, jvm = default_jvm())
-    transaction = graph.transaction
-
-
-def delete_all_data():
-    global dirname
-    dbpath = dirname
-
-    close()
-
-    print dbpath, type(dbpath)
-    # do it the brute-force way...
-    subprocess.call([ 'rm', '-fr', dbpath ])
-
-    open(dbpath)
+DEFAULT_URL = 'http://localhost:7474/db/data/'
+
+# literal values which can't be stored as Neo4j properties (longs, None, guessit
+# Language, ...) are stored as strings starting with this prefix, followed by
+# their base64-encoded pickle
+PICKLE_PREFIX = '\x00pygoo:'
+
+
+class Neo4jError(Exception):
+    """Raised when the Neo4j server can't be reached or returns an error."""
+    pass
+
+
+def quote(name):
+    """Quote a label, relationship type or property name to be used in a Cypher query."""
+    return '`%s`' % name.replace('`', '``')
+
+
+def is_native(value):
+    """Return whether the given literal value is stored as is in Neo4j."""
+    t = type(value)
+    return t is unicode or t is int or t is float
+
+def to_neo(value):
+    """Return the representation of the given literal value as a Neo4j property."""
+    if is_native(value):
+        return value
+    return PICKLE_PREFIX + base64.b64encode(pickle.dumps(value, 2)).decode('ascii')
+
+def from_neo(value):
+    """Return the literal value corresponding to the given Neo4j property (see to_neo)."""
+    if isinstance(value, unicode):
+        if value.startswith(PICKLE_PREFIX):
+            return pickle.loads(base64.b64decode(value[len(PICKLE_PREFIX):]))
+        return value
+    if isinstance(value, long) and -2**63 <= value < 2**63:
+        # the json module returns longs for big ints, but they were ints when written
+        return int(value)
+    return value
+
+
+class CypherClient(object):
+    """A connection to the Cypher transactional endpoint of a Neo4j server.
+
+    example:
+      client = CypherClient('http://localhost:7474/db/data/')
+      client.query('MATCH (n) WHERE n.title = {title} RETURN id(n)', title = 'Monk')
+    """
+
+    def __init__(self, url = DEFAULT_URL):
+        self.url = url
+        parsed = urlparse.urlparse(url)
+        self._host = parsed.netloc
+        self._path = parsed.path.rstrip('/') + '/transaction/commit'
+        self._connection = None
+        # number of requests sent to the server, mostly useful for testing
+        self.requests = 0
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _dropped(self):
+        """Return whether the server closed the idle connection kept open since the
+        last request, in which case its socket is readable (at end of file)."""
+        sock = self._connection.sock
+        return sock is not None and bool(select.select([ sock ], [], [], 0)[0])
+
+    def _post(self, body):
+        # the connection is kept open between requests, and opened again if the
+        # server closed it in the meantime. The request is only sent again if it
+        # couldn't be sent on a reused connection: once it has been sent, the server
+        # might have executed it, and sending it again could apply it twice.
+        if self._connection is not None and self._dropped():
+            self.close()
+        for retry in (True, False):
+            reused = self._connection is not None
+            if not reused:
+                self._connection = httplib.HTTPConnection(self._host)
+            try:
+                self._connection.request('POST', self._path, body,
+                                         { 'Content-Type': 'application/json',
+                                           'Accept': 'application/json; charset=UTF-8' })
+                break
+            except (httplib.HTTPException, IOError), e:
+                self.close()
+                if not (retry and reused):
+                    raise Neo4jError('Could not connect to Neo4j server at %s: %s' % (self.url, e))
+
+        try:
+            response = self._connection.getresponse()
+            return response.status, response.read()
+        except (httplib.HTTPException, IOError), e:
+            self.close()
+            raise Neo4jError('Lost connection to Neo4j server at %s after sending a request, '
+                             'which might have been executed: %s' % (self.url, e))
+
+    def run(self, statements):
+        """Execute the given list of (query, parameters dict) statements in a single
+        transaction, and return the list of their results, each of them being a list
+        of rows (lists of values).
+
+        :raises Neo4jError: If the server can't be reached, or if one of the statements
+                            failed, in which case none of them has been applied. If
+                            the connection was lost while waiting for the response,
+                            the statements might have been applied or not.
+        """
+        if not statements:
+            return []
+        body = json.dumps({ 'statements': [ { 'statement': query, 'parameters': params }
+                                            for query, params in statements ] })
+        log.debug('Sending %d Cypher statements to %s' % (len(statements), self.url))
+        status, data = self._post(body)
+        self.requests += 1
+
+        if status != 200:
+            raise Neo4jError('Neo4j server returned HTTP status %d: %s' % (status, data[:200]))
+        response = json.loads(data)
+        if response.get('errors'):
+            raise Neo4jError('; '.join('%s: %s' % (e.get('code'), e.get('message'))
+                                       for e in response['errors']))
+
+        return [ [ row['row'] for row in result['data'] ] for result in response['results'] ]
+
+    def query(self, query, **params):
+        """Execute a single statement and return its rows."""
+        return self.run([ (query, params) ])[0]
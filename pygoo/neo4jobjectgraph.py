@@ -18,70 +18,649 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from pygoo.memoryobjectgraph import MemoryObjectGraph
+from pygoo.objectgraph import ObjectGraph, Equal
 from pygoo.neo4jobjectnode import Neo4jObjectNode
-#import neo4j
-import neo
+from pygoo.baseobject import BaseObject
+from pygoo.neo import CypherClient, DEFAULT_URL, quote, to_neo, is_native
+from pygoo import ontology
+from contextlib import contextmanager
+import collections
+import weakref
 import logging
 
 log = logging.getLogger(__name__)
 
-"""
-class AllNodes(neo4j.Traversal):
-    types = [
-        #neo4j.Incoming._ingraph,
-        ]
-    #order = neo4j.DEPTH_FIRST
-    #stop = neo4j.STOP_AT_END_OF_GRAPH
-    #returnable = neo4j.RETURN_ALL_BUT_START_NODE
-"""
-
-def all_nodes():
-    # FIXME: ATM returns neo nodes, not expected Neo4jObjectNodes
-    return AllNodes(neo.graph.reference_node)
-
-class Neo4jObjectGraph(MemoryObjectGraph):
-    """A Neo4jObjectGraph is an ObjectGraph where all data is persistent on disk.
-    All attribute modifications are immediately synchronized on the data store.
-
-    A Neo4jObjectGraph uses PersistentObjectNodes."""
+
+# SYNC can take 2 values:
+# - AUTO: automatically synchronize changes with the underlying store as they are modified
+# - MANUAL: only flush data to store when the synchronize() method is called
+AUTO = 'auto'
+MANUAL = 'manual'
+
+# number of node ids reserved at once on the server
+ID_BLOCK_SIZE = 1000
+
+# number of nodes fetched by each request when iterating over nodes
+FETCH_SIZE = 1000
+
+# maximum number of node objects kept in the cache of a graph
+CACHE_SIZE = 10000
+
+# number of nodes or edges sent by each request when importing a graph
+IMPORT_BATCH_SIZE = 5000
+
+
+# All the nodes are stored with the PyGoo label and one label per class, and are
+# identified by their node id, stored in the _id property (which has a uniqueness
+# constraint, and thus an index). Edges are stored as relationships.
+
+# label, property
+_CONSTRAINT = 'CREATE CONSTRAINT ON (n:%s) ASSERT n.%s IS UNIQUE'
+
+_INDEX = 'CREATE INDEX ON :%s(%s)'
+
+_RESERVE_IDS = ('MERGE (s:PyGooSequence) ON CREATE SET s.next = 0 '
+                'SET s.next = CASE WHEN s.next < {min} THEN {min} ELSE s.next END + {count} '
+                'RETURN s.next')
+
+_CREATE_NODES = 'UNWIND {rows} AS row CREATE (n:PyGoo%s) SET n = row.props'
+
+_UPDATE_NODES = 'UNWIND {rows} AS row MATCH (n:PyGoo {_id: row.id}) SET n = row.props'
+
+_ADD_LABEL = 'UNWIND {ids} AS id MATCH (n:PyGoo {_id: id}) SET n:%s'
+
+_REMOVE_LABEL = 'UNWIND {ids} AS id MATCH (n:PyGoo {_id: id}) REMOVE n:%s'
+
+_ADD_EDGES = ('UNWIND {rows} AS row MATCH (a:PyGoo {_id: row.source}), (b:PyGoo {_id: row.target}) '
+              'CREATE (a)-[r:%s]->(b) RETURN id(r)')
+
+_IMPORT_EDGES = ('UNWIND {rows} AS row MATCH (a:PyGoo {_id: row.source}), (b:PyGoo {_id: row.target}) '
+                 'CREATE (a)-[:%s]->(b)')
+
+_REMOVE_EDGES = 'UNWIND {ids} AS id MATCH ()-[r]->() WHERE id(r) = id DELETE r'
+
+_DELETE_NODES = 'UNWIND {ids} AS id MATCH (n:PyGoo {_id: id}) OPTIONAL MATCH (n)-[r]-() DELETE r, n'
+
+_DELETE_ALL = 'MATCH (n:PyGoo) OPTIONAL MATCH (n)-[r]-() DELETE r, n'
+
+_GET_NODE = 'MATCH (n:PyGoo {_id: {id}}) RETURN labels(n), n'
+
+# label, properties, other labels
+_MERGE_NODE = ('MERGE (n:PyGoo:%s {%s}) ON CREATE SET n += {props}%s '
+               'RETURN n._id, labels(n), n')
+
+_GET_EDGES = 'MATCH (n:PyGoo {_id: {id}})-[r]->(m:PyGoo) RETURN type(r), id(r), m._id ORDER BY id(r)'
+
+_PREFETCH_EDGES = ('UNWIND {ids} AS id MATCH (n:PyGoo {_id: id})-[r]->(m:PyGoo) '
+                   'RETURN n._id, type(r), id(r), m._id ORDER BY id(r)')
+
+_PREFETCH_NODES = ('UNWIND {ids} AS id MATCH (n:PyGoo {_id: id})-[r]->(m:PyGoo) WHERE type(r) IN {names} '
+                   'RETURN DISTINCT m._id, labels(m), m')
+
+# labels, conditions
+_MATCH_NODES = ('MATCH (n:PyGoo%s) WHERE %sn._id > {after} '
+                'RETURN n._id, labels(n), n ORDER BY n._id LIMIT {limit}')
+
+
+def _labels(classes):
+    return ''.join(':' + quote(name) for name in sorted(cls.__name__ for cls in classes))
+
+def _props(literals, node_id):
+    result = dict((name, to_neo(value)) for name, value in literals)
+    result['_id'] = node_id
+    return result
+
+def _native_property(name):
+    """Return whether the values of the given property can be stored as is in Neo4j,
+    according to the schemas of all the classes in the ontology. Values stored as
+    pickles (eg: Language) can't be compared by the server, even though they might
+    compare equal to a native value."""
+    return all(cls.schema.get(name, unicode) in (unicode, int, float)
+               for cls in ontology._classes.values())
+
+
+class Neo4jObjectGraph(ObjectGraph):
+    """A Neo4jObjectGraph is an ObjectGraph where all data is persistent in a Neo4j
+    server, which is accessed through its Cypher HTTP endpoint (see pygoo.neo).
+
+    Modifications are recorded as pending changes (unit of work), and sent to the
+    server in a single request, which is executed in a single transaction:
+     - with sync = AUTO, the changes are sent as soon as they are made. Creating a
+       node or setting one of its properties (including links) is one request.
+     - with sync = MANUAL, the changes are only sent when calling synchronize().
+     - in both modes, the changes made in a 'with g.transaction():' block are sent
+       at the end of the block.
+
+    Reading a node or its edges takes the pending changes into account, without
+    sending them. Queries over the whole graph (iterating over nodes, finding
+    objects) send the pending changes first, so that the server sees them.
+
+    Node ids are reserved on the server by blocks of ID_BLOCK_SIZE, so that nodes
+    have their id as soon as they are created and new nodes can be linked to each
+    other in the same request.
+
+    Nodes are fetched from the server by batches of FETCH_SIZE when iterating over
+    them, and the last CACHE_SIZE node objects used are kept in a cache, so that
+    they don't need to be fetched again. Node objects are kept in a weak identity
+    map, so that a node never has more than one node object.
+
+    Queries are translated to Cypher as much as possible (see _candidate_nodes):
+    the class of the nodes, the equality filters on literals and on linked
+    objects and the limit are all done by the server. The objects linked to the
+    results of a query can be prefetched (see QuerySet.prefetch), in which case
+    they are loaded together with the relationships of the results in a single
+    request for each batch of results.
+
+    The literal unique properties of the classes of the ontology are indexed on
+    the server, and when unique_constraints is True, the classes with a single
+    unique literal property also get a uniqueness constraint on it (which makes
+    creating duplicate objects an error). find_or_create() is a single MERGE
+    query when it can be, which is atomic with a uniqueness constraint.
+
+    example:
+      g = Neo4jObjectGraph('http://localhost:7474/db/data/', sync = MANUAL)
+      for title in titles:
+          g.Series(title = title)
+      g.synchronize()
+
+      with g.transaction():
+          ep = g.Episode(series = g.find_one(Series, title = 'Monk'), season = 1)
+          ep.episodeNumber = 3
+    """
     _object_node_class = Neo4jObjectNode
 
-    def __init__(self, dbpath):
-        MemoryObjectGraph.__init__(self)
-        neo.open(dbpath)
+    def __init__(self, url = DEFAULT_URL, dynamic = False, sync = AUTO, unique_constraints = False):
+        super(Neo4jObjectGraph, self).__init__(dynamic)
+        if sync not in (AUTO, MANUAL):
+            raise ValueError('Invalid sync mode: %s' % sync)
+        self.sync = sync
+        self.unique_constraints = unique_constraints
+        self._client = CypherClient(url)
+        # used by the MemoryObjectNode methods
+        self._indexes = {}
+
+        # pending changes
+        self._new = collections.OrderedDict()
+        self._updated = collections.OrderedDict()
+        self._edge_changes = []
+        self._deleted = []
+        self._transactions = 0
+
+        self._free_ids = (0, 0)
+        self._min_id = 0
+
+        # identity map of all the node objects of this graph, by id, so that each
+        # node has only one node object
+        self._nodes = weakref.WeakValueDictionary()
+        # LRU cache of the most recently used node objects, which keeps them alive
+        self._cache = collections.OrderedDict()
+
+        # schema statements already sent
+        self._schema = set()
+        self._update_schema()
+
+    def close(self):
+        """Send the pending changes to the server and close the connection."""
+        self.synchronize()
+        self._client.close()
+
+    def _update_schema(self):
+        """Create the constraints and indexes for the unique properties of the classes
+        of the ontology which don't have them yet."""
+        statements = [ _CONSTRAINT % ('PyGoo', '_id') ]
+        for cls in sorted(ontology._classes.values(), key = lambda cls: cls.__name__):
+            props = [ prop for prop in sorted(cls.unique)
+                      if cls.schema.get(prop) in (unicode, int, float) and _native_property(prop) ]
+            if self.unique_constraints and len(cls.unique) == 1 and props:
+                statements.append(_CONSTRAINT % (quote(cls.__name__), quote(props[0])))
+            else:
+                statements += [ _INDEX % (quote(cls.__name__), quote(prop)) for prop in props ]
+
+        statements = [ s for s in statements if s not in self._schema ]
+        self._client.run([ (statement, {}) for statement in statements ])
+        self._schema.update(statements)
+
+    def revalidate_objects(self):
+        self._update_schema()
+        super(Neo4jObjectGraph, self).revalidate_objects()
+
+
+    ### Unit of work
+
+    @contextmanager
+    def transaction(self):
+        """Return a context manager which sends all the changes made in its block at
+        the end of it, in a single request. Transactions can be nested, only the
+        outermost one sends the changes.
+
+        If an exception is raised in the block, the changes are not sent, but are still
+        pending: they will be sent by the next synchronize()."""
+        self._transactions += 1
+        try:
+            yield self
+        finally:
+            self._transactions -= 1
+        if self._transactions == 0 and self.sync == AUTO:
+            self.synchronize()
+
+    def _mutated(self, node_id, mutation, *args):
+        # called by the MemoryObjectNode methods, the changes of the nodes are
+        # recorded by the Neo4jObjectNode methods instead
+        pass
+
+    def _changed(self):
+        if self._transactions == 0 and self.sync == AUTO:
+            self.synchronize()
+
+    def _modified(self, node):
+        if node._id not in self._new:
+            self._updated[node._id] = node
+        self._changed()
+
+    def _edge_changed(self, change, node, name, rel):
+        """Record the addition or removal of the given relationship (see
+        Neo4jObjectNode._relationships)."""
+        if change == 'remove' and rel[0] is None:
+            # the relationship has not been created on the server yet
+            for i, (_, _, _, pending) in enumerate(self._edge_changes):
+                if pending is rel:
+                    del self._edge_changes[i]
+                    break
+        else:
+            self._edge_changes.append((change, name, node._id, rel))
+        self._changed()
 
-    def close():
-        neo.close()
+    def has_pending_changes(self):
+        return bool(self._new or self._updated or self._edge_changes or self._deleted)
+
+    def _statements(self):
+        """Return the list of statements which apply the pending changes, and a dict
+        from the index of each statement which creates relationships to the list of
+        those relationships, in order."""
+        def props(node):
+            return _props(node._props.items(), node._id)
+
+        statements = []
+
+        # new nodes, grouped by classes as labels can't be given as parameters
+        created = collections.OrderedDict()
+        for node in self._new.values():
+            created.setdefault(_labels(node._classes), []).append({ 'props': props(node) })
+        for labels, rows in created.items():
+            statements.append((_CREATE_NODES % labels, { 'rows': rows }))
+
+        # modified nodes: literals are all written again, and labels changed if needed
+        if self._updated:
+            statements.append((_UPDATE_NODES, { 'rows': [ { 'id': node._id, 'props': props(node) }
+                                                          for node in self._updated.values() ] }))
+        added, removed = collections.OrderedDict(), collections.OrderedDict()
+        for node in self._updated.values():
+            for cls in node._classes - node._synced_classes:
+                added.setdefault(cls.__name__, []).append(node._id)
+            for cls in node._synced_classes - node._classes:
+                removed.setdefault(cls.__name__, []).append(node._id)
+        for name, ids in removed.items():
+            statements.append((_REMOVE_LABEL % quote(name), { 'ids': ids }))
+        for name, ids in added.items():
+            statements.append((_ADD_LABEL % quote(name), { 'ids': ids }))
+
+        # edges, in order, grouping consecutive additions of the same name and
+        # consecutive removals
+        created = {}
+        for change, name, node_id, rel in self._edge_changes:
+            last = statements[-1] if statements else (None, None)
+            if change == 'add':
+                row = { 'source': node_id, 'target': rel[1] }
+                if last[0] == _ADD_EDGES % quote(name):
+                    last[1]['rows'].append(row)
+                else:
+                    statements.append((_ADD_EDGES % quote(name), { 'rows': [ row ] }))
+                created.setdefault(len(statements) - 1, []).append(rel)
+            elif last[0] == _REMOVE_EDGES:
+                last[1]['ids'].append(rel[0])
+            else:
+                statements.append((_REMOVE_EDGES, { 'ids': [ rel[0] ] }))
+
+        if self._deleted:
+            statements.append((_DELETE_NODES, { 'ids': list(self._deleted) }))
+
+        return statements, created
+
+    def synchronize(self):
+        """Send all the pending changes to the server, in a single request.
+
+        :raises Neo4jError: If the changes could not be applied. None of them has
+                            been applied then, and they are still pending.
+        """
+        if not self.has_pending_changes():
+            return
+
+        statements, created = self._statements()
+        results = self._client.run(statements)
+        for i, rels in created.items():
+            for rel, (rel_id,) in zip(rels, results[i]):
+                rel[0] = rel_id
+
+        for node in self._new.values() + self._updated.values():
+            node._synced_classes = set(node._classes)
+            self._remember(node)
+        self._new.clear()
+        self._updated.clear()
+        self._edge_changes = []
+        self._deleted = []
+
+    def _query(self, query, **params):
+        """Send the pending changes, then execute the given query."""
+        self.synchronize()
+        return self._client.query(query, **params)
+
+
+    ### Node methods
+
+    def _reserve_ids(self, count):
+        """Reserve count consecutive node ids on the server, and return the first one."""
+        return self._client.query(_RESERVE_IDS, min = self._min_id, count = count)[0][0] - count
+
+    def _reserve_id(self):
+        start, end = self._free_ids
+        if start == end:
+            start = self._reserve_ids(ID_BLOCK_SIZE)
+            end = start + ID_BLOCK_SIZE
+        self._free_ids = (start + 1, end)
+        return start
+
+    def _add_node(self, node, node_id = None):
+        """Give an id to a newly created node, and record its creation."""
+        if node_id is None:
+            node_id = self._reserve_id()
+        else:
+            # make sure that the next reserved ids don't use this one
+            self._min_id = max(self._min_id, node_id + 1)
+            start, end = self._free_ids
+            if start <= node_id < end:
+                self._free_ids = (0, 0)
+        node._id = node_id
+        self._nodes[node_id] = node
+        self._new[node_id] = node
+        self._changed()
 
     def clear(self):
         """Delete all objects in this graph."""
-        MemoryObjectGraph.clear(self)
+        for node in self._nodes.values():
+            node.graph = None
+        self._nodes.clear()
+        self._cache.clear()
+        self._new.clear()
+        self._updated.clear()
+        self._edge_changes = []
+        self._deleted = []
+        self._client.query(_DELETE_ALL)
+
+    def create_node(self, props = [], _classes = set(), _id = None):
+        return self.__class__._object_node_class(self, props, _classes, _id)
+
+    def restore_node(self, node_id, props, _classes, trusted = False):
+        return self.create_node(props, _classes, _id = node_id)
+
+    def delete_node(self, node):
+        with self.transaction():
+            node.unlink_all()
+            if self._new.pop(node._id, None) is None:
+                self._updated.pop(node._id, None)
+                self._deleted.append(node._id)
+        self._nodes.pop(node._id, None)
+        self._cache.pop(node._id, None)
+        node.graph = None
+
+    def add_directed_edge(self, node, name, other_node):
+        node.add_directed_edge(name, other_node)
+
+    def remove_directed_edge(self, node, name, other_node):
+        node.remove_directed_edge(name, other_node)
+
+    def _remember(self, node):
+        """Put the given node in the cache, as its most recently used node."""
+        self._cache.pop(node._id, None)
+        self._cache[node._id] = node
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last = False)
+
+    def _load_node(self, node_id, labels, props):
+        """Return the node object for the given node as returned by the server. An
+        existing node object is at least as recent as the server data (its changes
+        are either pending or sent), and is used instead."""
+        node = self._nodes.get(node_id)
+        if node is None:
+            node = self.__class__._object_node_class.from_server(self, node_id, labels, props)
+            self._nodes[node_id] = node
+        self._remember(node)
+        return node
+
+    def get_node(self, node_id):
+        node = self._nodes.get(node_id)
+        if node is not None:
+            self._remember(node)
+            return node
+        rows = self._client.query(_GET_NODE, id = node_id) if node_id not in self._deleted else []
+        if not rows:
+            raise KeyError('No node with id %d in graph %s' % (node_id, self))
+        labels, props = rows[0]
+        return self._load_node(node_id, labels, props)
 
-        neo.delete_all_data()
+    def _relationships(self, node_id):
+        """Return the list of (name, relationship) outgoing relationships of the given
+        node, as stored on the server with the pending edge changes applied (see
+        Neo4jObjectNode._relationships)."""
+        rels = [] if node_id in self._new else [ (name, [ rel_id, other_id ]) for name, rel_id, other_id
+                                                 in self._client.query(_GET_EDGES, id = node_id) ]
+        for change, name, source, rel in self._edge_changes:
+            if source != node_id:
+                continue
+            if change == 'add':
+                rels.append((name, rel))
+            else:
+                rels = [ r for r in rels if r[1][0] != rel[0] ]
+        return rels
 
-    def __contains__(self, node):
+    def contains(self, node):
         """Return whether this graph contains the given node (identity)."""
-        # TODO: only works if correctly cached
-        return get_node(node) in self._nodes
+        return (isinstance(node, Neo4jObjectNode) and
+                self._nodes.get(node._id) is node)
 
+    def _scan(self, query, params, after = -1, limit = None):
+        """Return a generator over the (node id, node) pairs returned by the given
+        query, in increasing id order and starting after the given id. The query
+        needs to return the id, labels and node, and is run in batches of FETCH_SIZE
+        nodes, using its {after} and {limit} parameters. If limit is not None, at
+        most that many nodes are fetched."""
+        last, remaining = after, limit
+        while remaining is None or remaining > 0:
+            size = FETCH_SIZE if remaining is None else min(FETCH_SIZE, remaining)
+            rows = self._query(query, after = last, limit = size, **params)
+            for node_id, labels, props in rows:
+                yield node_id, self._load_node(node_id, labels, props)
+            if len(rows) < size:
+                return
+            last = rows[-1][0]
+            if remaining is not None:
+                remaining -= size
+
+    def scan_nodes(self, after = None):
+        after = after if after is not None else -1
+        return self._scan(_MATCH_NODES % ('', ''), {}, after)
 
     def nodes(self):
-        for n in all_nodes():
-            yield Neo4jObjectNode(neonode = n)
+        for _, node in self.scan_nodes():
+            yield node
 
+    def nodes_from_class(self, cls):
+        return self._candidate_nodes(cls, {})[0]
 
-    def remove_directed_edge(self, node, name, other_node):
-        MemoryObjectGraph.remove_directed_edge(self, node, name, other_node)
+    def import_graph(self, graph):
+        """Add all the nodes and edges of the given graph (usually a MemoryObjectGraph)
+        to this graph, and return a dict from their node id in the given graph to the
+        node id of the new nodes.
 
-        for r in node._neonode.relationships():
-            if r.end == other_node and r.type == name:
-                r.delete()
-                # return early, which means if we had the same link multiple times,
-                # we only remove one of them. This could be used for doing ref-counting if necessary
-                return
+        Nodes and then edges are streamed to the server in batches of IMPORT_BATCH_SIZE,
+        each of them being sent in a single request. Each batch is a separate
+        transaction, so a failed import might leave some of the nodes on the server.
 
-    def add_directed_edge(self, node, name, other_node):
-        MemoryObjectGraph.add_directed_edge(self, node, name, other_node)
+        example:
+          g = Neo4jObjectGraph('http://localhost:7474/db/data/')
+          g.import_graph(library)
+        """
+        self.synchronize()
+
+        ids = {}
+        start = self._reserve_ids(sum(1 for _ in graph.scan_nodes()))
+
+        def send(batch):
+            self._client.run([ (query, { 'rows': rows }) for query, rows in batch.items() ])
+            batch.clear()
+
+        # nodes, grouped by classes in each batch
+        batch, size = collections.OrderedDict(), 0
+        for i, (node_id, node) in enumerate(graph.scan_nodes()):
+            ids[node_id] = start + i
+            batch.setdefault(_CREATE_NODES % _labels(node.classes()), []).append(
+                { 'props': _props(node.literal_items(), start + i) })
+            size += 1
+            if size == IMPORT_BATCH_SIZE:
+                send(batch)
+                size = 0
+        send(batch)
+        size = 0
+
+        # edges, grouped by name in each batch
+        for node_id, node in graph.scan_nodes():
+            for name, others in node.edge_items():
+                for other in others:
+                    batch.setdefault(_IMPORT_EDGES % quote(name), []).append(
+                        { 'source': ids[node_id], 'target': ids[other.node_id()] })
+                    size += 1
+                    if size == IMPORT_BATCH_SIZE:
+                        send(batch)
+                        size = 0
+        send(batch)
+
+        return ids
+
+
+    ### Query methods
+
+    def _filter_condition(self, param, prop, value):
+        """Return a tuple (condition, value, exact) for the given filter, where value
+        is the value of the {param} parameter used in the Cypher condition, or None if
+        the filter can't be expressed in Cypher. exact is False when the condition might
+        also match some nodes which don't match the filter (chained filters which
+        follow a link that points to multiple nodes), in which case it still needs
+        to be checked on the resulting nodes."""
+        if isinstance(value, BaseObject):
+            value = value.node
+
+        path, exact = prop.split('_'), '_' not in prop
+        if isinstance(value, Neo4jObjectNode):
+            if not self.contains(value):
+                return None
+            value = value._id
+            target = '(:PyGoo {_id: {%s}})' % param
+        elif is_native(value):
+            if not _native_property(path[-1]):
+                return None
+            if exact:
+                return 'n.%s = {%s}' % (quote(prop), param), value, True
+            target = '({%s: {%s}})' % (quote(path.pop()), param)
+        else:
+            return None
+
+        hops = [ '-[:%s]->' % quote(name) for name in path ]
+        return '(n)' + '()'.join(hops) + target, value, exact
+
+    def _candidate_nodes(self, node_type, filters, limit = None):
+        """Translate the class of the nodes, the equality filters on literals and linked
+        objects and the limit into a Cypher query. Only the filters that couldn't be
+        translated exactly are returned as remaining filters."""
+        filters = dict(filters)
+
+        labels, conditions, params = '', [], {}
+        if isinstance(node_type, tuple):
+            conditions.append('(%s)' % ' OR '.join('n:%s' % quote(cls.__name__) for cls in node_type))
+        elif node_type is not None:
+            labels = ':' + quote(node_type.__name__)
+
+        for i, (prop, value) in enumerate(sorted(filters.items())):
+            param = 'p%d' % i
+            condition = self._filter_condition(param, prop, value)
+            if condition is None:
+                continue
+            condition, params[param], exact = condition
+            conditions.append(condition)
+            if exact:
+                del filters[prop]
+
+        query = _MATCH_NODES % (labels, ''.join(c + ' AND ' for c in conditions))
+        nodes = (node for _, node in self._scan(query, params, limit = limit if not filters else None))
+        return nodes, filters
+
+    def _prefetch(self, nodes, names):
+        """Load in a single request the relationships of the given nodes which are not
+        cached yet, and the nodes pointed to by their relationships with one of the
+        given names."""
+        self.synchronize()
+        missing = [ node for node in nodes if node._rels is None ]
+        statements = []
+        if missing:
+            statements.append((_PREFETCH_EDGES, { 'ids': [ node._id for node in missing ] }))
+        if names:
+            statements.append((_PREFETCH_NODES, { 'ids': [ node._id for node in nodes ],
+                                                  'names': list(names) }))
+        results = self._client.run(statements)
+
+        if missing:
+            rels = dict((node._id, collections.OrderedDict()) for node in missing)
+            for node_id, name, rel_id, other_id in results.pop(0):
+                rels[node_id].setdefault(name, []).append([ rel_id, other_id ])
+            for node in missing:
+                node._rels = rels[node._id]
+
+        if names:
+            for node_id, labels, props in results[0]:
+                self._load_node(node_id, labels, props)
+
+    def find_node(self, node, cmp = Equal.OnIdentity, exclude_properties = list()):
+        """Look for nodes with the same unique properties with a Cypher query on their
+        literal unique properties (see ObjectGraph.find_node)."""
+        if cmp != Equal.OnUnique:
+            return super(Neo4jObjectGraph, self).find_node(node, cmp, exclude_properties)
+
+        props = list(set(node.virtual().unique_properties()) - set(exclude_properties))
+        # NB: properties with a '_' would be understood as chained properties
+        filters = dict((prop, node.get(prop)) for prop in props
+                       if prop in node.literal_keys() and '_' not in prop)
+        for n in self._candidate_nodes(node.virtual_class(), filters)[0]:
+            if node.same_properties(n, props, cmp = Equal.OnUnique):
+                log.debug('%s already in graph %s (unique)...' % (n, self))
+                return n
+
+    def find_or_create(self, node_type, **kwargs):
+        """Find or create the object with a single MERGE query, if all the given
+        properties are literals stored natively, and are enough to make the object
+        valid. Otherwise, this is the same as ObjectGraph.find_or_create.
+
+        The MERGE query is sent immediately, even with sync = MANUAL."""
+        if not (set(node_type.valid) <= set(kwargs) and
+                all(is_native(value) and _native_property(prop) and '_' not in prop
+                    for prop, value in kwargs.items())):
+            return super(Neo4jObjectGraph, self).find_or_create(node_type, **kwargs)
+
+        keys = ', '.join('%s: {p%d}' % (quote(prop), i) for i, prop in enumerate(sorted(kwargs)))
+        params = dict(('p%d' % i, kwargs[prop]) for i, prop in enumerate(sorted(kwargs)))
+        others = [ cls for cls in ontology.parent_classes(node_type) if cls is not node_type ]
 
-        setattr(node._neonode, name, other_node._neonode)
+        self.synchronize()
+        node_id = self._reserve_id()
+        params['props'] = _props(kwargs.items(), node_id)
+        query = _MERGE_NODE % (quote(node_type.__name__), keys,
+                               ', n' + _labels(others) if others else '')
+        node_id, labels, props = self._client.query(query, **params)[0]
+        return node_type(self._load_node(node_id, labels, props))
@@ -18,86 +18,171 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from __future__ import with_statement
 from pygoo.memoryobjectnode import MemoryObjectNode
 from pygoo.objectnode import ObjectNode
-from pygoo.utils import toresult
-import neo
+from pygoo.neo import from_neo
+from pygoo import ontology
+import collections
+import weakref
 import logging
 
 log = logging.getLogger(__name__)
 
 
-# SYNC can take 2 values:
-# - AUTO: automatically synchronize changes with the underlying store as they are modified
-# - MANUAL: only flush data to store when the synchronize() method is called
-#
-# when SYNC == 'AUTO', there is another option to get rid of the calls to the caching MemoryObjectNode (ie: pure database-based)
-
-
 class Neo4jObjectNode(MemoryObjectNode):
-    """This is a proxy class for the neo4j instances.
-    It derives from the MemoryObjectNode, which serves as a cache.
-    This only loads the nodes needed from the DB when it needs them."""
-
-    def __init__(self, graph, props = [], neonode = None):
-        if neonode is not None:
-            self._neonode = neonode
-            return
-
-        literal = {}
-        links = []
-        for prop, value, reverse_name in props:
-            if isinstance(value, ObjectNode):
-                links.append((prop, value, reverse_name))
-            else:
-                literal[prop] = value
-
-        print 'starting transaction'
-        with neo.transaction:
-            self._neonode = neo.graph.node(**literal)
-            print 'node created'
-            self._neonode._ingraph(neo.graph.reference_node) # as a way to get them all
-            print 'setting links'
-            for link in links:
-                self.setLink(*link)
-            print 'setting links ok'
-        print 'transaction ok'
-
-        #MemoryObjectNode.__init__(self, graph, props)
-
+    """This is a proxy class for the nodes stored in a Neo4j server (see Neo4jObjectGraph).
+
+    It derives from the MemoryObjectNode, which serves as a cache for the literals
+    and the classes of the node: they are read from the server when the node is
+    loaded, and all their modifications go through the node itself. The outgoing
+    relationships of the node are read from the server the first time its edges
+    are accessed, and kept in a cache which is updated by the edge modifications.
+
+    Modifications are not sent to the server directly, but recorded by the graph
+    as pending changes, which are all sent at once when the graph is synchronized
+    (see Neo4jObjectGraph.synchronize).
+    """
+
+    def __init__(self, graph, props = [], _classes = None, _id = None):
+        # NB: we don't call MemoryObjectNode.__init__, as the node needs to have
+        #     an id before its properties are set
+        self._props = {}
+        self._classes = set(_classes) if _classes is not None else set()
+        # classes as they are stored on the server, None for a node which hasn't
+        # been created there yet
+        self._synced_classes = None
+        self._rels = collections.OrderedDict()
+        with graph.transaction():
+            graph._add_node(self, _id)
+            ObjectNode.__init__(self, graph, props)
+
+    @classmethod
+    def from_server(cls, graph, node_id, labels, props):
+        """Return the node object for a node which already exists on the server, given
+        its labels and properties."""
+        node = cls.__new__(cls)
+        object.__setattr__(node, 'graph', weakref.ref(graph))
+        node._id = node_id
+        node._props = dict((name, from_neo(value)) for name, value in props.items() if name != '_id')
+        node._classes = set(ontology._classes[label] for label in labels if label in ontology._classes)
+        node._synced_classes = set(node._classes)
+        node._rels = None
+        return node
 
     def __eq__(self, other):
-        return self._neonode == other._neonode
+        return (isinstance(other, Neo4jObjectNode) and
+                self._id == other._id and
+                self.graph() is other.graph())
 
     def __hash__(self):
-        # TODO: verify me
-        return id(self)
-
-    ### Acessing properties methods
-
+        return hash(self._id)
 
     def __setattr__(self, name, value):
-        if name == '_neonode':
+        if name in ('_synced_classes', '_rels'):
             object.__setattr__(self, name, value)
         else:
-            MemoryObjectNode.__setattr__(self, name, value)
+            super(Neo4jObjectNode, self).__setattr__(name, value)
+
+    def set(self, name, value, reverse_name = None, validate = True):
+        # setting a link modifies the edges of both nodes, send them together
+        with self.graph().transaction():
+            super(Neo4jObjectNode, self).set(name, value, reverse_name, validate)
+
+
+    ### Ontology methods
+
+    def add_class(self, cls):
+        super(Neo4jObjectNode, self).add_class(cls)
+        self.graph()._modified(self)
+
+    def remove_class(self, cls):
+        super(Neo4jObjectNode, self).remove_class(cls)
+        self.graph()._modified(self)
 
-    def get_link(self, name):
-        log.debug('getlink:', name)
-        return toresult([ r.end for r in self._neonode.relationships() if r.type == name ])
+    def clear_classes(self):
+        super(Neo4jObjectNode, self).clear_classes()
+        self.graph()._modified(self)
 
-    def get_literal(self, name):
-        log.debug('getliteral:', name)
-        result = self._neonode[name]
-        if isinstance(result, basestring):
-            return result
+    def update_valid_classes(self):
+        classes = set(self._classes)
+        super(Neo4jObjectNode, self).update_valid_classes()
+        if self._classes != classes:
+            self.graph()._modified(self)
 
-        return result.value # fix in neo4j.py
+
+    ### Accessing literal properties
 
     def set_literal(self, name, value):
-        MemoryObjectNode.set_literal(self, name, value) # keep in cache
-        with neo.transaction:
-            self._neonode[name] = value
+        super(Neo4jObjectNode, self).set_literal(name, value)
+        self.graph()._modified(self)
+
+    def del_literal(self, name):
+        super(Neo4jObjectNode, self).del_literal(name)
+        self.graph()._modified(self)
+
+
+    ### Accessing edge properties
+
+    def _relationships(self):
+        """Return the cache of the outgoing relationships of this node, which is an
+        ordered dict of edge name to the list of its relationships, each of them being
+        a [relationship id, pointed node id] list. The relationship id is None until
+        the relationship has been created on the server."""
+        if self._rels is None:
+            self._rels = collections.OrderedDict()
+            for name, rel in self.graph()._relationships(self._id):
+                self._rels.setdefault(name, []).append(rel)
+        return self._rels
+
+    def add_directed_edge(self, name, other_node):
+        rel = [ None, other_node._id ]
+        self._relationships().setdefault(name, []).append(rel)
+        self.graph()._edge_changed('add', self, name, rel)
+
+    def remove_directed_edge(self, name, other_node):
+        rels = self._relationships().get(name, [])
+        for i, rel in enumerate(rels):
+            if rel[1] == other_node._id:
+                break
+        else:
+            raise ValueError('No edge %s from %s to %s' % (name, self, other_node))
+        del rels[i]
+        if not rels:
+            del self._rels[name]
+        self.graph()._edge_changed('remove', self, name, rel)
+
+    def _endpoints(self, node_ids):
+        get_node = self.graph().get_node
+        for node_id in node_ids:
+            yield get_node(node_id)
+
+    def _edge_ids(self, name):
+        return [ other_id for _, other_id in self._relationships().get(name, []) ]
+
+    def outgoing_edge_endpoints(self, name = None):
+        if name is None:
+            return self._endpoints([ other_id for rels in self._relationships().values()
+                                              for _, other_id in rels ])
+        if name in self._props:
+            raise AttributeError(name)
+        return self._endpoints(self._edge_ids(name))
+
+    def edge_keys(self):
+        return iter(self._relationships().keys())
+
+    def edge_values(self):
+        return (self._endpoints(self._edge_ids(k)) for k in self._relationships().keys())
+
+    def edge_items(self):
+        return ((k, self._endpoints(self._edge_ids(k))) for k in self._relationships().keys())
+
+
+    # The next methods are overriden for efficiency, see MemoryObjectNode
+
+    def keys(self):
+        return self._props.keys() + self._relationships().keys()
 
-    #def update(self, props):
+    def get(self, name, default=None):
+        if name in self._props:
+            return self._props[name]
+        return self._endpoints(self._edge_ids(name))
@@ -21,7 +21,8 @@
 from pygoo.abstractdirectedgraph import AbstractDirectedGraph, Equal
 from pygoo.objectnode import ObjectNode
 from pygoo.baseobject import BaseObject, get_node
-from pygoo.utils import reverse_lookup
+from pygoo.queryset import QuerySet, match_filters
+from pygoo.utils import reverse_lookup, is_literal
 from pygoo import ontology
 import collections
 import logging
@@ -41,6 +42,22 @@ def unwrap_node(node):
 
     return node, node_class
 
+def check_query_options(node_type, **options):
+    """Raise a ValueError if one of the given query options is also the name of a
+    property of node_type, as it would then be ambiguous whether it is meant as an
+    option or as a filter on that property. Options which are None are ignored."""
+    if isinstance(node_type, basestring):
+        node_type = ontology.get_class(node_type)
+    classes = node_type if isinstance(node_type, tuple) else (node_type,)
+
+    for name, value in options.items():
+        if value is None:
+            continue
+        for cls in classes:
+            if cls is not None and name in cls.schema:
+                raise ValueError("'%s' is both a query option and a property of %s: use query() "
+                                 "and the QuerySet methods instead" % (name, cls.__name__))
+
 
 
 class ObjectGraph(AbstractDirectedGraph):
@@ -274,7 +291,8 @@ class ObjectGraph(AbstractDirectedGraph):
             raise NotImplementedError
 
 
-    def find_all(self, node_type = None, valid_node = lambda x: True, **kwargs):
+    def find_all(self, node_type = None, valid_node = None, order_by = None, limit = None,
+                 prefetch = None, **kwargs):
         """This method returns a list of the objects of the given type in this graph for which
         the cond function returns True (or sth that evaluates to True).
         It will also only keep those objects that have properties which match the given keyword
@@ -290,71 +308,186 @@ class ObjectGraph(AbstractDirectedGraph):
 
         If no match is found, it returns an empty list.
 
+        The results can be ordered by giving a field or list of fields to order_by (prefix
+        them with '-' for decreasing order), and their number limited with limit. See
+        QuerySet.order_by for more details.
+
+        The objects pointed to by the links given in prefetch are loaded for all the
+        results at once, instead of one by one when they are accessed (see
+        QuerySet.prefetch).
+
+        If you don't need all the results at once, use query() instead, which returns a lazy
+        QuerySet. This is also the way to filter on properties called order_by, limit or
+        prefetch, as using them as options here raises a ValueError.
+
         examples:
           g.find_all(node_type = Movie)
           g.find_all(Episode, lambda x: x.season = 2)
           g.find_all(Movie, lambda m: m.releaseYear > 2000)
           g.find_all(Person, role_movie_title = 'The Dark Knight')
           g.find_all(Character, isCharacterOf_movie_title = 'Fear and loathing.*', regexp = True)
+          g.find_all(Comment, order_by = '-date', limit = 20)
+          g.find_all(Episode, prefetch = [ 'series', 'files' ])
         """
-        return list(self._find_all(node_type, valid_node, **kwargs))
+        check_query_options(node_type, order_by = order_by, limit = limit, prefetch = prefetch)
+
+        query = self.query(node_type, valid_node, **kwargs)
+        if order_by is not None:
+            if isinstance(order_by, basestring):
+                order_by = [ order_by ]
+            query = query.order_by(*order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        if prefetch is not None:
+            if isinstance(prefetch, basestring):
+                prefetch = [ prefetch ]
+            query = query.prefetch(*prefetch)
 
+        return list(query)
 
-    def _find_all(self, node_type = None, valid_node = lambda x: True, **kwargs):
+
+    def _find_all(self, node_type = None, valid_node = None, **kwargs):
         """Implementation of findAll that returns a generator."""
+        return iter(self.query(node_type, valid_node, **kwargs))
+
+
+    def query(self, node_type = None, valid_node = None, **kwargs):
+        """Return a lazy QuerySet over the objects of the given type in this graph which
+        match the given valid_node function and keyword args (see find_all).
+
+        examples:
+          g.query(Episode, series_title = 'Monk').count()
+          g.query(Movie, lambda m: m.year > 2000).exists()
+          g.query(Episode).filter(season = 2).offset(20).limit(20)
+        """
+        return QuerySet(self, node_type, valid_node, kwargs)
+
+
+    def values(self, node_type, *fields, **kwargs):
+        """Return a generator over tuples containing the values of the given fields for
+        the objects of the given type which match the keyword args (see find_all).
+
+        This doesn't need to create a BaseObject for each result, and is thus much faster
+        than find_all when you only need a few fields from each object.
+
+        example:
+          g.values(Episode, 'season', 'episodeNumber', 'series.title', series_title = 'Monk')
+        """
+        return self.query(node_type, **kwargs).values(*fields)
+
+
+    def aggregate(self, node_type = None, group_by = None, count = None, **kwargs):
+        """Compute aggregated values for the objects of the given type in a single pass
+        over the graph. The sum, min, max and avg keyword args define the aggregated
+        values, and the other keyword args are used as filters (see find_all).
+
+        See QuerySet.aggregate for a complete description of the arguments and result.
+        To filter on properties called group_by, count, sum, min, max or avg, use
+        query().filter().aggregate() instead, as they raise a ValueError here.
+
+        example:
+          g.aggregate(Episode, group_by = 'series', count = True, max = 'season')
+        """
+        aggregates = dict((func, kwargs.pop(func)) for func in ('sum', 'min', 'max', 'avg')
+                          if func in kwargs)
+        check_query_options(node_type, group_by = group_by, count = count, **aggregates)
+
+        return self.query(node_type, **kwargs).aggregate(group_by, bool(count), **aggregates)
+
+
+    def scan(self, node_type = None, after = None, batch = 1000, **kwargs):
+        """Return a batch of at most batch objects of the given type matching the given
+        keyword args (see find_all), in increasing order of node id, and starting after
+        the given cursor.
+
+        This returns a tuple (objects, cursor), where cursor should be given as the after
+        argument to get the next batch, or is None if there are no more objects. As node
+        ids are stable, this allows to resume long-running scans without having to start
+        over, even if the graph has been modified in the meantime.
+
+        example:
+          cursor = None
+          while True:
+              episodes, cursor = g.scan(Episode, after = cursor, batch = 1000)
+              process(episodes)
+              if cursor is None:
+                  break
+        """
         if isinstance(node_type, basestring):
             node_type = ontology.get_class(node_type)
 
+        result = []
+        for node_id, node in self.scan_nodes(after):
+            if node_type is not None and not node.isinstance(node_type):
+                continue
+            if kwargs and not match_filters(node, kwargs):
+                continue
+
+            result.append(wrap_node(node, node_type) if node_type is not None else node)
+            if len(result) == batch:
+                return result, node_id
+
+        return result, None
+
+
+    def index(self, prop):
+        """Return the index for the given literal property, or None if there is none."""
+        return None
+
+    def _candidate_nodes(self, node_type, filters, limit = None):
+        """Return a tuple (nodes, remaining_filters) where nodes is an iterable over
+        the nodes of the given type that might match the given filters, and
+        remaining_filters is the dict of filters that still need to be checked
+        on each of them.
+
+        If limit is not None, at most that many matching nodes will be used, which
+        backends can use to fetch fewer nodes when there are no remaining filters.
+
+        Backends should override this to push as much of a query as possible to
+        their storage. This implementation uses an index on one of the literal
+        equality filters if it can find one, or falls back on a class scan."""
+        filters = dict(filters)
+
+        for prop, value in filters.items():
+            # chained properties and None values can't be answered by an index
+            if '_' in prop or value is None or not is_literal(value):
+                continue
+
+            index = self.index(prop)
+            if index is None:
+                continue
+
+            del filters[prop]
+            nodes = list(index.lookup(value))
+            if isinstance(node_type, tuple):
+                nodes = [ n for n in nodes if any(n.isinstance(cls) for cls in node_type) ]
+            elif node_type is not None:
+                nodes = [ n for n in nodes if n.isinstance(node_type) ]
+
+            return nodes, filters
+
         if node_type is None:
             nodes = self.nodes()
-        elif issubclass(node_type, BaseObject):
-            nodes = self.nodes_from_class(node_type)
         elif isinstance(node_type, tuple):
-            nodes = set(set(self.nodes_from_class(cls)) for cls in node_type)
+            nodes = (n for n in self.nodes() if any(n.isinstance(cls) for cls in node_type))
         else:
-            raise TypeError('ObjectGraph.find_node: Invalid node type: %s' % node_type)
-
-        for node in nodes:
-            # TODO: should this go before or after the properties checking? Which is faster in general?
-            try:
-                if not valid_node(node):
-                    continue
-            except Exception, e:
-                log.warning('valid_node returned an exception: %s' % e)
-                continue
+            nodes = self.nodes_from_class(node_type)
 
-            valid = True
-            for prop, value in kwargs.items():
-                try:
-                    # FIXME: this doesn't work with lists of objects
-                    if isinstance(value, BaseObject):
-                        value = value.node
-
-                    if node.get_chained_properties(prop.split('_')) != value:
-                        valid = False
-                        break
-                except AttributeError:
-                    valid = False
-                    break
-
-            if not valid:
-                continue
+        return nodes, filters
 
-            if node_type is None:
-                yield node
-            else:
-                if isinstance(node_type, tuple):
-                    for cls in node_type:
-                        if node.isinstance(cls):
-                            yield cls(node)
-                            break
-                    else:
-                        raise TypeError('ObjectGraph._find_all: asked for nodes of type %s but found this one: %s' % (node_type, node))
-                else:
-                    yield node_type(node)
-
-
-    def find_one(self, node_type = None, valid_node = lambda x: True, **kwargs):
+
+    def _prefetch(self, nodes, names):
+        """Load the nodes pointed to by the edges with the given names of the given
+        nodes, so that accessing them later doesn't need to access the storage of the
+        graph (see QuerySet.prefetch).
+
+        This does nothing, as nodes are either in memory or cheap to load. Backends
+        which store their nodes on a server should override this to load them with as
+        few requests as possible."""
+        pass
+
+
+    def find_one(self, node_type = None, valid_node = None, **kwargs):
         """Returns a single result. see find_all for description.
         Raises an exception if no result was found."""
         # NB: as _findAll is a generator, this should be fairly optimized
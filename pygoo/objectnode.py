@@ -238,16 +238,19 @@ class ObjectNode(AbstractNode):
         """Given a list of successive chained properties, returns the final value.
         e.g.: Movie('2001').get_chained_properties([ 'director', 'firstName' ]) == 'Stanley'
 
+        If one of the intermediate properties is a link to other nodes, the first of
+        them is followed (which is what you want for *-to-one relations). If the last
+        property is a link, an iterator over the pointed nodes is returned.
+
         In case some property does not exist, it will raise an AttributeError.
         """
         # FIXME: replace with follow()
         result = self
         for prop in prop_list:
-            result = result.get(prop)
             if isinstance(result, collections.Iterator):
-                # FIXME: this will fail if it branches before the last property
-                #result = toresult(list(result))
-                pass
+                # FIXME: we only follow the first branch here
+                result = next(result, None)
+            result = result.get(prop)
 
         return result
 
@@ -21,6 +21,7 @@
 from __future__ import unicode_literals
 from pygoo import unicode_text_type, base_text_type
 import weakref
+import hashlib
 import logging
 import sys
 
@@ -139,6 +140,32 @@ def parent_classes(cls):
     return (c for c in _classes.values() if issubclass(cls, c))
 
 
+def fingerprint():
+    """Return a hash of the current ontology, which changes whenever a class is added
+    or removed, or when the schema, relations, reverse lookups or valid and unique
+    properties of one of them change.
+
+    This is stored in snapshots, so that a graph saved with the same ontology can
+    be loaded without revalidating its nodes (see pygoo.snapshot.read_snapshot)."""
+    def type_name(ctype):
+        if isinstance(ctype, (list, set)):
+            return '%s(%s)' % (type(ctype).__name__, type_name(next(iter(ctype))))
+        return getattr(ctype, '__name__', unicode(ctype))
+
+    desc = [ 'literals: %s' % ', '.join(t.__name__ for t in validLiteralTypes) ]
+    for name, cls in sorted(_classes.items()):
+        parent = cls.parent_class().__name__ if name != 'BaseObject' else ''
+        desc.append('class %s(%s)' % (name, parent))
+        for prop, ctype in sorted(cls.schema.items()):
+            desc.append('  %s: %s%s relation=%s reverse=%s' % (prop, type_name(ctype),
+                                                              ' implicit' if prop in cls.schema._implicit else '',
+                                                              cls.schema._relations.get(prop),
+                                                              type_name(cls.reverse_lookup.get(prop))))
+        desc.append('  valid: %s' % ', '.join(sorted(cls.valid)))
+        desc.append('  unique: %s' % ', '.join(sorted(cls.unique)))
+
+    return hashlib.sha1('\n'.join(desc).encode('utf-8')).hexdigest().decode('ascii')
+
 
 def validate_class_definition(cls, attrs):
     """Validate that the class definition is correct and doesn't introduce any
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pygoo.abstractnode import AbstractNode
+from pygoo.baseobject import BaseObject
+from pygoo import ontology
+import collections
+import itertools
+import heapq
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# number of results for which the links are prefetched at once (see QuerySet.prefetch)
+PREFETCH_BATCH_SIZE = 1000
+
+def match_filters(node, filters):
+    """Return whether the given node has properties which match all the given
+    keyword filters (see ObjectGraph.find_all for a description of those)."""
+    for prop, value in filters.items():
+        try:
+            # FIXME: this doesn't work with lists of objects
+            if isinstance(value, BaseObject):
+                value = value.node
+
+            result = node.get_chained_properties(prop.split('_'))
+            if isinstance(result, collections.Iterator):
+                if value not in result:
+                    return False
+            elif result != value:
+                return False
+        except AttributeError:
+            return False
+
+    return True
+
+
+def get_field(node, path):
+    """Return the value found by following the given list of properties from
+    node, or None if it can't be reached. If the last property is a link, the
+    first node it points to is returned."""
+    try:
+        result = node.get_chained_properties(path)
+    except AttributeError:
+        return None
+
+    if isinstance(result, collections.Iterator):
+        return next(result, None)
+    return result
+
+
+_aggregate_functions = set([ 'sum', 'min', 'max', 'avg' ])
+
+def _aggregate_state(fields):
+    # state is [ count, value of field 1, value of field 2, ... ]
+    # with value being a (total, n) pair for avg
+    return [ 0 ] + [ (0, 0) if func == 'avg' else None for _, func, _ in fields ]
+
+def _aggregate_update(state, node, fields):
+    state[0] += 1
+    for i, (_, func, path) in enumerate(fields, 1):
+        value = get_field(node, path)
+        if value is None:
+            continue
+
+        current = state[i]
+        if func == 'avg':
+            state[i] = (current[0] + value, current[1] + 1)
+        elif current is None:
+            state[i] = value
+        elif func == 'sum':
+            state[i] = current + value
+        elif func == 'min':
+            if value < current:
+                state[i] = value
+        elif func == 'max':
+            if value > current:
+                state[i] = value
+
+def _aggregate_result(state, count, fields):
+    if state is None:
+        state = _aggregate_state(fields)
+
+    result = {}
+    if count:
+        result['count'] = state[0]
+    for i, (name, func, _) in enumerate(fields, 1):
+        value = state[i]
+        if func == 'avg':
+            value = float(value[0]) / value[1] if value[1] else None
+        result[name] = value
+    return result
+
+
+class _Reversed(object):
+    """Wrapper around a value that reverses its ordering, used for sorting fields
+    in decreasing order while still sorting on other fields in increasing order."""
+    __slots__ = [ 'value' ]
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __le__(self, other):
+        return self.value >= other.value
+
+    def __ge__(self, other):
+        return self.value <= other.value
+
+
+class QuerySet(object):
+    """A QuerySet is a lazy, chainable query over the objects of an ObjectGraph.
+
+    Nothing is evaluated when building a QuerySet: the graph is only traversed
+    when iterating over it or when calling one of count(), exists() or first(),
+    and iteration stops as soon as enough results have been found.
+
+    Each chaining method returns a new QuerySet and leaves the original one
+    untouched, so that they can be safely reused.
+
+    examples:
+      g.query(Episode, season = 2).count()
+      g.query(Episode).filter(series_title = 'Monk').limit(20)
+      g.query(Movie, lambda m: m.year > 2000).first()
+    """
+
+    def __init__(self, graph, node_type = None, valid_node = None, filters = None):
+        if isinstance(node_type, basestring):
+            node_type = ontology.get_class(node_type)
+
+        if not (node_type is None or
+                isinstance(node_type, tuple) or
+                issubclass(node_type, BaseObject)):
+            raise TypeError('QuerySet: Invalid node type: %s' % node_type)
+
+        self._graph = graph
+        self._node_type = node_type
+        self._valid_nodes = [ valid_node ] if valid_node is not None else []
+        self._filters = dict(filters or {})
+        self._offset = 0
+        self._limit = None
+        self._order_by = []
+        self._prefetch = []
+
+    def _clone(self):
+        result = QuerySet.__new__(QuerySet)
+        result.__dict__.update(self.__dict__)
+        result._valid_nodes = list(self._valid_nodes)
+        result._filters = dict(self._filters)
+        result._order_by = list(self._order_by)
+        result._prefetch = list(self._prefetch)
+        return result
+
+    def __repr__(self):
+        node_type = self._node_type
+        if isinstance(node_type, tuple):
+            node_type = '(%s)' % ', '.join(cls.__name__ for cls in node_type)
+        elif node_type is not None:
+            node_type = node_type.__name__
+        return '<QuerySet: %s, filters = %s, offset = %d, limit = %s>' % (node_type, self._filters,
+                                                                        self._offset, self._limit)
+
+
+    ### Chaining methods
+
+    def filter(self, valid_node = None, **kwargs):
+        """Return a new QuerySet which only keeps the objects that also match the
+        given valid_node function and keyword args (same as for find_all)."""
+        if self._offset or self._limit is not None:
+            raise TypeError('Cannot filter a query once a limit or an offset has been applied')
+
+        result = self._clone()
+        if valid_node is not None:
+            result._valid_nodes.append(valid_node)
+        result._filters.update(kwargs)
+        return result
+
+    def order_by(self, *fields):
+        """Return a new QuerySet which returns its results ordered by the given fields.
+
+        Fields can follow links using '.', and are sorted in decreasing order when
+        prefixed with '-'. Results for which a field is missing come last.
+
+        When a limit is given, the results are selected using a heap of that size
+        instead of sorting all of them, and if the QuerySet is ordered on a single
+        property with a sorted index, the index is walked directly so that only
+        the returned results need to be looked at.
+
+        example:
+          g.query(Comment).order_by('-date', 'author.name').limit(20)
+        """
+        if self._offset or self._limit is not None:
+            raise TypeError('Cannot reorder a query once a limit or an offset has been applied')
+
+        result = self._clone()
+        result._order_by = [ (field[1:].split('.'), True) if field.startswith('-')
+                             else (field.split('.'), False)
+                             for field in fields ]
+        return result
+
+    def offset(self, n):
+        """Return a new QuerySet which skips the first n results."""
+        result = self._clone()
+        result._offset += n
+        if result._limit is not None:
+            result._limit = max(result._limit - n, 0)
+        return result
+
+    def limit(self, n):
+        """Return a new QuerySet which returns at most n results."""
+        result = self._clone()
+        result._limit = n if result._limit is None else min(result._limit, n)
+        return result
+
+    def prefetch(self, *names):
+        """Return a new QuerySet which loads the objects pointed to by the given links
+        of its results by batches of PREFETCH_BATCH_SIZE results, instead of one at a
+        time when they are accessed. This only makes a difference for graphs which are
+        stored in a server (see Neo4jObjectGraph._prefetch).
+
+        example:
+          for ep in g.query(Episode).prefetch('series', 'files'):
+              print ep.series.title
+        """
+        result = self._clone()
+        result._prefetch += [ name for name in names if name not in result._prefetch ]
+        return result
+
+
+    ### Evaluation methods
+
+    def _accept(self, node, filters):
+        """Return whether the given node matches the valid_node functions and the given filters."""
+        # TODO: should this go before or after the properties checking? Which is faster in general?
+        try:
+            if not all(valid_node(node) for valid_node in self._valid_nodes):
+                return False
+        except Exception, e:
+            log.warning('valid_node returned an exception: %s' % e)
+            return False
+
+        return not filters or match_filters(node, filters)
+
+    def _matching_nodes(self, count = None):
+        """Return a generator over the nodes matching this query, without
+        applying ordering, offset or limit and without wrapping them. If count
+        is not None, only the first count nodes are needed."""
+        limit = count if not self._valid_nodes else None
+        nodes, filters = self._graph._candidate_nodes(self._node_type, self._filters, limit)
+        return (node for node in nodes if self._accept(node, filters))
+
+    def _sort_key(self, node):
+        key = []
+        for path, reverse in self._order_by:
+            value = get_field(node, path)
+            # missing values always come last
+            key.append((value is None, _Reversed(value) if reverse else value))
+        return key
+
+    def _ordered_nodes(self, count):
+        """Return an iterable over the nodes matching this query in the requested
+        order. If count is not None, only the first count nodes are needed."""
+        if len(self._order_by) == 1:
+            path, reverse = self._order_by[0]
+            index = self._graph.index(path[0]) if len(path) == 1 else None
+            if index is not None and hasattr(index, 'walk'):
+                return self._walk_index(index, reverse)
+
+        if count is not None:
+            return heapq.nsmallest(count, self._matching_nodes(), key = self._sort_key)
+
+        return sorted(self._matching_nodes(), key = self._sort_key)
+
+    def _walk_index(self, index, reverse):
+        node_type = self._node_type
+        if isinstance(node_type, tuple):
+            is_valid = lambda n: any(n.isinstance(cls) for cls in node_type)
+        elif node_type is not None:
+            is_valid = lambda n: n.isinstance(node_type)
+        else:
+            is_valid = lambda n: True
+
+        for node in index.walk(reverse):
+            if is_valid(node) and self._accept(node, self._filters):
+                yield node
+
+        # nodes which are not in the index (ie: missing value) come last
+        path = [ index.prop ]
+        for node in self._matching_nodes():
+            if get_field(node, path) is None:
+                yield node
+
+    def _nodes(self, ordered = True):
+        """Return a generator over the nodes matching this query, with offset
+        and limit applied. If ordered is False, ordering is ignored."""
+        stop = self._offset + self._limit if self._limit is not None else None
+        if ordered and self._order_by:
+            nodes = self._ordered_nodes(stop)
+        else:
+            nodes = self._matching_nodes(stop)
+        return itertools.islice(nodes, self._offset, stop)
+
+    def _wrap(self, node):
+        node_type = self._node_type
+        if node_type is None:
+            return node
+
+        if isinstance(node_type, tuple):
+            for cls in node_type:
+                if node.isinstance(cls):
+                    return cls(node)
+            raise TypeError('QuerySet: asked for nodes of type %s but found this one: %s' % (node_type, node))
+
+        return node_type(node)
+
+    def _prefetched(self, nodes):
+        """Return a generator over the given nodes, which prefetches the links of
+        each batch of PREFETCH_BATCH_SIZE nodes before returning them."""
+        nodes = iter(nodes)
+        while True:
+            batch = list(itertools.islice(nodes, PREFETCH_BATCH_SIZE))
+            if not batch:
+                return
+            self._graph._prefetch(batch, self._prefetch)
+            for node in batch:
+                yield node
+
+    def __iter__(self):
+        nodes = self._nodes()
+        if self._prefetch:
+            nodes = self._prefetched(nodes)
+        for node in nodes:
+            yield self._wrap(node)
+
+    def count(self):
+        """Return the number of results of this query.
+
+        This never wraps the nodes into objects, and if the query can be fully
+        answered by an index it doesn't even need to match them one by one."""
+        if self._limit == 0:
+            return 0
+
+        if not self._valid_nodes:
+            nodes, filters = self._graph._candidate_nodes(self._node_type, self._filters)
+            if not filters and hasattr(nodes, '__len__'):
+                result = max(len(nodes) - self._offset, 0)
+                if self._limit is not None:
+                    result = min(result, self._limit)
+                return result
+
+        return sum(1 for _ in self._nodes(ordered = False))
+
+    def exists(self):
+        """Return whether this query has at least one result."""
+        for _ in self._nodes(ordered = False):
+            return True
+        return False
+
+    def values(self, *fields):
+        """Return a generator over tuples containing the values of the given fields
+        for each result of this query, read directly from the nodes (ie: no
+        BaseObject is ever created).
+
+        Fields can follow links to other objects using '.', and missing fields
+        are returned as None.
+
+        example:
+          g.query(Episode, season = 2).values('episodeNumber', 'series.title')
+        """
+        paths = [ field.split('.') for field in fields ]
+        nodes = self._nodes()
+        if self._prefetch:
+            nodes = self._prefetched(nodes)
+        for node in nodes:
+            yield tuple(get_field(node, path) for path in paths)
+
+    def aggregate(self, group_by = None, count = False, **aggregates):
+        """Compute aggregated values over the results of this query, in a single pass.
+
+        group_by can be a field (or a list of fields) whose value is used to group
+        the results, and fields can follow links to other objects using '.'. Results
+        for which this value is None are not part of any group.
+
+        The aggregated values are given with count=True and with any of the sum, min,
+        max and avg keyword args set to a field (or a list of fields). They are
+        returned as a dict with 'count' and '<aggregate>_<field>' keys (eg: 'max_season').
+
+        If group_by is None, this dict is returned directly, otherwise a dict from the
+        group value to its aggregated values is returned. Groups on links use the object
+        they point to as key.
+
+        When grouping on a single property which is indexed, the index is used to build
+        the groups instead of hashing the group value for each result.
+
+        example:
+          g.query(Episode).aggregate(group_by = 'series', count = True, max = 'season')
+        """
+        fields = []
+        for func, props in aggregates.items():
+            if func not in _aggregate_functions:
+                raise TypeError("Unknown aggregate function: '%s'" % func)
+            if isinstance(props, basestring):
+                props = [ props ]
+            for prop in props:
+                fields.append(('%s_%s' % (func, prop), func, prop.split('.')))
+
+        if group_by is None:
+            return self._aggregate_group(self._nodes(), count, fields) or _aggregate_result(None, count, fields)
+
+        groups = {}
+        if isinstance(group_by, basestring):
+            index = self._graph.index(group_by) if '.' not in group_by else None
+            if (index is not None and not self._valid_nodes and not self._filters and
+                not self._offset and self._limit is None):
+                node_type = self._node_type
+                if isinstance(node_type, tuple):
+                    is_valid = lambda n: any(n.isinstance(cls) for cls in node_type)
+                elif node_type is not None:
+                    is_valid = lambda n: n.isinstance(node_type)
+                else:
+                    is_valid = lambda n: True
+
+                for key, nodes in index.items():
+                    result = self._aggregate_group((n for n in nodes if is_valid(n)), count, fields)
+                    if result is not None:
+                        groups[key] = result
+
+                return groups
+
+            paths = [ group_by.split('.') ]
+        else:
+            paths = [ field.split('.') for field in group_by ]
+
+        states = {}
+        for node in self._nodes():
+            key = tuple(get_field(node, path) for path in paths)
+            if None in key:
+                continue
+            state = states.get(key)
+            if state is None:
+                state = states[key] = _aggregate_state(fields)
+            _aggregate_update(state, node, fields)
+
+        for key, state in states.items():
+            key = tuple(k.virtual() if isinstance(k, AbstractNode) else k for k in key)
+            if isinstance(group_by, basestring):
+                key = key[0]
+            groups[key] = _aggregate_result(state, count, fields)
+
+        return groups
+
+    def _aggregate_group(self, nodes, count, fields):
+        """Aggregate the given nodes as a single group, return None if there were none."""
+        state = None
+        for node in nodes:
+            if state is None:
+                state = _aggregate_state(fields)
+            _aggregate_update(state, node, fields)
+
+        if state is None:
+            return None
+        return _aggregate_result(state, count, fields)
+
+    def first(self):
+        """Return the first result of this query, or None if there are none."""
+        for obj in self.limit(1):
+            return obj
+        return None
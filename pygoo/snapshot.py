@@ -0,0 +1,1024 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Binary snapshot format for graphs.
+
+A snapshot is written and read as a stream, so that saving or loading a graph
+never needs to build a full copy of it in memory.
+
+The file starts with an 8 bytes magic string followed by the format version as
+an unsigned short. The rest of the file is a sequence of records, each of them
+being a one byte tag followed by the length of its payload as an unsigned int,
+and the payload itself. All the integers are little-endian.
+
+Version 2 of the format partitions the nodes by class (see below). Files
+written in version 1 can still be read.
+
+Records are:
+
+ - 'S' (string): an utf-8 encoded string. Strings are implicitly numbered in
+   the order they appear in the file, and property, edge and class names are
+   referred to by their string number afterwards (string table).
+ - 'N' (node): node id, number of classes, number of literals (<IHH), then the
+   string numbers of the class names (<I each) and the literals, each being the
+   string number of its name (<I) followed by a typed value (see below).
+ - 'A' (adjacency): node id and number of outgoing edges (<II) followed by the
+   edges, as fixed-width pairs of (edge name string number, target node id).
+ - 'M' (metadata): a list of (key, value) pairs, the key being an utf-8 encoded
+   string prefixed by its length (<I) and the value a typed value. This is used
+   to store information about the snapshot itself, such as the fingerprint of
+   the ontology it has been written with (see read_snapshot).
+ - 'K' (delete node): node id (<I), only used in delta segments (see below).
+ - 'P' (partition section) and 'E' (edges section): start a section, see below.
+ - 'X' (index): allows random access to the records without reading the whole
+   file (see MmapObjectGraph). It contains the number of node ids, strings,
+   classes and adjacency records (<IIII), followed by the file offsets (<Q each)
+   of the node records for each node id (0 if there is none), the position of
+   the first adjacency record of each node id in the adjacency offsets (<I each,
+   plus one for the end of the last one), the file offsets of the adjacency
+   records (<Q each), the file offsets of the string records, and for each class
+   the string number of its name and its number of nodes (<II) followed by their
+   ids (<I each). In version 1, there is no number of adjacency records and each
+   node id has the file offset of its only adjacency record instead.
+ - 'Z' (end): marks the end of the snapshot. If the snapshot has an index, the
+   payload is the file offset of the index record (<Q), so that it can be found
+   by reading the last bytes of the file.
+
+In version 2, the nodes are grouped in sections by partition: a partition
+contains all the nodes for which the most specialized class is the same, and is
+split in as many sections as needed so that a section contains at most
+SECTION_SIZE nodes. A partition section starts with a 'P' record containing the
+length of the section (<Q, the number of bytes of the records following the 'P'
+record which are part of the section), the string number of the partition name,
+and the number of distinct classes of its nodes (<II) followed by their string
+numbers (<I each). It contains the node records of the section, possibly
+followed by the adjacency records for the edges between two nodes of the
+section. After all the partition sections, the edges are written in edges
+sections, each of them containing the edges from nodes of one partition to
+nodes of another (or the same) partition. They start with an 'E' record
+containing the length of the section (<Q) followed by the string numbers of the
+source and target partitions (<II), and contain adjacency records, so a node can
+have several adjacency records. Readers can thus skip the sections they don't
+need without decoding them, as they are independent of each other (see
+read_snapshot). String records are never part of a section, so that readers
+which skip some sections still know all the strings, and always come before
+the first record which refers to them.
+
+A delta segment (see write_delta) uses the same format as a snapshot, but only
+contains the nodes which have been modified since the last save: their node
+record and their adjacency record (even if it has no edges) replace the ones
+of the snapshot it applies to, and a 'K' record is written for each node that
+has been deleted. Delta segments are appended one after the other to the delta
+file of a snapshot.
+
+Readers ignore records with an unknown tag, so new record types can be added
+without breaking older readers as long as they are not needed to rebuild the
+graph.
+
+Typed values are a one byte type followed by:
+ - None: nothing
+ - int, long: a signed long long (<q), longs which don't fit in it are
+   written as their decimal representation (length-prefixed)
+ - float: a double (<d)
+ - unicode: the length of the utf-8 encoded string (<I) and the string itself
+ - any other literal type: a length-prefixed pickle of the value
+"""
+
+from pygoo import ontology
+import cPickle as pickle
+import tempfile
+import struct
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+MAGIC = b'PYGOOSNP'
+VERSION = 2
+
+_header = struct.Struct(b'<8sH')
+_record = struct.Struct(b'<cI')
+_node = struct.Struct(b'<IHH')
+_adjacency = struct.Struct(b'<II')
+_uint = struct.Struct(b'<I')
+_edge = struct.Struct(b'<II')
+_literal = struct.Struct(b'<IB')
+_long = struct.Struct(b'<q')
+_double = struct.Struct(b'<d')
+_offset = struct.Struct(b'<Q')
+_index_v1 = struct.Struct(b'<III')
+_index = struct.Struct(b'<IIII')
+_section = struct.Struct(b'<QII')
+_class = struct.Struct(b'<II')
+# type byte followed by a value or a length
+_typed_long = struct.Struct(b'<Bq')
+_typed_double = struct.Struct(b'<Bd')
+_typed_length = struct.Struct(b'<BI')
+
+# literal types
+T_NONE, T_INT, T_LONG, T_BIGINT, T_FLOAT, T_UNICODE, T_PICKLE = range(7)
+
+# flush the write buffer each time it gets bigger than this
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# maximum number of nodes in a partition section
+SECTION_SIZE = 10000
+
+_MIN_LONG, _MAX_LONG = -2**63, 2**63 - 1
+
+
+def encode_literal(value):
+    """Return the binary representation of the given literal value."""
+    t = type(value)
+    if t is unicode:
+        value = value.encode('utf-8')
+        return _typed_length.pack(T_UNICODE, len(value)) + value
+    elif t is int or t is long:
+        if _MIN_LONG <= value <= _MAX_LONG:
+            return _typed_long.pack(T_INT if t is int else T_LONG, value)
+        value = str(value)
+        return _typed_length.pack(T_BIGINT, len(value)) + value
+    elif t is float:
+        return _typed_double.pack(T_FLOAT, value)
+    elif value is None:
+        return chr(T_NONE)
+    else:
+        value = pickle.dumps(value, 2)
+        return _typed_length.pack(T_PICKLE, len(value)) + value
+
+
+def decode_literal(data, pos, ltype):
+    """Decode the value of the given type starting at data[pos].
+    Return a tuple (value, position after the value)."""
+    if ltype == T_UNICODE:
+        n, = _uint.unpack_from(data, pos)
+        pos += 4
+        return data[pos:pos+n].decode('utf-8'), pos + n
+    elif ltype == T_INT:
+        return int(_long.unpack_from(data, pos)[0]), pos + 8
+    elif ltype == T_LONG:
+        return long(_long.unpack_from(data, pos)[0]), pos + 8
+    elif ltype == T_FLOAT:
+        return _double.unpack_from(data, pos)[0], pos + 8
+    elif ltype == T_NONE:
+        return None, pos
+    elif ltype == T_BIGINT:
+        n, = _uint.unpack_from(data, pos)
+        pos += 4
+        return long(data[pos:pos+n]), pos + n
+    elif ltype == T_PICKLE:
+        n, = _uint.unpack_from(data, pos)
+        pos += 4
+        return pickle.loads(data[pos:pos+n]), pos + n
+    else:
+        raise ValueError('Invalid literal type in snapshot: %d' % ltype)
+
+
+class SnapshotWriter(object):
+    """Write a snapshot to a file-like object, one record at a time.
+
+    If strings is given, the writer continues a file which already contains
+    those strings as its string table (and the header), otherwise it starts a
+    new one."""
+
+    magic = MAGIC
+
+    def __init__(self, f, strings = None):
+        self._f = f
+        self._strings = {}
+        self._buffer = []
+        self._buffered = 0
+        self._pos = 0
+        self.string_offsets = []
+        if strings is None:
+            self._write(_header.pack(self.magic, VERSION))
+        else:
+            self._strings = dict((s, i) for i, s in enumerate(strings))
+
+    def _write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._pos += len(data)
+        if self._buffered > WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self._f.write(b''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+    def record(self, tag, payload):
+        """Write a record and return its offset in the file."""
+        offset = self._pos
+        self._write(_record.pack(tag, len(payload)))
+        self._write(payload)
+        return offset
+
+    def string_id(self, s):
+        """Return the number of the given string in the string table, writing
+        it to the snapshot the first time it is seen."""
+        sid = self._strings.get(s)
+        if sid is None:
+            sid = self._strings[s] = len(self._strings)
+            self.string_offsets.append(self.record(b'S', s.encode('utf-8')))
+        return sid
+
+    def write_node(self, node_id, classes, literals):
+        """Write a node record. classes is a list of class names and literals a
+        list of (name, value) pairs."""
+        sid = self.string_id
+        payload = [ _node.pack(node_id, len(classes), len(literals)) ]
+        payload += [ _uint.pack(sid(cls)) for cls in classes ]
+        for name, value in literals:
+            payload.append(_uint.pack(sid(name)))
+            payload.append(encode_literal(value))
+        return self.record(b'N', b''.join(payload))
+
+    def write_adjacency(self, node_id, edges):
+        """Write the outgoing edges of a node, given as a list of (name, target node id) pairs."""
+        sid = self.string_id
+        payload = [ _adjacency.pack(node_id, len(edges)) ]
+        payload += [ _edge.pack(sid(name), other_id) for name, other_id in edges ]
+        return self.record(b'A', b''.join(payload))
+
+    def write_section(self, tag, payload, records, size):
+        """Write a section: a record of the given tag, the payload of which is the
+        length of the section followed by payload, and then the given records, whose
+        total length is size. Return the offset of the first record of the section."""
+        self.record(tag, _offset.pack(size) + payload)
+        start = self._pos
+        self._write(b''.join(records))
+        return start
+
+    def write_file(self, f):
+        """Copy the whole contents of the given file-like object (eg: a spool of
+        records, see write_snapshot)."""
+        f.seek(0)
+        while True:
+            data = f.read(WRITE_BUFFER_SIZE)
+            if not data:
+                break
+            self._write(data)
+
+    def write_metadata(self, metadata):
+        """Write a metadata record from the given dict."""
+        payload = []
+        for key, value in metadata.items():
+            key = key.encode('utf-8')
+            payload += [ _uint.pack(len(key)), key, encode_literal(value) ]
+        return self.record(b'M', b''.join(payload))
+
+    def write_index(self, node_offsets, adjacency_start, adjacency_offsets, classes):
+        """Write the index record. The tables are given as (count, chunks) pairs, where
+        chunks is an iterable over sequences of integers, so that they don't need to be
+        in memory all at once (see _IntSpool):
+
+         - node_offsets: the record offset of each node id (0 for no record)
+         - adjacency_start: for each node id, the position of its first adjacency
+           record in adjacency_offsets, and the total number of adjacency records
+         - adjacency_offsets: the offsets of the adjacency records, by node id
+         - classes: a list of (string number of a class name, table of the ids of the
+           nodes having this class)
+
+        This needs to be the last record before calling close()."""
+        def write_table(fmt, table):
+            for values in table[1]:
+                self._write(struct.pack(b'<%d%s' % (len(values), fmt), *values))
+
+        size = (_index.size + 8 * node_offsets[0] + 4 * adjacency_start[0] +
+                8 * adjacency_offsets[0] + 8 * len(self.string_offsets) +
+                sum(_class.size + 4 * table[0] for _, table in classes))
+
+        self._index_offset = self._pos
+        self._write(_record.pack(b'X', size))
+        self._write(_index.pack(node_offsets[0], len(self.string_offsets), len(classes),
+                                adjacency_offsets[0]))
+        write_table(b'Q', node_offsets)
+        write_table(b'I', adjacency_start)
+        write_table(b'Q', adjacency_offsets)
+        write_table(b'Q', (len(self.string_offsets), [ self.string_offsets ]))
+        for name_id, table in classes:
+            self._write(_class.pack(name_id, table[0]))
+            write_table(b'I', table)
+
+    def close(self):
+        index_offset = getattr(self, '_index_offset', None)
+        self.record(b'Z', _offset.pack(index_offset) if index_offset is not None else b'')
+        self.flush()
+
+
+class SnapshotReader(object):
+    """Read a snapshot from a file-like object, one record at a time."""
+
+    magic = MAGIC
+
+    def __init__(self, f):
+        self._f = f
+        self.strings = []
+
+        header = f.read(_header.size)
+        if len(header) != _header.size:
+            raise ValueError('Not a PyGoo snapshot: file is too short')
+        magic, self.version = _header.unpack(header)
+        if magic != self.magic:
+            raise ValueError('Not a PyGoo snapshot: invalid magic string')
+        if self.version > VERSION:
+            raise ValueError('Unsupported snapshot version: %d (only up to %d is supported)' % (self.version, VERSION))
+
+    def skip(self, size):
+        """Skip the given number of bytes, i.e. the records of a section the caller is
+        not interested in. This is meant to be called while iterating over records()."""
+        try:
+            self._f.seek(size, 1)
+        except (AttributeError, IOError):
+            # not a seekable file
+            while size > 0:
+                data = self._f.read(min(size, WRITE_BUFFER_SIZE))
+                if not data:
+                    break
+                size -= len(data)
+
+    def records(self):
+        """Return a generator over the (tag, payload) records of the snapshot.
+        String records are consumed to build the string table and not returned."""
+        read = self._f.read
+        strings = self.strings
+        self.complete = False
+        while True:
+            header = read(_record.size)
+            if not header:
+                log.warning('Snapshot has no end record, it might have been truncated')
+                return
+            if len(header) != _record.size:
+                raise ValueError('Truncated snapshot')
+            tag, size = _record.unpack(header)
+            payload = read(size)
+            if len(payload) != size:
+                raise ValueError('Truncated snapshot')
+
+            if tag == b'S':
+                strings.append(payload.decode('utf-8'))
+            elif tag == b'Z':
+                self.complete = True
+                return
+            else:
+                yield tag, payload
+
+    def decode_node(self, payload):
+        """Return a tuple (node_id, class names, literals) for the given node record."""
+        return decode_node(payload, self.strings)
+
+    def decode_adjacency(self, payload):
+        """Return a tuple (node_id, edges) for the given adjacency record, where edges
+        is a list of (name, target node id) pairs."""
+        return decode_adjacency(payload, self.strings)
+
+    def decode_metadata(self, payload):
+        """Return the dict contained in the given metadata record."""
+        metadata = {}
+        pos = 0
+        while pos < len(payload):
+            n, = _uint.unpack_from(payload, pos)
+            key = payload[pos+4:pos+4+n].decode('utf-8')
+            pos += 4 + n
+            metadata[key], pos = decode_literal(payload, pos + 1, ord(payload[pos]))
+        return metadata
+
+
+def decode_node(payload, strings):
+    """Return a tuple (node_id, class names, literals) for the given node record,
+    using the given string table."""
+    node_id, nclasses, nliterals = _node.unpack_from(payload, 0)
+    pos = _node.size
+    classes = [ strings[_uint.unpack_from(payload, pos + 4*i)[0]] for i in xrange(nclasses) ]
+    pos += 4 * nclasses
+
+    literals = []
+    for _ in xrange(nliterals):
+        sid, ltype = _literal.unpack_from(payload, pos)
+        value, pos = decode_literal(payload, pos + _literal.size, ltype)
+        literals.append((strings[sid], value))
+
+    return node_id, classes, literals
+
+
+def decode_adjacency(payload, strings):
+    """Return a tuple (node_id, edges) for the given adjacency record, using the
+    given string table."""
+    node_id, count = _adjacency.unpack_from(payload, 0)
+    edges = []
+    for i in xrange(count):
+        sid, other_id = _edge.unpack_from(payload, _adjacency.size + _edge.size*i)
+        edges.append((strings[sid], other_id))
+    return node_id, edges
+
+
+def record_at(data, offset):
+    """Return the (tag, payload) of the record starting at the given offset in data,
+    which can be a string or a mmap object."""
+    tag, size = _record.unpack_from(data, offset)
+    offset += _record.size
+    return tag, data[offset:offset+size]
+
+
+class SnapshotIndex(object):
+    """Give random access to the records of a snapshot through its index record.
+
+    data can be any object supporting slicing and the buffer interface, such as
+    a string or a mmap object. The offset tables are not copied but read from data
+    each time they are accessed, only the string table and the class table (which
+    are both small) are decoded when the index is created.
+    """
+
+    def __init__(self, data):
+        tail = len(data) - _record.size - _offset.size
+        if tail < _header.size:
+            raise ValueError('Not a PyGoo snapshot: file is too short')
+        tag, size = _record.unpack_from(data, tail)
+        if tag != b'Z' or size != _offset.size:
+            raise ValueError('Snapshot has no index, it needs to be saved again with a more recent version of PyGoo')
+
+        index_offset, = _offset.unpack_from(data, tail + _record.size)
+        tag, size = _record.unpack_from(data, index_offset)
+        if tag != b'X':
+            raise ValueError('Invalid snapshot index offset: %d' % index_offset)
+
+        pos = index_offset + _record.size
+        self._data = data
+        self.version = _header.unpack_from(data, 0)[1]
+        if self.version == 1:
+            self.node_count, nstrings, nclasses = _index_v1.unpack_from(data, pos)
+            pos += _index_v1.size
+            self._nodes_table = pos
+            self._adjacency_start = None
+            self._adjacency_table = pos + 8 * self.node_count
+            pos = self._adjacency_table + 8 * self.node_count
+        else:
+            self.node_count, nstrings, nclasses, nadjacency = _index.unpack_from(data, pos)
+            pos += _index.size
+            self._nodes_table = pos
+            self._adjacency_start = pos + 8 * self.node_count
+            self._adjacency_table = self._adjacency_start + 4 * (self.node_count + 1)
+            pos = self._adjacency_table + 8 * nadjacency
+
+        self.strings = []
+        for i in xrange(nstrings):
+            tag, payload = record_at(data, _offset.unpack_from(data, pos + 8*i)[0])
+            self.strings.append(payload.decode('utf-8'))
+        pos += 8 * nstrings
+
+        # class name -> (offset of the node ids, number of nodes)
+        self.classes = {}
+        for _ in xrange(nclasses):
+            sid, count = _class.unpack_from(data, pos)
+            pos += _class.size
+            self.classes[self.strings[sid]] = (pos, count)
+            pos += 4 * count
+
+    def node_offset(self, node_id):
+        """Return the offset of the record for the given node id, or 0 if there is none."""
+        if not 0 <= node_id < self.node_count:
+            return 0
+        return _offset.unpack_from(self._data, self._nodes_table + 8*node_id)[0]
+
+    def adjacency_offsets(self, node_id):
+        """Return the list of offsets of the adjacency records for the given node id."""
+        if not 0 <= node_id < self.node_count:
+            return []
+        data = self._data
+        if self._adjacency_start is None:
+            offset, = _offset.unpack_from(data, self._adjacency_table + 8*node_id)
+            return [ offset ] if offset else []
+        start, end = struct.unpack_from(b'<II', data, self._adjacency_start + 4*node_id)
+        return [ _offset.unpack_from(data, self._adjacency_table + 8*i)[0] for i in xrange(start, end) ]
+
+    def class_node_ids(self, name):
+        """Return a generator over the ids of the nodes having the given class."""
+        pos, count = self.classes.get(name, (0, 0))
+        data = self._data
+        for i in xrange(count):
+            yield _uint.unpack_from(data, pos + 4*i)[0]
+
+    def node(self, node_id):
+        """Return a tuple (class names, literals) for the given node id.
+
+        :raises KeyError: If there is no node with this id in the snapshot.
+        """
+        offset = self.node_offset(node_id)
+        if not offset:
+            raise KeyError(node_id)
+        _, class_names, literals = decode_node(record_at(self._data, offset)[1], self.strings)
+        return class_names, literals
+
+    def edges(self, node_id):
+        """Return the list of (name, target node id) outgoing edges of the given node id."""
+        edges = []
+        for offset in self.adjacency_offsets(node_id):
+            edges += decode_adjacency(record_at(self._data, offset)[1], self.strings)[1]
+        return edges
+
+
+class _Spool(SnapshotWriter):
+    """Temporary storage for the records which are produced while walking the graph
+    but can only be written at the end of a snapshot (see write_snapshot). They are
+    kept in memory until they get bigger than WRITE_BUFFER_SIZE, and in a temporary
+    file after that. Offsets are relative to the start of the spool."""
+
+    def __init__(self):
+        super(_Spool, self).__init__(tempfile.SpooledTemporaryFile(WRITE_BUFFER_SIZE), strings = [])
+
+    def close(self):
+        self._f.close()
+
+
+class _IntSpool(object):
+    """A list of unsigned integers which is written to a temporary file as it grows,
+    and can then be read back in chunks. Values are appended to the values list, and
+    spill() needs to be called regularly to move them to the file."""
+
+    CHUNK_SIZE = 16384
+
+    def __init__(self, fmt = b'I'):
+        self._fmt = fmt
+        self._itemsize = struct.calcsize(b'<%s' % fmt)
+        self._f = tempfile.SpooledTemporaryFile(WRITE_BUFFER_SIZE)
+        self.values = []
+        self.count = 0
+
+    def spill(self):
+        """Write the values to the temporary file if there are enough of them."""
+        values = self.values
+        if len(values) >= self.CHUNK_SIZE:
+            self._f.write(struct.pack(b'<%d%s' % (len(values), self._fmt), *values))
+            self.count += len(values)
+            del values[:]
+
+    def __len__(self):
+        return self.count + len(self.values)
+
+    def chunks(self):
+        """Return a generator over tuples containing the values of the list, in order.
+        Values which have been appended in pairs are never split across two chunks."""
+        self._f.seek(0)
+        while True:
+            data = self._f.read(self._itemsize * self.CHUNK_SIZE)
+            if not data:
+                break
+            yield struct.unpack(b'<%d%s' % (len(data) // self._itemsize, self._fmt), data)
+        yield tuple(self.values)
+
+    def table(self):
+        """Return this list as a table for SnapshotWriter.write_index."""
+        return len(self), self.chunks()
+
+    def close(self):
+        self._f.close()
+
+
+class _SectionBuffer(object):
+    """The records of a section which hasn't been written yet (see write_snapshot)."""
+
+    __slots__ = ('number', 'records', 'size', 'count', 'classes')
+
+    def __init__(self, number):
+        self.number = number
+        self.records = []
+        self.size = 0
+        self.count = 0
+        self.classes = set()
+
+
+# (section, offset) of the node ids which don't have a node record
+_NO_SECTION = 2**32 - 1
+
+def write_snapshot(graph, f, metadata = None):
+    """Write the given graph as a snapshot to the given file-like object, with the
+    given metadata dict if any.
+
+    The graph is walked only once, in increasing order of node id. Node records are
+    kept by partition until a section is full and then written, while the edges
+    sections and the index tables are spooled to temporary files and appended to
+    the snapshot once all the nodes have been written. The memory needed thus only
+    depends on the number of partitions, not on the size of the graph."""
+    writer = SnapshotWriter(f)
+    sid = writer.string_id
+    metadata = dict(metadata or {})
+    metadata['ontology'] = ontology.fingerprint()
+    writer.write_metadata(metadata)
+
+    # packed string number of the literal names
+    names = {}
+    def name_key(name):
+        key = names[name] = _uint.pack(sid(name))
+        return key
+
+    # (partition, class string numbers, packed class string numbers, functions adding
+    # a node id to the table of each class) for each set of classes, as computing the
+    # partition of a node needs to look at all its classes
+    class_sets = {}
+    def class_set(node):
+        classes = frozenset(node.classes())
+        class_ids = sorted(sid(cls.__name__) for cls in classes)
+        for class_id in class_ids:
+            if class_id not in class_tables:
+                class_tables[class_id] = _IntSpool()
+                tables.append(class_tables[class_id])
+        info = class_sets[classes] = (sid(node.virtual_class().__name__), class_ids,
+                                      struct.pack(b'<%dI' % len(class_ids), *class_ids),
+                                      [ class_tables[class_id].values.append for class_id in class_ids ])
+        return info
+
+    node_sections = {}   # partition -> section being filled
+    edge_sections = {}   # (partition, target partition) -> section being filled
+    node_starts = []     # offset of the first record of each partition section
+    edge_starts = []     # offset of the first record of each edges section in the spool
+    edges = _Spool()
+
+    # (section, offset in section) of the node record of each node id, and of the
+    # adjacency records of each node id
+    node_table = _IntSpool()
+    adjacency_start = _IntSpool()
+    adjacency_table = _IntSpool()
+    # class string number -> ids of the nodes having this class
+    class_tables = {}
+    tables = [ node_table, adjacency_start, adjacency_table ]
+
+    node_values = node_table.values
+    adjacency_values = adjacency_table.values
+    adjacency_start_values = adjacency_start.values
+
+    def write_nodes(part):
+        section = node_sections.pop(part)
+        part_classes = sorted(section.classes)
+        node_starts[section.number] = writer.write_section(
+            b'P', _uint.pack(part) + _uint.pack(len(part_classes)) +
+                  struct.pack(b'<%dI' % len(part_classes), *part_classes),
+            section.records, section.size)
+
+    def write_edges(parts):
+        section = edge_sections.pop(parts)
+        edge_starts[section.number] = edges.write_section(b'E', _uint.pack(parts[0]) + _uint.pack(parts[1]),
+                                                          section.records, section.size)
+
+    next_id = 0
+    adjacency_count = 0
+    for node_id, node in graph.scan_nodes():
+        gap = node_id != next_id
+        for _ in xrange(next_id, node_id):
+            node_values += (_NO_SECTION, 0)
+            adjacency_start_values.append(adjacency_count)
+        if gap or not node_id % 1024:
+            for table in tables:
+                table.spill()
+        next_id = node_id + 1
+
+        part, class_ids, packed_classes, add_to_classes = (class_sets.get(frozenset(node.classes())) or
+                                                           class_set(node))
+        for add_to_class in add_to_classes:
+            add_to_class(node_id)
+
+        payload = []
+        for name, value in node.literal_items():
+            payload.append(names.get(name) or name_key(name))
+            payload.append(encode_literal(value))
+        payload = (_node.pack(node_id, len(class_ids), len(payload) // 2) + packed_classes +
+                   b''.join(payload))
+
+        section = node_sections.get(part)
+        if section is None:
+            section = node_sections[part] = _SectionBuffer(len(node_starts))
+            node_starts.append(None)
+        section.classes.update(class_ids)
+        node_values += (section.number, section.size)
+        section.records += (_record.pack(b'N', len(payload)), payload)
+        section.size += _record.size + len(payload)
+        section.count += 1
+        if section.count >= SECTION_SIZE or section.size >= WRITE_BUFFER_SIZE:
+            write_nodes(part)
+
+        # group the outgoing edges by the partition of their target
+        node_edges = {}
+        for name, other_nodes in node.edge_items():
+            name_id = sid(name)
+            for other_node in other_nodes:
+                other_part = (class_sets.get(frozenset(other_node.classes())) or class_set(other_node))[0]
+                edge = _edge.pack(name_id, other_node.node_id())
+                if other_part in node_edges:
+                    node_edges[other_part].append(edge)
+                else:
+                    node_edges[other_part] = [ edge ]
+
+        adjacency_start_values.append(adjacency_count)
+        adjacency_count += len(node_edges)
+        for other_part, other_edges in node_edges.items():
+            payload = _adjacency.pack(node_id, len(other_edges)) + b''.join(other_edges)
+            parts = (part, other_part)
+            section = edge_sections.get(parts)
+            if section is None:
+                section = edge_sections[parts] = _SectionBuffer(len(edge_starts))
+                edge_starts.append(None)
+            adjacency_values += (section.number, section.size)
+            section.records += (_record.pack(b'A', len(payload)), payload)
+            section.size += _record.size + len(payload)
+            section.count += 1
+            if section.count >= SECTION_SIZE or section.size >= WRITE_BUFFER_SIZE:
+                write_edges(parts)
+
+    adjacency_start_values.append(adjacency_count)
+
+    # edges come after all the nodes, so that their targets have been read already
+    for part in sorted(node_sections):
+        write_nodes(part)
+    for parts in sorted(edge_sections):
+        write_edges(parts)
+    edges.flush()
+    edges_start = writer._pos
+    writer.write_file(edges._f)
+    edges.close()
+
+    def absolute(table, starts, base = 0):
+        for values in table.chunks():
+            yield [ base + starts[section] + offset if section != _NO_SECTION else 0
+                    for section, offset in zip(values[::2], values[1::2]) ]
+
+    writer.write_index((next_id, absolute(node_table, node_starts)),
+                       adjacency_start.table(),
+                       (adjacency_count, absolute(adjacency_table, edge_starts, edges_start)),
+                       [ (class_id, table.table()) for class_id, table in sorted(class_tables.items()) ])
+    writer.close()
+
+    for table in tables:
+        table.close()
+
+
+def class_names(classes):
+    """Return the set of names of the given classes, which can be given as classes
+    or as class names, or None if classes is None."""
+    if classes is None:
+        return None
+    return set(cls if isinstance(cls, basestring) else cls.__name__ for cls in classes)
+
+
+def read_snapshot(graph, f, classes = None):
+    """Replace the contents of the given graph with the snapshot read from the
+    given file-like object, and return the metadata dict of the snapshot.
+
+    If classes is given, only the nodes which are instances of one of them and the
+    edges between those nodes are loaded. Sections which don't contain any of
+    them are skipped without being decoded.
+
+    If the snapshot has been written with the current ontology (same fingerprint),
+    the saved classes of the nodes are trusted and the graph can restore them
+    without validating them. Otherwise, the graph objects are revalidated once
+    the snapshot has been read."""
+    reader = SnapshotReader(f)
+    graph.clear()
+    metadata = {}
+    wanted = class_names(classes)
+    current_ontology = ontology.fingerprint()
+    trusted = [ False ]
+
+    loaded_classes = {}
+    def get_class(name):
+        cls = loaded_classes.get(name)
+        if cls is None:
+            cls = loaded_classes[name] = ontology.get_class(name)
+        return cls
+
+    # only remember the nodes for which the graph couldn't keep the saved id
+    idmap = {}
+    def get_node(node_id):
+        node = idmap.get(node_id)
+        if node is None:
+            node = graph.get_node(node_id)
+        return node
+
+    def add_node(node_id, node_classes, literals):
+        if wanted is not None and wanted.isdisjoint(node_classes):
+            return
+        node = graph.restore_node(node_id,
+                                  props = [ (name, value, None) for name, value in literals ],
+                                  _classes = [ get_class(cls) for cls in node_classes ],
+                                  trusted = trusted[0])
+        if node.node_id() != node_id:
+            idmap[node_id] = node
+
+    def add_edges(node_id, edges):
+        if wanted is None:
+            node = get_node(node_id)
+            for name, other_id in edges:
+                node.add_directed_edge(name, get_node(other_id))
+            return
+
+        try:
+            node = get_node(node_id)
+        except KeyError:
+            return
+        for name, other_id in edges:
+            try:
+                node.add_directed_edge(name, get_node(other_id))
+            except KeyError:
+                pass
+
+    # string numbers of the partitions which have been loaded
+    partitions = set()
+
+    for tag, payload in reader.records():
+        if tag == b'N':
+            add_node(*reader.decode_node(payload))
+
+        elif tag == b'A':
+            add_edges(*reader.decode_adjacency(payload))
+
+        elif tag == b'P':
+            length, part, count = _section.unpack_from(payload, 0)
+            if wanted is not None:
+                part_classes = struct.unpack_from(b'<%dI' % count, payload, _section.size)
+                if wanted.isdisjoint(reader.strings[i] for i in part_classes):
+                    reader.skip(length)
+                    continue
+            partitions.add(part)
+
+        elif tag == b'E':
+            length, part, other_part = _section.unpack(payload)
+            if part not in partitions or other_part not in partitions:
+                reader.skip(length)
+
+        elif tag == b'M':
+            metadata.update(reader.decode_metadata(payload))
+            trusted[0] = metadata.get('ontology') == current_ontology
+
+    if not trusted[0]:
+        graph.revalidate_objects()
+
+    return metadata
+
+
+def write_delta(graph, f, node_ids, metadata = None):
+    """Write a delta segment containing the current state of the nodes with the given
+    ids to the given file-like object. Ids which are not in the graph anymore are
+    written as deleted nodes."""
+    writer = SnapshotWriter(f)
+    if metadata:
+        writer.write_metadata(metadata)
+
+    nodes = []
+    for node_id in sorted(node_ids):
+        try:
+            nodes.append((node_id, graph.get_node(node_id)))
+        except KeyError:
+            writer.record(b'K', _uint.pack(node_id))
+
+    for node_id, node in nodes:
+        writer.write_node(node_id,
+                          [ cls.__name__ for cls in node.classes() ],
+                          list(node.literal_items()))
+
+    for node_id, node in nodes:
+        writer.write_adjacency(node_id, [ (name, other_node.node_id())
+                                          for name, other_nodes in node.edge_items()
+                                          for other_node in other_nodes ])
+    writer.close()
+
+
+def read_delta(f):
+    """Read the next delta segment from the given file-like object.
+
+    Return a tuple (metadata, changes) where changes is a list of (tag, decoded
+    record) to be given to apply_delta, or None if there is no complete segment
+    left in the file."""
+    try:
+        reader = SnapshotReader(f)
+        records = list(reader.records())
+    except ValueError:
+        return None
+    if not reader.complete:
+        return None
+
+    metadata = {}
+    changes = []
+    for tag, payload in records:
+        if tag == b'N':
+            changes.append((tag, reader.decode_node(payload)))
+        elif tag == b'A':
+            changes.append((tag, reader.decode_adjacency(payload)))
+        elif tag == b'K':
+            changes.append((tag, _uint.unpack(payload)[0]))
+        elif tag == b'M':
+            metadata.update(reader.decode_metadata(payload))
+
+    return metadata, changes
+
+
+def read_deltas(filename, snapshot_id):
+    """Return a generator over the delta segments written for the snapshot with the
+    given id (see MemoryObjectGraph.save_incremental) in filename.delta, as tuples
+    (changes, offset of the end of the segment), where changes are to be given to
+    apply_delta.
+
+    It stops at the end of the file, at an incomplete segment, or at the segments
+    which have been written for a previous snapshot."""
+    delta = filename + '.delta'
+    if snapshot_id is None or not os.path.exists(delta):
+        return
+    with open(delta, 'rb') as f:
+        while True:
+            segment = read_delta(f)
+            if segment is None or segment[0].get('base') != snapshot_id:
+                return
+            yield segment[1], f.tell()
+
+
+def apply_delta(graph, changes, classes = None):
+    """Apply the changes of a delta segment (see read_delta) to the given graph.
+
+    If classes is given, the graph is assumed to have been loaded with the same
+    classes (see read_snapshot), and new nodes are only added if they are
+    instances of one of them."""
+    get_class = ontology.get_class
+    wanted = class_names(classes)
+
+    for tag, change in changes:
+        if tag == b'N':
+            node_id, node_classes, literals = change
+            try:
+                node = graph.get_node(node_id)
+            except KeyError:
+                if wanted is None or not wanted.isdisjoint(node_classes):
+                    graph.restore_node(node_id,
+                                       props = [ (name, value, None) for name, value in literals ],
+                                       _classes = [ get_class(cls) for cls in node_classes ])
+                continue
+
+            literals = dict(literals)
+            for name in list(node.literal_keys()):
+                if name not in literals:
+                    node.del_literal(name)
+            for name, value in literals.items():
+                node.set_literal(name, value)
+            node.clear_classes()
+            for cls in node_classes:
+                node.add_class(get_class(cls))
+
+        elif tag == b'A':
+            node_id, edges = change
+            try:
+                node = graph.get_node(node_id)
+            except KeyError:
+                if wanted is None:
+                    raise
+                continue
+            for name, other_nodes in [ (name, list(other_nodes)) for name, other_nodes in node.edge_items() ]:
+                for other_node in other_nodes:
+                    node.remove_directed_edge(name, other_node)
+            for name, other_id in edges:
+                try:
+                    other_node = graph.get_node(other_id)
+                except KeyError:
+                    if wanted is None:
+                        raise
+                    continue
+                node.add_directed_edge(name, other_node)
+
+        elif tag == b'K':
+            try:
+                graph.delete_node(graph.get_node(change))
+            except KeyError:
+                # node was created and deleted between two saves
+                pass
+
+
+def read_metadata(f):
+    """Return the metadata dict of the snapshot read from the given file-like
+    object, without reading the rest of the snapshot."""
+    reader = SnapshotReader(f)
+    for tag, payload in reader.records():
+        # write_snapshot writes the metadata record first
+        if tag == b'M':
+            return reader.decode_metadata(payload)
+        break
+    return {}
+
+
+def is_snapshot(filename):
+    """Return whether the given file is a snapshot (as opposed to a legacy pickle)."""
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
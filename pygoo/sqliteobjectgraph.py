@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pygoo.objectgraph import ObjectGraph
+from pygoo.sqliteobjectnode import SQLiteObjectNode, to_sql
+from pygoo.baseobject import BaseObject
+from pygoo.snapshot import T_INT, T_LONG, T_FLOAT, T_UNICODE, T_BIGINT, T_PICKLE
+from pygoo import ontology
+import weakref
+import sqlite3
+import logging
+
+log = logging.getLogger(__name__)
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY AUTOINCREMENT);
+CREATE TABLE IF NOT EXISTS classes (node INTEGER NOT NULL, class TEXT NOT NULL,
+                                    PRIMARY KEY (node, class));
+CREATE INDEX IF NOT EXISTS classes_class ON classes (class, node);
+CREATE TABLE IF NOT EXISTS literals (node INTEGER NOT NULL, name TEXT NOT NULL,
+                                     type INTEGER NOT NULL, value,
+                                     PRIMARY KEY (node, name));
+CREATE INDEX IF NOT EXISTS literals_value ON literals (name, type, value);
+CREATE TABLE IF NOT EXISTS edges (id INTEGER PRIMARY KEY, node INTEGER NOT NULL,
+                                  name TEXT NOT NULL, other INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS edges_node ON edges (node, name);
+CREATE INDEX IF NOT EXISTS edges_other ON edges (other, name);
+'''
+
+# number of node ids fetched at once when iterating over the results of a query
+FETCH_SIZE = 1000
+
+
+class _QueryNodes(object):
+    """The nodes matching a SQL query (see SQLiteObjectGraph._candidate_nodes), which
+    are fetched when iterating over them, and can be counted without fetching them."""
+
+    def __init__(self, graph, sql, params, id_column, limit = None):
+        self._graph = graph
+        self._sql = sql
+        self._params = params
+        self._id_column = id_column
+        self._limit = limit
+
+    def __iter__(self):
+        get_node = self._graph.get_node
+        for node_id in self._graph._node_ids(self._sql, self._params, self._id_column, limit = self._limit):
+            yield get_node(node_id)
+
+    def __len__(self):
+        count, = self._graph._execute('SELECT COUNT(DISTINCT %s) %s' % (self._id_column, self._sql),
+                                      self._params).fetchone()
+        return count if self._limit is None else min(count, self._limit)
+
+
+class SQLiteObjectGraph(ObjectGraph):
+    """An ObjectGraph stored in a SQLite database.
+
+    Nodes, literals, classes and edges are each stored in their own table, and
+    node objects are only created when a node is accessed (and kept in a weak
+    identity map), so that graphs bigger than the available memory can be used,
+    and opening an existing database is immediate.
+
+    Writes are batched in transactions, which are committed every commit_every
+    writes, or when calling commit() or close(). Reads always see the
+    uncommitted writes.
+
+    Queries are translated to SQL as much as possible (see _candidate_nodes):
+    the class of the nodes, the equality filters on literals and on linked
+    objects are all done by the database.
+
+    example:
+      g = SQLiteObjectGraph('library.sqlite')
+      g.Series(title = 'Monk')
+      g.find_all(Episode, series_title = 'Monk', season = 2)
+      g.close()
+    """
+    _object_node_class = SQLiteObjectNode
+
+    def __init__(self, filename = ':memory:', dynamic = False, commit_every = 1000):
+        super(SQLiteObjectGraph, self).__init__(dynamic)
+        self.filename = filename
+        self.commit_every = commit_every
+        self._db = sqlite3.connect(filename)
+        if filename != ':memory:':
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript(_SCHEMA)
+        # ids are given by the graph so that they start at 0 as for the other graphs,
+        # but AUTOINCREMENT still keeps track of the biggest id ever used
+        seq = self._execute("SELECT seq FROM sqlite_sequence WHERE name = 'nodes'").fetchone()
+        self._next_id = seq[0] + 1 if seq is not None else 0
+        self._writes = 0
+        self._cache = weakref.WeakValueDictionary()
+        self._classes = {}
+
+    def _execute(self, sql, params = ()):
+        return self._db.execute(sql, params)
+
+    def _write(self, sql, params = ()):
+        cursor = self._db.execute(sql, params)
+        self._writes += 1
+        if self._writes >= self.commit_every:
+            self.commit()
+        return cursor
+
+    def commit(self):
+        """Commit the current transaction."""
+        self._db.commit()
+        self._writes = 0
+
+    def close(self):
+        """Commit the current transaction and close the database."""
+        self.commit()
+        self._cache.clear()
+        self._db.close()
+
+    def _get_class(self, name):
+        cls = self._classes.get(name)
+        if cls is None:
+            cls = self._classes[name] = ontology.get_class(name)
+        return cls
+
+    def revalidate_objects(self):
+        # the cached classes might not be the current ones anymore
+        self._classes = {}
+        super(SQLiteObjectGraph, self).revalidate_objects()
+
+
+    ### Node methods
+
+    def _insert_node(self, classes, node_id = None):
+        """Insert a new node with the given classes in the database and return its id."""
+        if node_id is None:
+            node_id = self._next_id
+        try:
+            self._write('INSERT INTO nodes (id) VALUES (?)', (node_id,))
+        except sqlite3.IntegrityError:
+            raise ValueError('Node id %d is already used in graph %s' % (node_id, self))
+        self._next_id = max(self._next_id, node_id + 1)
+
+        for cls in classes:
+            self._write('INSERT INTO classes (node, class) VALUES (?, ?)', (node_id, cls.__name__))
+        return node_id
+
+    def clear(self):
+        for table in ('nodes', 'classes', 'literals', 'edges'):
+            self._write('DELETE FROM %s' % table)
+        for node in self._cache.values():
+            node.graph = None
+        self._cache.clear()
+
+    def create_node(self, props = [], _classes = set(), _id = None):
+        return self.__class__._object_node_class(self, props, _classes, _id)
+
+    def restore_node(self, node_id, props, _classes, trusted = False):
+        return self.create_node(props, _classes, _id = node_id)
+
+    def delete_node(self, node):
+        node.unlink_all()
+        for table in ('literals', 'classes'):
+            self._write('DELETE FROM %s WHERE node = ?' % table, (node._id,))
+        self._write('DELETE FROM nodes WHERE id = ?', (node._id,))
+        self._cache.pop(node._id, None)
+        node.graph = None
+
+    def add_directed_edge(self, node, name, other_node):
+        node.add_directed_edge(name, other_node)
+
+    def get_node(self, node_id):
+        node = self._cache.get(node_id)
+        if node is None:
+            if self._execute('SELECT 1 FROM nodes WHERE id = ?', (node_id,)).fetchone() is None:
+                raise KeyError('No node with id %d in graph %s' % (node_id, self))
+            node = self._cache[node_id] = self.__class__._object_node_class.from_id(self, node_id)
+        return node
+
+    def contains(self, node):
+        """Return whether this graph contains the given node (identity)."""
+        return (isinstance(node, SQLiteObjectNode) and
+                node.graph is not None and node.graph() is self and
+                self._cache.get(node._id) is node)
+
+    def _node_ids(self, sql, params, id_column, after = -1, limit = None):
+        """Return a generator over the distinct node ids returned by the given query,
+        in increasing order and starting after the given id, and at most limit of
+        them if limit is not None. The query is run in batches of FETCH_SIZE ids, so
+        that the graph can be modified while iterating over the results."""
+        sql = ('SELECT DISTINCT %s %s AND %s > ? ORDER BY %s LIMIT ?' %
+               (id_column, sql, id_column, id_column))
+        last = after
+        while limit is None or limit > 0:
+            size = FETCH_SIZE if limit is None else min(limit, FETCH_SIZE)
+            node_ids = [ node_id for node_id, in self._execute(sql, tuple(params) + (last, size)) ]
+            for node_id in node_ids:
+                yield node_id
+            if len(node_ids) < size:
+                return
+            last = node_ids[-1]
+            if limit is not None:
+                limit -= size
+
+    def scan_nodes(self, after = None):
+        after = after if after is not None else -1
+        for node_id in self._node_ids('FROM nodes n WHERE 1', (), 'n.id', after):
+            yield node_id, self.get_node(node_id)
+
+    def nodes(self):
+        for _, node in self.scan_nodes():
+            yield node
+
+    def nodes_from_class(self, cls):
+        return iter(self._candidate_nodes(cls, {})[0])
+
+
+    ### Query methods
+
+    def _filter_join(self, alias, id_column, prop, value):
+        """Return a tuple (join clause, params, exact) for the given filter, or None if
+        it can't be expressed in SQL. exact is False when the SQL condition might
+        also match some nodes which don't match the filter (chained filters which
+        follow a link that points to multiple nodes), in which case it still needs
+        to be checked on the resulting nodes."""
+        if isinstance(value, BaseObject):
+            value = value.node
+
+        if isinstance(value, SQLiteObjectNode):
+            if not self.contains(value):
+                return None
+        elif type(value) in (unicode, int, long, float):
+            ltype, value = to_sql(value)
+            if ltype == T_BIGINT:
+                return None
+            # values of other types (eg: Language) might compare equal to it, but
+            # can't be compared in SQL
+            if self._execute('SELECT 1 FROM literals WHERE name = ? AND type = ? LIMIT 1',
+                             (prop.split('_')[-1], T_PICKLE)).fetchone() is not None:
+                return None
+        else:
+            return None
+
+        path = prop.split('_')
+        joins, params = [], []
+        current = id_column
+        for i, name in enumerate(path[:-1]):
+            joins.append('JOIN edges %s_%d ON %s_%d.node = %s AND %s_%d.name = ?' %
+                         (alias, i, alias, i, current, alias, i))
+            params.append(name)
+            current = '%s_%d.other' % (alias, i)
+
+        if isinstance(value, SQLiteObjectNode):
+            joins.append('JOIN edges %s ON %s.node = %s AND %s.name = ? AND %s.other = ?' %
+                         (alias, alias, current, alias, alias))
+            params += [ path[-1], value._id ]
+        else:
+            types = (T_UNICODE,) if type(value) is unicode else (T_INT, T_LONG, T_FLOAT)
+            joins.append('JOIN literals %s ON %s.node = %s AND %s.name = ? AND %s.type IN (%s) AND %s.value = ?' %
+                         (alias, alias, current, alias, alias, ', '.join(str(t) for t in types), alias))
+            params += [ path[-1], value ]
+
+        return ' '.join(joins), params, len(path) == 1
+
+    def _candidate_nodes(self, node_type, filters, limit = None):
+        """Translate the class of the nodes and the equality filters on literals and linked
+        objects into a SQL query. Only the filters that couldn't be translated exactly
+        are returned as remaining filters. The nodes can be counted in SQL, and the limit
+        is applied in SQL too when there are no remaining filters."""
+        filters = dict(filters)
+
+        if node_type is None:
+            base, where, params, id_column = 'FROM nodes n', [], [], 'n.id'
+        else:
+            classes = node_type if isinstance(node_type, tuple) else (node_type,)
+            base = 'FROM classes c'
+            where = [ 'c.class IN (%s)' % ', '.join('?' * len(classes)) ]
+            params = [ cls.__name__ for cls in classes ]
+            id_column = 'c.node'
+
+        joins, join_params = [], []
+        for i, (prop, value) in enumerate(sorted(filters.items())):
+            join = self._filter_join('f%d' % i, id_column, prop, value)
+            if join is None:
+                continue
+            clause, clause_params, exact = join
+            joins.append(clause)
+            join_params += clause_params
+            if exact:
+                del filters[prop]
+
+        sql = ' '.join([ base ] + joins + [ 'WHERE', ' AND '.join(where) or '1' ])
+        if filters:
+            limit = None
+        return _QueryNodes(self, sql, join_params + params, id_column, limit), filters
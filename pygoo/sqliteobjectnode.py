@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pygoo.objectnode import ObjectNode
+from pygoo.snapshot import (T_NONE, T_INT, T_LONG, T_BIGINT, T_FLOAT, T_UNICODE, T_PICKLE,
+                            _MIN_LONG, _MAX_LONG)
+from pygoo import ontology
+import cPickle as pickle
+import collections
+import weakref
+import sqlite3
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def to_sql(value):
+    """Return a tuple (type, value) where value is the representation of the given
+    literal value that can be stored in a SQLite column, and type one of the
+    literal types defined in pygoo.snapshot."""
+    t = type(value)
+    if value is None:
+        return T_NONE, None
+    elif t is unicode:
+        return T_UNICODE, value
+    elif t is int or t is long:
+        if _MIN_LONG <= value <= _MAX_LONG:
+            return (T_INT if t is int else T_LONG), value
+        return T_BIGINT, unicode(value)
+    elif t is float:
+        return T_FLOAT, value
+    else:
+        return T_PICKLE, sqlite3.Binary(pickle.dumps(value, 2))
+
+def from_sql(ltype, value):
+    """Return the literal value corresponding to the given SQLite type and value (see to_sql)."""
+    if ltype == T_UNICODE or ltype == T_FLOAT or ltype == T_NONE:
+        return value
+    elif ltype == T_INT:
+        return int(value)
+    elif ltype == T_LONG or ltype == T_BIGINT:
+        return long(value)
+    elif ltype == T_PICKLE:
+        return pickle.loads(str(value))
+    else:
+        raise ValueError('Invalid literal type in database: %d' % ltype)
+
+
+class SQLiteObjectNode(ObjectNode):
+    """Implementation of an object node stored in a SQLite database (see SQLiteObjectGraph).
+
+    A node only holds its id. Its classes and literals are read from the database
+    the first time they are accessed and then cached, as all the modifications go
+    through the node itself. Edges are not cached and are read from the database
+    each time they are accessed.
+    """
+
+    def __init__(self, graph, props = [], _classes = None, _id = None):
+        self._classes = set(_classes) if _classes is not None else set()
+        self._literals = {}
+        self._id = graph._insert_node(self._classes, _id)
+        graph._cache[self._id] = self
+        super(SQLiteObjectNode, self).__init__(graph, props)
+
+    @classmethod
+    def from_id(cls, graph, node_id):
+        """Return the node object for a node which already exists in the database."""
+        node = cls.__new__(cls)
+        node._id = node_id
+        node._classes = None
+        node._literals = None
+        node.graph = weakref.ref(graph)
+        return node
+
+    def __eq__(self, other):
+        return (isinstance(other, SQLiteObjectNode) and
+                self._id == other._id and
+                self.graph() is other.graph())
+
+    def __hash__(self):
+        return hash(self._id)
+
+    def __setattr__(self, name, value):
+        if name in [ '_id', '_classes', '_literals' ]:
+            object.__setattr__(self, name, value)
+        else:
+            super(SQLiteObjectNode, self).__setattr__(name, value)
+
+    def _execute(self, sql, params):
+        return self.graph()._execute(sql, params)
+
+    def _write(self, sql, params):
+        return self.graph()._write(sql, params)
+
+
+    def node_id(self):
+        return self._id
+
+
+    ### Ontology methods
+
+    def classes(self):
+        if self._classes is None:
+            get_class = self.graph()._get_class
+            self._classes = set(get_class(name) for name, in
+                                self._execute('SELECT class FROM classes WHERE node = ?', (self._id,)))
+        return self._classes
+
+    def isinstance(self, cls):
+        return cls in self.classes()
+
+    def add_class(self, cls):
+        if cls not in self.classes():
+            self._classes.add(cls)
+            self._write('INSERT INTO classes (node, class) VALUES (?, ?)', (self._id, cls.__name__))
+
+    def remove_class(self, cls):
+        self.classes().remove(cls)
+        self._write('DELETE FROM classes WHERE node = ? AND class = ?', (self._id, cls.__name__))
+
+    def clear_classes(self):
+        self._classes = set()
+        self._write('DELETE FROM classes WHERE node = ?', (self._id,))
+
+    def update_valid_classes(self):
+        if self.graph()._dynamic:
+            classes = set(cls for cls in ontology._classes.values() if self.is_valid_instance(cls))
+            current = self.classes()
+            for cls in current - classes:
+                self.remove_class(cls)
+            for cls in classes - current:
+                self.add_class(cls)
+
+
+    ### Accessing literal properties
+
+    def _props(self):
+        if self._literals is None:
+            self._literals = dict((name, from_sql(ltype, value)) for name, ltype, value in
+                                  self._execute('SELECT name, type, value FROM literals WHERE node = ?',
+                                                (self._id,)))
+        return self._literals
+
+    def get_literal(self, name):
+        try:
+            return self._props()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def set_literal(self, name, value):
+        ltype, svalue = to_sql(value)
+        self._write('INSERT OR REPLACE INTO literals (node, name, type, value) VALUES (?, ?, ?, ?)',
+                    (self._id, name, ltype, svalue))
+        self._props()[name] = value
+
+    def del_literal(self, name):
+        props = self._props()
+        if name not in props:
+            raise AttributeError(name)
+        self._write('DELETE FROM literals WHERE node = ? AND name = ?', (self._id, name))
+        del props[name]
+
+    def literal_keys(self):
+        return iter(self._props().keys())
+
+    def literal_values(self):
+        return iter(self._props().values())
+
+    def literal_items(self):
+        return iter(self._props().items())
+
+
+    ### Accessing edge properties
+
+    def add_directed_edge(self, name, other_node):
+        self._write('INSERT INTO edges (node, name, other) VALUES (?, ?, ?)',
+                    (self._id, name, other_node._id))
+
+    def remove_directed_edge(self, name, other_node):
+        # only remove one of the edges if there are multiple ones, as for MemoryObjectNode
+        cursor = self._write('DELETE FROM edges WHERE id = (SELECT id FROM edges WHERE '
+                             'node = ? AND name = ? AND other = ? ORDER BY id LIMIT 1)',
+                             (self._id, name, other_node._id))
+        if cursor.rowcount == 0:
+            raise ValueError('Node %d has no edge %s to node %d' % (self._id, name, other_node._id))
+
+    def _endpoints(self, node_ids):
+        get_node = self.graph().get_node
+        for node_id in node_ids:
+            yield get_node(node_id)
+
+    def _edges(self):
+        """Return an ordered dict of edge name to the list of pointed node ids."""
+        edges = collections.OrderedDict()
+        for name, other_id in self._execute('SELECT name, other FROM edges WHERE node = ? ORDER BY id',
+                                            (self._id,)):
+            edges.setdefault(name, []).append(other_id)
+        return edges
+
+    def _edge_ids(self, name):
+        return [ other_id for other_id, in
+                 self._execute('SELECT other FROM edges WHERE node = ? AND name = ? ORDER BY id',
+                               (self._id, name)) ]
+
+    def outgoing_edge_endpoints(self, name = None):
+        if name is None:
+            return self._endpoints(node_id for node_ids in self._edges().values()
+                                           for node_id in node_ids)
+        if name in self._props():
+            raise AttributeError(name)
+        return self._endpoints(self._edge_ids(name))
+
+    def edge_keys(self):
+        return iter(self._edges().keys())
+
+    def edge_values(self):
+        return (self._endpoints(v) for v in self._edges().values())
+
+    def edge_items(self):
+        return ((k, self._endpoints(v)) for k, v in self._edges().items())
+
+
+    # The next methods are overriden for efficiency, see MemoryObjectNode
+
+    def keys(self):
+        return self._props().keys() + self._edges().keys()
+
+    def get(self, name, default=None):
+        props = self._props()
+        if name in props:
+            return props[name]
+        return self._endpoints(self._edge_ids(name))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Compare the binary snapshots with the pickle files written by previous versions
+of PyGoo, when saving and loading a graph.
+
+usage: PYTHONPATH=. python tests/benchmark_snapshot.py [number of series]
+
+Each series has 200 episodes. Times are the best of 3 runs, and the memory is the
+increase of the peak RSS of a separate process while it saves the graph (Linux only).
+"""
+
+from __future__ import unicode_literals
+from pygootest import *
+from pygoo import snapshot
+import cPickle as pickle
+import subprocess
+import resource
+import tempfile
+import shutil
+import time
+import sys
+
+
+def create_graph(nseries):
+    g = MemoryObjectGraph()
+    for s in range(nseries):
+        series = g.Series(title = 'Series %d' % s, rating = s / 10.)
+        for e in range(200):
+            g.Episode(series = series, season = e // 20 + 1, episodeNumber = e % 20 + 1,
+                      title = 'Episode %d' % e)
+    return g
+
+def save_pickle(g, filename):
+    # this is how AbstractDirectedGraph.save used to write graphs
+    with open(filename, 'w') as f:
+        pickle.dump(g.to_nodes_and_edges(), f)
+
+def save_snapshot(g, filename):
+    with open(filename, 'wb') as f:
+        snapshot.write_snapshot(g, f)
+
+def best_time(func, *args):
+    result = None
+    for _ in range(3):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        result = min(result, elapsed) if result is not None else elapsed
+    return result
+
+def peak_memory(nseries, fmt):
+    """Return the increase of the peak RSS (in MB) of a new process when it saves
+    the graph in the given format."""
+    return float(subprocess.check_output([ sys.executable, __file__, str(nseries), '--memory', fmt ]))
+
+
+if __name__ == '__main__':
+    nseries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    if '--memory' not in sys.argv:
+        # the peak RSS is kept across exec(), so this needs to be done before the
+        # graph is created in this process
+        memory = dict((fmt, peak_memory(nseries, fmt)) for fmt in [ 'pickle', 'snapshot' ])
+
+    g = create_graph(nseries)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filenames = { 'pickle': os.path.join(tmpdir, 'graph.pickle'),
+                      'snapshot': os.path.join(tmpdir, 'graph.db') }
+        save = { 'pickle': save_pickle, 'snapshot': save_snapshot }
+
+        if '--memory' in sys.argv:
+            fmt = sys.argv[sys.argv.index('--memory') + 1]
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            save[fmt](g, filenames[fmt])
+            print (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024.
+            sys.exit(0)
+
+        print 'Graph with %d nodes' % len(list(g.nodes()))
+        print '%-10s %10s %10s %10s %12s' % ('', 'save (s)', 'load (s)', 'size (MB)', 'memory (MB)')
+        for fmt in [ 'pickle', 'snapshot' ]:
+            save_time = best_time(save[fmt], g, filenames[fmt])
+            load_time = best_time(MemoryObjectGraph().load, filenames[fmt])
+            size = os.path.getsize(filenames[fmt]) / 1024. / 1024
+            print '%-10s %10.2f %10.2f %10.1f %12.1f' % (fmt, save_time, load_time, size, memory[fmt])
+    finally:
+        shutil.rmtree(tmpdir)
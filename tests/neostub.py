@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""A local stub of the Cypher transactional endpoint of Neo4j, for testing the
+Neo4j backend without a Neo4j server.
+
+It doesn't understand Cypher: it only recognizes the statements generated by
+pygoo.neo4jobjectgraph, and executes them on an in-memory graph. All the requests
+received are recorded, so that tests can check which statements have been sent.
+"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import collections
+import threading
+import socket
+import copy
+import json
+import re
+
+
+class CypherError(Exception):
+    def __init__(self, code, message):
+        super(CypherError, self).__init__(message)
+        self.code = code
+
+
+def _labels(s):
+    return re.findall(r'`([^`]+)`', s)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        self.connections.append(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def close_connections(self):
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class Neo4jStub(object):
+    """Serve the stub on a random local port. Its URL is in the url attribute.
+
+    example:
+      stub = Neo4jStub()
+      g = Neo4jObjectGraph(stub.url)
+      ...
+      stub.stop()
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.rels = collections.OrderedDict()
+        self.sequence = None
+        self.constraints = set()
+        self.indexes = set()
+        self._next_id = 0
+
+        # list of the statements of each request, as (query, params) pairs
+        self.requests = []
+        # number of the next requests which are executed, but whose connection is
+        # then closed without sending the response
+        self.drop_responses = 0
+        self._lock = threading.Lock()
+
+        self._handlers = [
+            (r'CREATE CONSTRAINT ON \(n:`?([^`]+?)`?\) ASSERT n\.`?([^`]+?)`? IS UNIQUE$', self.create_constraint),
+            (r'CREATE INDEX ON :`([^`]+)`\(`([^`]+)`\)$', self.create_index),
+            (r'MERGE \(n:PyGoo:`([^`]+)` \{(.*)\}\) ON CREATE SET n \+= \{props\}((?:, n(?::`[^`]+`)+)?) '
+             r'RETURN n\._id, labels\(n\), n$', self.merge_node),
+            (r'MERGE \(s:PyGooSequence\) .* RETURN s\.next$', self.reserve_ids),
+            (r'UNWIND \{rows\} AS row CREATE \(n:PyGoo((?::`[^`]+`)*)\) SET n = row\.props$', self.create_nodes),
+            (r'UNWIND \{rows\} AS row MATCH \(n:PyGoo \{_id: row\.id\}\) SET n = row\.props$', self.update_nodes),
+            (r'UNWIND \{ids\} AS id MATCH \(n:PyGoo \{_id: id\}\) (SET|REMOVE) n:`([^`]+)`$', self.change_label),
+            (r'UNWIND \{rows\} AS row MATCH \(a:PyGoo \{_id: row\.source\}\), \(b:PyGoo \{_id: row\.target\}\) '
+             r'CREATE \(a\)-\[r?:`([^`]+)`\]->\(b\)(?: RETURN id\(r\))?$', self.add_edges),
+            (r'UNWIND \{ids\} AS id MATCH \(\)-\[r\]->\(\) WHERE id\(r\) = id DELETE r$', self.remove_edges),
+            (r'UNWIND \{ids\} AS id MATCH \(n:PyGoo \{_id: id\}\) OPTIONAL MATCH \(n\)-\[r\]-\(\) DELETE r, n$', self.delete_nodes),
+            (r'MATCH \(n:PyGoo\) OPTIONAL MATCH \(n\)-\[r\]-\(\) DELETE r, n$', self.delete_all),
+            (r'MATCH \(n:PyGoo \{_id: \{id\}\}\) RETURN labels\(n\), n$', self.get_node),
+            (r'MATCH \(n:PyGoo \{_id: \{id\}\}\)-\[r\]->\(m:PyGoo\) '
+             r'RETURN type\(r\), id\(r\), m\._id ORDER BY id\(r\)$', self.get_edges),
+            (r'UNWIND \{ids\} AS id MATCH \(n:PyGoo \{_id: id\}\)-\[r\]->\(m:PyGoo\) '
+             r'RETURN n\._id, type\(r\), id\(r\), m\._id ORDER BY id\(r\)$', self.prefetch_edges),
+            (r'UNWIND \{ids\} AS id MATCH \(n:PyGoo \{_id: id\}\)-\[r\]->\(m:PyGoo\) WHERE type\(r\) IN \{names\} '
+             r'RETURN DISTINCT m\._id, labels\(m\), m$', self.prefetch_nodes),
+            (r'MATCH \(n:PyGoo((?::`[^`]+`)?)\) WHERE (.*)n\._id > \{after\} '
+             r'RETURN n\._id, labels\(n\), n ORDER BY n\._id LIMIT \{limit\}$', self.match_nodes),
+            ]
+
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            wbufsize = -1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with stub._lock:
+                    response = json.dumps(stub.handle(json.loads(body)))
+                    drop = stub.drop_responses > 0
+                    if drop:
+                        stub.drop_responses -= 1
+                if drop:
+                    self.close_connection = True
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/db/data/' % self._server.server_address[1]
+        self._thread = threading.Thread(target = self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+
+    def close_connections(self):
+        """Close the connections of the clients, as the server does for idle connections."""
+        self._server.close_connections()
+
+    def queries(self):
+        """Return the list of all the queries received, in order."""
+        return [ query for statements in self.requests for query, params in statements ]
+
+
+    ### Request handling
+
+    def handle(self, request):
+        statements = [ (s['statement'], s.get('parameters') or {}) for s in request['statements'] ]
+        self.requests.append(statements)
+
+        # statements are executed on a copy of the data, which is only kept if all of
+        # them succeed
+        saved = copy.deepcopy((self.nodes, self.rels, self.sequence, self._next_id))
+        try:
+            results = [ self.execute(query, params) for query, params in statements ]
+            self.check_constraints()
+        except CypherError, e:
+            self.nodes, self.rels, self.sequence, self._next_id = saved
+            return { 'results': [], 'errors': [ { 'code': e.code, 'message': unicode(e) } ] }
+
+        return { 'results': [ { 'columns': [], 'data': [ { 'row': row } for row in rows ] }
+                              for rows in results ],
+                 'errors': [] }
+
+    def execute(self, query, params):
+        for regexp, handler in self._handlers:
+            m = re.match(regexp, query)
+            if m:
+                return handler(params, *m.groups()) or []
+        raise CypherError('Neo.ClientError.Statement.InvalidSyntax', 'Unsupported statement: %s' % query)
+
+
+    ### Data access
+
+    def find(self, node_id):
+        """Return the internal id of the PyGoo node with the given _id, or None."""
+        for iid, node in self.nodes.items():
+            if 'PyGoo' in node['labels'] and node['props'].get('_id') == node_id:
+                return iid
+        return None
+
+    def node_ids(self, label = 'PyGoo'):
+        return sorted(node['props']['_id'] for node in self.nodes.values() if label in node['labels'])
+
+    def edges(self, node_id):
+        iid = self.find(node_id)
+        return [ (rtype, self.nodes[end]['props']['_id'])
+                 for rid, (start, rtype, end) in self.rels.items() if start == iid ]
+
+
+    ### Statement handlers
+
+    def check_constraints(self):
+        for label, prop in self.constraints:
+            values = [ node['props'][prop] for node in self.nodes.values()
+                       if label in node['labels'] and prop in node['props'] ]
+            if len(set(values)) != len(values):
+                raise CypherError('Neo.ClientError.Schema.ConstraintViolation',
+                                  'Node already exists with label %s and property "%s"' % (label, prop))
+
+    def create_constraint(self, params, label, prop):
+        self.constraints.add((label, prop))
+
+    def create_index(self, params, label, prop):
+        self.indexes.add((label, prop))
+
+    def merge_node(self, params, label, keys, labels):
+        keys = dict((prop, params[param]) for prop, param in re.findall(r'`([^`]+)`: \{(\w+)\}', keys))
+        for iid, node in self.nodes.items():
+            if (set([ 'PyGoo', label ]) <= node['labels'] and
+                all(node['props'].get(prop) == value for prop, value in keys.items())):
+                break
+        else:
+            iid = self._next_id
+            self._next_id += 1
+            self.nodes[iid] = { 'labels': set([ 'PyGoo', label ] + _labels(labels)),
+                                'props': dict(params['props']) }
+        node = self.nodes[iid]
+        return [ [ node['props']['_id'], sorted(node['labels']), node['props'] ] ]
+
+    def reserve_ids(self, params):
+        current = self.sequence or 0
+        self.sequence = max(current, params['min']) + params['count']
+        return [ [ self.sequence ] ]
+
+    def create_nodes(self, params, labels):
+        labels = set([ 'PyGoo' ] + _labels(labels))
+        for row in params['rows']:
+            props = dict(row['props'])
+            if self.find(props['_id']) is not None:
+                raise CypherError('Neo.ClientError.Schema.ConstraintViolation',
+                                  'Node already exists with label PyGoo and property "_id"=[%s]' % props['_id'])
+            self.nodes[self._next_id] = { 'labels': set(labels), 'props': props }
+            self._next_id += 1
+
+    def update_nodes(self, params):
+        for row in params['rows']:
+            iid = self.find(row['id'])
+            if iid is not None:
+                self.nodes[iid]['props'] = dict(row['props'])
+
+    def change_label(self, params, action, label):
+        for node_id in params['ids']:
+            iid = self.find(node_id)
+            if iid is None:
+                continue
+            if action == 'SET':
+                self.nodes[iid]['labels'].add(label)
+            else:
+                self.nodes[iid]['labels'].discard(label)
+
+    def add_edges(self, params, rtype):
+        result = []
+        for row in params['rows']:
+            start, end = self.find(row['source']), self.find(row['target'])
+            if start is not None and end is not None:
+                self.rels[self._next_id] = (start, rtype, end)
+                result.append([ self._next_id ])
+                self._next_id += 1
+        return result
+
+    def remove_edges(self, params):
+        for rid in params['ids']:
+            self.rels.pop(rid, None)
+
+    def _delete(self, iids):
+        for rid, (start, rtype, end) in self.rels.items():
+            if start in iids or end in iids:
+                del self.rels[rid]
+        for iid in iids:
+            del self.nodes[iid]
+
+    def delete_nodes(self, params):
+        self._delete(set(iid for iid in (self.find(node_id) for node_id in params['ids'])
+                         if iid is not None))
+
+    def delete_all(self, params):
+        self._delete(set(iid for iid, node in self.nodes.items() if 'PyGoo' in node['labels']))
+
+    def get_node(self, params):
+        iid = self.find(params['id'])
+        if iid is None:
+            return []
+        node = self.nodes[iid]
+        return [ [ sorted(node['labels']), node['props'] ] ]
+
+    def get_edges(self, params):
+        iid = self.find(params['id'])
+        return [ [ rtype, rid, self.nodes[end]['props']['_id'] ]
+                 for rid, (start, rtype, end) in self.rels.items() if start == iid ]
+
+    def prefetch_edges(self, params):
+        iids = set(self.find(node_id) for node_id in params['ids'])
+        return [ [ self.nodes[start]['props']['_id'], rtype, rid, self.nodes[end]['props']['_id'] ]
+                 for rid, (start, rtype, end) in sorted(self.rels.items()) if start in iids ]
+
+    def prefetch_nodes(self, params):
+        iids = set(self.find(node_id) for node_id in params['ids'])
+        ends = set(end for start, rtype, end in self.rels.values()
+                   if start in iids and rtype in params['names'])
+        return [ [ self.nodes[end]['props']['_id'] ] + self.get_node({ 'id': self.nodes[end]['props']['_id'] })[0]
+                 for end in sorted(ends) ]
+
+    def _condition(self, condition, params):
+        """Return a function telling whether a node (internal id) matches the given
+        condition of a WHERE clause."""
+        m = re.match(r'\((n:`[^`]+`(?: OR n:`[^`]+`)*)\)$', condition)
+        if m:
+            labels = set(_labels(m.group(1)))
+            return lambda iid: bool(labels & self.nodes[iid]['labels'])
+
+        m = re.match(r'n\.`([^`]+)` = \{(\w+)\}$', condition)
+        if m:
+            prop, value = m.group(1), params[m.group(2)]
+            return lambda iid: self.nodes[iid]['props'].get(prop) == value
+
+        m = re.match(r'\(n\)((?:-\[:`[^`]+`\]->\(\))*-\[:`[^`]+`\]->)'
+                     r'\((?::PyGoo \{_id: |\{`([^`]+)`: )\{(\w+)\}\}\)$', condition)
+        if m:
+            hops, prop, value = _labels(m.group(1)), m.group(2) or '_id', params[m.group(3)]
+            def match(iid):
+                current = set([ iid ])
+                for name in hops:
+                    current = set(end for start, rtype, end in self.rels.values()
+                                  if start in current and rtype == name)
+                return any(self.nodes[other]['props'].get(prop) == value for other in current)
+            return match
+
+        raise CypherError('Neo.ClientError.Statement.InvalidSyntax', 'Unsupported condition: %s' % condition)
+
+    def match_nodes(self, params, label, conditions):
+        conditions = [ self._condition(c, params) for c in conditions.split(' AND ') if c ]
+        label = _labels(label)[0] if label else 'PyGoo'
+        result = []
+        for node_id in self.node_ids(label):
+            iid = self.find(node_id)
+            if node_id > params['after'] and all(c(iid) for c in conditions):
+                result.append([ node_id ] + self.get_node({ 'id': node_id })[0])
+        return result[:params['limit']]
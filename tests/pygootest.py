@@ -18,6 +18,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from __future__ import unicode_literals
 from unittest import *
 from pygoo import *
 from pygoo import ontology
@@ -39,3 +40,28 @@ logging.getLogger('guessit.language').setLevel(logging.WARNING)
 
 def allTests(testClass):
     return TestLoader().loadTestsFromTestCase(testClass)
+
+
+class GraphTestCase(TestCase):
+    """Base class for the tests which compare whole graphs, with a small media
+    library to fill them with."""
+
+    def assertSameGraph(self, g1, g2):
+        """Assert that both graphs have the same nodes (with their ids), edges and classes."""
+        def normalized(g):
+            nodes, edges, classes = g.to_nodes_and_edges()
+            return (dict((k, sorted(v)) for k, v in nodes.items()),
+                    sorted(edges),
+                    dict((k, sorted(v)) for k, v in classes.items()))
+        self.assertEqual(normalized(g1), normalized(g2))
+
+    def createData(self, g):
+        monk = g.Series(title = 'Monk')
+        wire = g.Series(title = 'The Wire', rating = 9.5)
+        for season in range(1, 3):
+            for epnum in range(1, 4):
+                ep = g.Episode(series = monk, season = season, episodeNumber = epnum)
+                g.File(video = ep, filename = 'Monk.%dx%02d.avi' % (season, epnum))
+        ep = g.Episode(series = wire, season = 2, episodeNumber = 1, title = 'Ebb Tide')
+        sub = g.Subtitle(video = ep, language = 'en')
+        g.File(subtitle = sub, filename = 'The Wire.2x01.en.srt', filesize = 2**70)
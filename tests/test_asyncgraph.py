@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+from neostub import Neo4jStub
+
+from pygoo.asyncgraph import AsyncGraph, AsyncObject
+from pygoo.neo4jobjectgraph import Neo4jObjectGraph
+from pygoo.sqliteobjectgraph import SQLiteObjectGraph
+import threading
+
+class TestAsyncGraph(TestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+
+    def createData(self, g):
+        monk = g.Series(title = 'Monk')
+        for season in range(1, 3):
+            for epnum in range(1, 6):
+                g.Episode(series = monk, season = season, episodeNumber = epnum)
+
+    def testQueries(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        ag = AsyncGraph(g)
+
+        done = threading.Event()
+        results = []
+        def on_episodes(episodes):
+            results.extend(ep.episodeNumber for ep in episodes)
+            done.set()
+
+        ag.afind_all(Episode, season = 2, callback = on_episodes)
+        done.wait(10)
+        self.assertEqual(sorted(results), range(1, 6))
+
+        ep = ag.afind_one(Episode, season = 1, episodeNumber = 3).get(10)
+        self.assertEqual(ep.series.title, 'Monk')
+        self.assertRaises(ValueError, ag.afind_one(Episode, season = 3).get, 10)
+
+        # operations are executed in the worker thread, one at a time
+        threads = [ ag.apply(threading.current_thread).get(10) for i in range(3) ]
+        self.assert_(threads[0] is threads[1] is threads[2])
+        self.assert_(threads[0] is not threading.current_thread())
+        ag.close()
+
+    def testProxies(self):
+        touched = []
+        class Probe(BaseObject):
+            schema = { 'name': unicode }
+            valid = [ 'name' ]
+
+            def touch(self):
+                touched.append(threading.current_thread())
+                return self.name
+
+        g = MemoryObjectGraph()
+        self.createData(g)
+        g.Probe(name = 'probe')
+        ag = AsyncGraph(g)
+        worker = ag.apply(threading.current_thread).get(10)
+
+        # the properties and methods of the returned objects are accessed in the worker
+        probe = ag.afind_one(Probe).get(10)
+        self.assert_(isinstance(probe, AsyncObject))
+        self.assertEqual(probe.touch(), 'probe')
+        self.assertEqual(touched, [ worker ])
+
+        ep = ag.afind_one(Episode, season = 1, episodeNumber = 3).get(10)
+        series = ep.series
+        self.assert_(isinstance(series, AsyncObject))
+        self.assertEqual(sorted(e.episodeNumber for e in series.episodes), sorted(range(1, 6) * 2))
+        self.assertEqual(series, ag.afind_one(Series).get(10))
+        self.assertEqual(len(ag.afind_all(Episode, series = series).get(10)), 10)
+        self.assertEqual(str(ep), str(g.find_one(Episode, season = 1, episodeNumber = 3)))
+
+        # and are modified in the worker too
+        ep.title = 'Mr. Monk and the Candidate'
+        self.assertEqual(g.find_one(Episode, season = 1, episodeNumber = 3).title, 'Mr. Monk and the Candidate')
+
+        # callbacks are called in the worker, where the proxies access the objects directly
+        seen = []
+        def on_episodes(episodes):
+            seen.extend((threading.current_thread(), ep.episodeNumber) for ep in episodes)
+        ag.afind_all(Episode, season = 2, callback = on_episodes).get(10)
+        self.assertEqual(sorted(seen), [ (worker, n) for n in range(1, 6) ])
+        ag.close()
+
+    def testStream(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        ag = AsyncGraph(g)
+
+        stream = ag.stream(g.query(Episode).values('episodeNumber'), batch_size = 3)
+        self.assertEqual(len(stream.next_batch().get(10)), 3)
+        self.assertEqual(len(list(stream)), 7)
+        self.assertEqual(stream.next_batch().get(10), [])
+
+        numbers = list(n for n, in ag.stream(g.query(Episode, season = 1).values('episodeNumber'), batch_size = 2))
+        self.assertEqual(sorted(numbers), range(1, 6))
+        ag.close()
+
+    def testWrite(self):
+        # the SQLite graph is created in the worker, which is the only thread using it
+        ag = AsyncGraph(lambda: SQLiteObjectGraph(':memory:'))
+        ag.awrite(self.createData).get(10)
+        self.assertEqual(ag.apply(lambda: len(ag.graph.find_all(Episode))).get(10), 10)
+        ag.close()
+
+        stub = Neo4jStub()
+        try:
+            g = Neo4jObjectGraph(stub.url)
+            ag = AsyncGraph(g)
+            writes = lambda: [ r for r in stub.requests if any(q.startswith('UNWIND') for q, params in r) ]
+            ag.awrite(self.createData).get(10)
+            # all the writes are sent in a single request
+            self.assertEqual(len(writes()), 1)
+            self.assertEqual(len(stub.node_ids('Episode')), 10)
+
+            titles = ag.apply(lambda: [ s.title for s in g.find_all(Series) ]).get(10)
+            self.assertEqual(titles, [ 'Monk' ])
+            ag.close()
+        finally:
+            stub.stop()
+
+
+suite = allTests(TestAsyncGraph)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
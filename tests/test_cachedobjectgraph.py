@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+from neostub import Neo4jStub
+
+from pygoo.cachedobjectgraph import CachedObjectGraph
+from pygoo.sqliteobjectgraph import SQLiteObjectGraph
+from pygoo.neo4jobjectgraph import Neo4jObjectGraph
+
+class TestCachedObjectGraph(GraphTestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+
+    def testBasicGraph(self):
+        for backend in [ MemoryObjectGraph(), SQLiteObjectGraph(':memory:') ]:
+            g = CachedObjectGraph(backend, flush_every = None)
+            mg = MemoryObjectGraph()
+            self.createData(g)
+            self.createData(mg)
+            self.assertSameGraph(g, mg)
+            self.assertSameGraph(backend, mg)
+
+            ep = g.find_one(Episode, series_title = 'The Wire')
+            self.assertEqual(ep.series.rating, 9.5)
+            self.assertEqual(ep.subtitle.language, 'en')
+            self.assertEqual(len(g.find_all(Episode, series = g.find_one(Series, title = 'Monk'))), 6)
+            self.assert_(ep.node in g)
+            self.assert_(ep.node not in backend)
+
+            # another cache over the same backend sees the same data
+            self.assertSameGraph(CachedObjectGraph(backend), mg)
+
+    def testReadThrough(self):
+        backend = MemoryObjectGraph()
+        self.createData(backend)
+        g = CachedObjectGraph(backend, cache_size = 5)
+
+        series = g.find_one(Series, title = 'Monk')
+        self.assertEqual((g.hits, g.misses), (0, 1))
+        self.assertEqual(g.find_one(Series, title = 'Monk'), series)
+        self.assertEqual((g.hits, g.misses), (1, 1))
+
+        # the episodes are loaded when following the links, and evict the series
+        self.assertEqual(sorted(ep.episodeNumber for ep in series.episodes), [ 1, 1, 2, 2, 3, 3 ])
+        self.assertEqual(g.misses, 7)
+        self.assertEqual(len(g._cache), 5)
+        self.assert_(series.node._literals is None)
+
+        # evicted nodes are read again from the backend when accessed
+        self.assertEqual(series.title, 'Monk')
+        self.assertEqual(g.misses, 8)
+        self.assert_(g.find_one(Series, title = 'Monk').node is series.node)
+
+    def testWriteBack(self):
+        backend = MemoryObjectGraph()
+        self.createData(backend)
+        g = CachedObjectGraph(backend, cache_size = 3, flush_every = None)
+
+        wire = g.find_one(Series, title = 'The Wire')
+        sub = g.find_one(Subtitle, language = 'en')
+        wire.rating = 9.8
+        del wire.rating
+        wire.rating = 9.9
+        ep = g.Episode(series = wire, season = 2, episodeNumber = 2, title = 'Collateral Damage')
+        g.delete_node(sub.node)
+
+        # the changes are only seen by the cache, and are kept when invalidating it
+        self.assert_(g.has_pending_changes())
+        self.assertEqual(backend.find_one(Series, title = 'The Wire').rating, 9.5)
+        self.assertEqual(len(backend.find_all(Subtitle)), 1)
+        g.invalidate()
+        self.assert_(not g._cache)
+        for ep2 in wire.episodes:
+            self.assertEqual(ep2.series.rating, 9.9)
+        self.assertEqual(ep.series.title, 'The Wire')
+
+        g.flush()
+        self.assert_(not g.has_pending_changes())
+        bwire = backend.find_one(Series, title = 'The Wire')
+        self.assertEqual(bwire.rating, 9.9)
+        self.assertEqual(sorted(e.title for e in bwire.episodes), [ 'Collateral Damage', 'Ebb Tide' ])
+        self.assert_(backend.find_one(Episode, title = 'Collateral Damage').node.isinstance(Episode))
+        self.assertEqual(len(backend.find_all(Subtitle)), 0)
+        self.assertSameGraph(g, backend)
+
+        # changes are written automatically after flush_every of them
+        g = CachedObjectGraph(backend, flush_every = 2)
+        wire = g.find_one(Series, title = 'The Wire')
+        wire.rating = 9.7
+        self.assertEqual(bwire.rating, 9.9)
+        wire.country = 'USA'
+        self.assertEqual((bwire.rating, bwire.country), (9.7, 'USA'))
+
+    def testBackgroundFlush(self):
+        backend = MemoryObjectGraph()
+        self.createData(backend)
+        g = CachedObjectGraph(backend, flush_every = 2, background_flush = True)
+        wire = g.find_one(Series, title = 'The Wire')
+        bwire = backend.find_one(Series, title = 'The Wire')
+
+        # block the flush thread, the graph can still be modified meanwhile
+        g._backend_lock.acquire()
+        try:
+            wire.rating = 9.7
+            wire.country = 'USA'
+            self.assert_(g._flush_thread.is_alive())
+            wire.rating = 9.8
+            self.assertEqual(bwire.rating, 9.5)
+        finally:
+            g._backend_lock.release()
+
+        # the changes are written as they were when the flush started
+        g.wait_flush()
+        self.assertEqual((bwire.rating, bwire.country), (9.7, 'USA'))
+        self.assert_(g.has_pending_changes())
+        self.assertEqual(wire.rating, 9.8)
+
+        # queries see all the changes
+        self.assertEqual(g.find_one(Series, rating = 9.8), wire)
+        self.assertEqual(bwire.rating, 9.8)
+        self.assert_(not g.has_pending_changes())
+
+    def testConcurrentFlush(self):
+        backend = MemoryObjectGraph()
+        self.createData(backend)
+        g = CachedObjectGraph(backend, flush_every = None)
+        wire = g.find_one(Series, title = 'The Wire')
+        wire.rating = 9.7
+
+        # simulate another thread modifying the graph while it is being flushed
+        get_node = backend.get_node
+        def modifying_get_node(node_id):
+            backend.get_node = get_node
+            wire.country = 'USA'
+            wire.rating = 9.8
+            return get_node(node_id)
+        backend.get_node = modifying_get_node
+        g.flush()
+
+        # the changes are not lost, but written by the next flush
+        bwire = backend.find_one(Series, title = 'The Wire')
+        self.assert_(g.has_pending_changes())
+        g.flush()
+        self.assertEqual((bwire.rating, bwire.country), (9.8, 'USA'))
+
+    def testInvalidate(self):
+        backend = MemoryObjectGraph()
+        self.createData(backend)
+        g = CachedObjectGraph(backend)
+
+        monk = g.find_one(Series, title = 'Monk')
+        wire = g.find_one(Series, title = 'The Wire')
+        backend.find_one(Series, title = 'Monk').rating = 8.5
+        backend.find_one(Series, title = 'The Wire').rating = 9.0
+        self.assert_('rating' not in monk.node.literal_keys())
+
+        g.invalidate(monk)
+        self.assertEqual(monk.rating, 8.5)
+        self.assertEqual(wire.rating, 9.5)
+
+        # nodes with pending changes are not invalidated
+        monk.rating = 7.0
+        g.invalidate()
+        self.assertEqual((monk.rating, wire.rating), (7.0, 9.0))
+
+    def testNeo4jBackend(self):
+        stub = Neo4jStub()
+        try:
+            backend = Neo4jObjectGraph(stub.url)
+            self.createData(backend)
+            g = CachedObjectGraph(backend, flush_every = None)
+
+            titles = sorted(ep.series.title for ep in g.find_all(Episode, season = 2))
+            self.assertEqual(titles, [ 'Monk' ] * 3 + [ 'The Wire' ])
+            requests = len(stub.requests)
+            self.assertEqual(sorted(ep.series.title for ep in g.find_all(Episode, season = 2)), titles)
+            # only the query itself was sent, all the nodes were in the cache
+            self.assertEqual(len(stub.requests), requests + 1)
+
+            for ep in g.find_all(Episode, season = 1):
+                ep.title = 'Episode %d' % ep.episodeNumber
+            requests = len(stub.requests)
+            g.flush()
+            self.assertEqual(len(stub.requests), requests + 1)
+            self.assertEqual(sorted(stub.nodes[stub.find(ep.node._id)]['props']['title']
+                                    for ep in g.find_all(Episode, season = 1)),
+                             [ 'Episode 1', 'Episode 2', 'Episode 3' ])
+        finally:
+            stub.stop()
+
+
+suite = allTests(TestCachedObjectGraph)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+from pygoo import export
+from StringIO import StringIO
+from xml.etree import ElementTree
+import json
+import csv
+import tempfile
+import shutil
+import sys
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.g = g = MemoryObjectGraph()
+        monk = g.Series(title = 'Monk', rating = 8.5)
+        ep = g.Episode(series = monk, season = 1, episodeNumber = 2, title = 'Mr. Monk & the "Candidate"')
+        g.Subtitle(video = ep, language = 'en')
+        g.BaseObject(count = 2**70, nothing = None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testJSONLines(self):
+        f = StringIO()
+        self.assertEqual(export.export_jsonl(self.g, f), 4 + 4)
+        lines = [ json.loads(line) for line in f.getvalue().splitlines() ]
+
+        nodes = [ l for l in lines if l['type'] == 'node' ]
+        edges = [ l for l in lines if l['type'] == 'edge' ]
+        self.assertEqual([ n['id'] for n in nodes ], [ 0, 1, 2, 3 ])
+        self.assertEqual(nodes[0]['properties'], { 'title': 'Monk', 'rating': 8.5 })
+        self.assert_('Series' in nodes[0]['classes'])
+        self.assertEqual(nodes[2]['properties'], { 'language': 'English' })
+        self.assertEqual(nodes[3]['properties'], { 'count': 2**70, 'nothing': None })
+        self.assert_({ 'type': 'edge', 'source': 1, 'name': 'series', 'target': 0 } in edges)
+        self.assert_({ 'type': 'edge', 'source': 0, 'name': 'episodes', 'target': 1 } in edges)
+
+    def testCSV(self):
+        filenames = export.export_csv(self.g, self.tmpdir)
+        self.assertEqual(sorted(os.path.basename(f) for f in filenames),
+                         [ 'BaseObject.csv', 'Episode.csv', 'Series.csv', 'Subtitle.csv',
+                           'episodes.edges.csv', 'series.edges.csv', 'subtitle.edges.csv', 'video.edges.csv' ])
+
+        def read(name):
+            return list(csv.DictReader(open(os.path.join(self.tmpdir, name), 'rb')))
+
+        rows = read('Episode.csv')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['id'], '1')
+        self.assertEqual(rows[0]['title'], 'Mr. Monk & the "Candidate"')
+        self.assertEqual(rows[0]['season'], '1')
+        self.assertEqual(read('Series.csv')[0]['rating'], '8.5')
+        self.assertEqual(read('BaseObject.csv')[0]['nothing'], '')
+        self.assertEqual(read('series.edges.csv'), [ { 'source': '1', 'target': '0' } ])
+
+    def testGraphML(self):
+        f = StringIO()
+        export.export_graphml(self.g, f)
+        ns = '{http://graphml.graphdrawing.org/xmlns}'
+        root = ElementTree.fromstring(f.getvalue())
+
+        keys = dict((k.get('attr.name'), (k.get('id'), k.get('attr.type'))) for k in root.iter(ns + 'key'))
+        self.assertEqual(keys['rating'][1], 'double')
+        self.assertEqual(keys['season'][1], 'int')
+        self.assertEqual(keys['title'][1], 'string')
+
+        nodes = root.findall('%sgraph/%snode' % (ns, ns))
+        self.assertEqual(len(nodes), 4)
+        data = dict((d.get('key'), d.text) for d in nodes[1])
+        self.assertEqual(data[keys['title'][0]], 'Mr. Monk & the "Candidate"')
+
+        edges = root.findall('%sgraph/%sedge' % (ns, ns))
+        self.assertEqual(len(edges), 4)
+        self.assert_(('n1', 'n0', 'series') in [ (e.get('source'), e.get('target'), e[0].text) for e in edges ])
+
+    def testDisplayGraph(self):
+        g = self.g
+        for i in range(20):
+            g.Series(title = 'Series %d' % i)
+
+        filename = os.path.join(self.tmpdir, 'graph.dot')
+        self.assertEqual(g.display_graph('Test & "title"', filename = filename, headless = True), filename)
+        dot = open(filename).read().decode('utf-8')
+        self.assert_(dot.startswith('digraph G {'))
+        self.assert_('label="Test & \\"title\\""' in dot)
+        self.assert_('title: Mr. Monk &amp; the "Candidate"' in dot)
+        self.assert_('node_1 -> node_0 [label="series"];' in dot)
+        self.assertEqual(dot.count('[shape=polygon'), 24)
+
+        # neighbourhood of a node
+        monk = g.find_one(Series, title = 'Monk')
+        self.assertEqual([ i for i, n in g.display_nodes(root = monk, depth = 1) ], [ 0, 1 ])
+        self.assertEqual([ i for i, n in g.display_nodes(root = monk, depth = 2) ], [ 0, 1, 2 ])
+        self.assertEqual([ i for i, n in g.display_nodes(root = monk, depth = 2, max_nodes = 2) ], [ 0, 1 ])
+
+        # sampling and limits
+        nodes = g.display_nodes(sample = 5)
+        self.assertEqual(len(nodes), 5)
+        self.assertEqual(len(set(i for i, n in nodes)), 5)
+        self.assertEqual(len(g.display_nodes(sample = 5, max_nodes = 3)), 3)
+        self.assertEqual(len(g.display_nodes(max_nodes = 10)), 10)
+
+        # edges to nodes which are not displayed are not written
+        g.display_graph(root = monk, depth = 1, filename = filename, headless = True)
+        dot = open(filename).read()
+        self.assert_('node_2' not in dot)
+        self.assert_('node_1 -> node_0' in dot)
+
+        # edge names are escaped too
+        g.add_directed_edge(monk.node, 'a "quoted" \\ name', g.find_one(Series, title = 'Series 0').node)
+        g.display_graph(filename = filename, headless = True)
+        self.assert_('[label="a \\"quoted\\" \\\\ name"];' in open(filename).read())
+
+        # there is no known image viewer on other platforms, which is not an error
+        platform = sys.platform
+        sys.platform = 'freebsd9'
+        try:
+            self.assertEqual(g.display_graph(filename = filename), filename)
+        finally:
+            sys.platform = platform
+
+
+suite = allTests(TestExport)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
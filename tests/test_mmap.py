@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+import tempfile
+import shutil
+
+from pygoo.mmapobjectgraph import MmapObjectGraph
+
+class TestMmap(GraphTestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'graph.db')
+
+        g = MemoryObjectGraph()
+        monk = g.Series(title = 'Monk')
+        wire = g.Series(title = 'The Wire', rating = 9.5)
+        for season in range(1, 3):
+            for epnum in range(1, 4):
+                ep = g.Episode(series = monk, season = season, episodeNumber = epnum)
+                g.File(video = ep, filename = 'Monk.%dx%02d.avi' % (season, epnum))
+        ep = g.Episode(series = wire, season = 2, episodeNumber = 1, title = 'Ebb Tide')
+        g.Subtitle(video = ep, language = 'en')
+        g.delete_node(g.find_one(Episode, season = 1, episodeNumber = 2).node)
+
+        g.save(self.filename)
+        self.g = g
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testLazyLoading(self):
+        mg = MmapObjectGraph(self.filename)
+        self.assertEqual(len(mg._cache), 0)
+
+        ep = mg.find_one(Episode, series_title = 'The Wire')
+        self.assertEqual(ep.title, 'Ebb Tide')
+        self.assertEqual(ep.series.rating, 9.5)
+        self.assertEqual(ep.subtitle.language, 'en')
+        # only the nodes we touched (or that are still referenced) are decoded
+        self.assert_(len(mg._cache) < len(list(self.g.nodes())))
+
+        # the same node is returned as long as it is in use
+        self.assert_(mg.get_node(ep.node.node_id()) is ep.node)
+        self.assertEqual(ep.series, mg.find_one(Series, title = 'The Wire'))
+
+        self.assertRaises(KeyError, mg.get_node, 4)
+        self.assertRaises(KeyError, mg.get_node, 1000)
+        mg.close()
+
+    def testSameGraph(self):
+        mg = MmapObjectGraph(self.filename)
+        self.assertSameGraph(self.g, mg)
+
+        self.assertEqual(len(mg.find_all(Episode)), 6)
+        self.assertEqual(len(mg.find_all(Episode, series_title = 'Monk')), 5)
+        self.assertEqual(sorted(mg.values(Episode, 'season', 'episodeNumber', series_title = 'Monk')),
+                         [ (1, 1), (1, 3), (2, 1), (2, 2), (2, 3) ])
+        self.assertEqual([ ep.episodeNumber for ep in mg.find_all(Episode, season = 2, order_by = '-episodeNumber', limit = 2) ],
+                         [ 3, 2 ])
+
+        # a read-only graph can still be saved and loaded in memory
+        filename = os.path.join(self.tmpdir, 'copy.db')
+        mg.save(filename)
+        g2 = MemoryObjectGraph()
+        g2.load(filename)
+        self.assertSameGraph(self.g, g2)
+        mg.close()
+
+    def testReadOnly(self):
+        mg = MmapObjectGraph(self.filename)
+        series = mg.find_one(Series, title = 'Monk')
+        self.assertRaises(TypeError, setattr, series, 'title', 'House')
+        self.assertRaises(TypeError, mg.Series, title = 'House')
+        self.assertRaises(TypeError, mg.delete_node, series.node)
+        self.assertEqual(series.title, 'Monk')
+        mg.close()
+
+    def testDeltas(self):
+        g = MemoryObjectGraph()
+        g.load(self.filename)
+        g.find_one(Series, title = 'Monk').rating = 8.5
+        g.delete_node(g.find_one(Episode, season = 1, episodeNumber = 1).node)
+        house = g.Series(title = 'House')
+        g.Episode(series = house, season = 1, episodeNumber = 1)
+        g.save_incremental(self.filename)
+        g.find_one(Series, title = 'The Wire').title = 'The Wire (2002)'
+        g.save_incremental(self.filename)
+        self.assert_(os.path.exists(self.filename + '.delta'))
+
+        mg = MmapObjectGraph(self.filename)
+        self.assertSameGraph(g, mg)
+        self.assertEqual(mg.find_one(Series, title = 'Monk').rating, 8.5)
+        self.assertEqual(len(mg.find_all(Episode)), 6)
+        self.assertEqual(len(mg.find_all(Episode, series_title = 'Monk')), 4)
+        self.assertEqual(mg.find_one(Episode, series_title = 'House').episodeNumber, 1)
+        self.assertEqual(mg.find_one(Episode, title = 'Ebb Tide').series.title, 'The Wire (2002)')
+        mg.close()
+
+    def testNoIndex(self):
+        import cPickle as pickle
+        pickle.dump(self.g.to_nodes_and_edges(), open(self.filename, 'w'))
+        self.assertRaises(ValueError, MmapObjectGraph, self.filename)
+
+
+
+suite = allTests(TestMmap)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+import tempfile
+import shutil
+import time
+
+from pygoo import mutationlog
+
+class TestMutationLog(GraphTestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'graph.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def recovered(self):
+        g = MemoryObjectGraph()
+        g.open_log(self.filename)
+        return g
+
+    def testRecovery(self):
+        g = MemoryObjectGraph()
+        g.open_log(self.filename, commit_every = 1000, commit_interval = None)
+        self.createData(g)
+
+        # nothing is written to disk before a commit (group commit)
+        logfile = self.filename + '.0.log'
+        size = os.path.getsize(logfile)
+        g.Series(title = 'Deadwood')
+        self.assertEqual(os.path.getsize(logfile), size)
+        g.commit()
+        self.assert_(os.path.getsize(logfile) > size)
+
+        self.assertSameGraph(g, self.recovered())
+
+        # all types of mutations
+        monk = g.find_one(Series, title = 'Monk')
+        monk.rating = 9.5
+        monk.title = 'Monk (2002)'
+        ep = g.find_one(Episode, season = 1, episodeNumber = 2)
+        ep.title = 'Mr. Monk Goes to the Carnival'
+        del ep.title
+        g.delete_node(g.find_one(Episode, season = 2, episodeNumber = 3).node)
+        g.find_one(Episode, season = 2, episodeNumber = 2).series = g.find_one(Series, title = 'Deadwood')
+        g.commit()
+
+        g2 = self.recovered()
+        self.assertSameGraph(g, g2)
+        self.assertEqual(g2.find_one(Series, title = 'Monk (2002)').rating, 9.5)
+        self.assertEqual(len(g2.find_all(Episode, series_title = 'Monk (2002)')), 4)
+        self.assertEqual(len(g2.find_all(Episode, series_title = 'Deadwood')), 1)
+
+        # new nodes continue after the recovered ones, and the recovered graph can be logged to as well
+        g2.Series(title = 'House')
+        g2.close_log()
+        self.assertSameGraph(g2, self.recovered())
+
+    def testCommitInterval(self):
+        g = MemoryObjectGraph()
+        g.open_log(self.filename, commit_every = 1000, commit_interval = 0.2)
+        self.createData(g)
+        g.commit()
+
+        # buffered records are committed after commit_interval, even when the graph stays idle
+        logfile = self.filename + '.0.log'
+        size = os.path.getsize(logfile)
+        g.Series(title = 'Deadwood')
+        self.assertEqual(os.path.getsize(logfile), size)
+        time.sleep(1.0)
+        self.assert_(os.path.getsize(logfile) > size)
+        self.assertSameGraph(g, self.recovered())
+        g.close_log()
+
+    def testTruncatedLog(self):
+        g = MemoryObjectGraph()
+        g.open_log(self.filename)
+        self.createData(g)
+        g.close_log()
+
+        # simulate a crash while writing a record
+        with open(self.filename + '.0.log', 'ab') as f:
+            f.write(b'L\x20\x00\x00\x00\x01\x00')
+
+        g2 = self.recovered()
+        self.assertSameGraph(g, g2)
+        g2.Series(title = 'Deadwood')
+        g2.close_log()
+
+        g3 = self.recovered()
+        self.assertSameGraph(g2, g3)
+
+    def testCompaction(self):
+        for background in (False, True):
+            g = MemoryObjectGraph()
+            g.open_log(self.filename)
+            self.createData(g)
+            g.compact(background = background)
+            g.Series(title = 'Deadwood')
+            g._log.wait_compaction()
+
+            self.assert_(os.path.exists(self.filename))
+            self.assertEqual([ gen for gen, _ in mutationlog.log_files(self.filename) ],
+                             [ g._log.generation ])
+            g.close_log()
+
+            g2 = self.recovered()
+            self.assertSameGraph(g, g2)
+            g2.close_log()
+            os.remove(self.filename)
+            for _, path in mutationlog.log_files(self.filename):
+                os.remove(path)
+
+    def testStaleLog(self):
+        g = MemoryObjectGraph()
+        g.open_log(self.filename)
+        self.createData(g)
+        g.commit()
+
+        # simulate a crash after the snapshot has been written, but before the
+        # old log files have been removed
+        backup = os.path.join(self.tmpdir, 'backup.log')
+        shutil.copy(self.filename + '.0.log', backup)
+        g.compact(background = False)
+        shutil.copy(backup, self.filename + '.0.log')
+        g.close_log()
+
+        self.assertSameGraph(g, self.recovered())
+
+    def testRecoveryWithDeltas(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        g.save(self.filename)
+        g.find_one(Series, title = 'Monk').rating = 8.5
+        g.Series(title = 'House')
+        g.save_incremental(self.filename)
+
+        # the delta segments are applied before replaying the log, and are
+        # folded in the snapshot when compacting
+        g2 = self.recovered()
+        self.assertSameGraph(g, g2)
+        g2.Series(title = 'The Shield')
+        g2.compact(background = False)
+        self.assert_(not os.path.exists(self.filename + '.delta'))
+        g2.close_log()
+        self.assertSameGraph(g2, self.recovered())
+
+    def testSaveWithLog(self):
+        g = MemoryObjectGraph()
+        g.open_log(self.filename)
+        self.createData(g)
+        # saving to the log file compacts the log, so that it is not replayed
+        # on top of the new snapshot
+        g.save(self.filename)
+        g.Series(title = 'Deadwood')
+        g.save_incremental(self.filename)
+        g.Series(title = 'The Shield')
+        g.close_log()
+
+        self.assertSameGraph(g, self.recovered())
+
+
+
+suite = allTests(TestMutationLog)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+from neostub import Neo4jStub
+
+from pygoo.neo import Neo4jError
+from pygoo import neo4jobjectgraph
+from pygoo.neo4jobjectgraph import Neo4jObjectGraph, AUTO, MANUAL
+
+class TestNeo4j(GraphTestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+        self.stub = Neo4jStub()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def writeRequests(self):
+        return [ r for r in self.stub.requests if any(q.startswith('UNWIND') for q, params in r) ]
+
+    def testBasicGraph(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        mg = MemoryObjectGraph()
+        self.createData(g)
+        self.createData(mg)
+        self.assertSameGraph(g, mg)
+
+        # data is read back from the server by another graph
+        g2 = Neo4jObjectGraph(self.stub.url)
+        self.assertSameGraph(g2, mg)
+        ep = g2.find_one(Episode, series_title = 'The Wire')
+        self.assertEqual(ep.title, 'Ebb Tide')
+        self.assertEqual(ep.series.rating, 9.5)
+        self.assertEqual(ep.subtitle.language, 'en')
+        self.assertEqual(ep.subtitle.files.next().filesize, 2**70)
+        self.assert_(ep.node in g2)
+        self.assert_(ep.node not in g)
+
+    def testManualSync(self):
+        g = Neo4jObjectGraph(self.stub.url, sync = MANUAL)
+        requests = len(self.stub.requests)
+
+        self.createData(g)
+        # only the request reserving a block of ids has been sent
+        self.assertEqual(len(self.stub.requests), requests + 1)
+        self.assert_(g.has_pending_changes())
+        self.assertEqual(self.stub.node_ids(), [])
+
+        g.synchronize()
+        self.assertEqual(len(self.stub.requests), requests + 2)
+        self.assert_(not g.has_pending_changes())
+        self.assertEqual(len(self.stub.node_ids()), 17)
+        self.assertEqual(len(self.stub.node_ids('Episode')), 7)
+
+        # nodes and edges created together are all in the same request
+        statements = [ q for q, params in self.stub.requests[-1] ]
+        self.assert_(all(q.startswith('UNWIND') for q in statements))
+
+        # nothing left to send
+        g.synchronize()
+        self.assertEqual(len(self.stub.requests), requests + 2)
+
+        # modifications of existing nodes are batched too
+        for ep in g.find_all(Episode, series_title = 'Monk'):
+            ep.season += 10
+        requests = len(self.stub.requests)
+        g.synchronize()
+        self.assertEqual(len(self.stub.requests), requests + 1)
+        self.assertEqual(sorted(ep.season for ep in Neo4jObjectGraph(self.stub.url).find_all(Episode)),
+                         [ 2, 11, 11, 11, 12, 12, 12 ])
+
+    def testTransaction(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        g.Series(title = 'Monk')
+
+        writes = len(self.writeRequests())
+        with g.transaction():
+            ep = g.Episode(series = g.find_one(Series, title = 'Monk'), season = 1)
+            ep.episodeNumber = 3
+            with g.transaction():
+                ep.title = 'Mr. Monk and the Candidate'
+            self.assertEqual(len(self.writeRequests()), writes)
+            self.assertEqual(self.stub.node_ids('Episode'), [])
+        self.assertEqual(len(self.writeRequests()), writes + 1)
+
+        # in AUTO mode, each modification outside of a transaction is a request
+        ep.title = 'Mr. Monk Goes to the Carnival'
+        self.assertEqual(len(self.writeRequests()), writes + 2)
+
+        g2 = Neo4jObjectGraph(self.stub.url)
+        ep = g2.find_one(Episode)
+        self.assertEqual((ep.season, ep.episodeNumber), (1, 3))
+        self.assertEqual(ep.title, 'Mr. Monk Goes to the Carnival')
+        self.assertEqual(ep.series.title, 'Monk')
+
+    def testFailedTransaction(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        try:
+            with g.transaction():
+                g.Series(title = 'Monk')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assert_(g.has_pending_changes())
+        self.assertEqual(self.stub.node_ids(), [])
+
+        # the pending changes are sent with the next ones
+        g.Series(title = 'The Wire')
+        self.assertEqual(len(self.stub.node_ids('Series')), 2)
+
+    def testServerError(self):
+        g = Neo4jObjectGraph(self.stub.url, sync = MANUAL)
+        g.Series(title = 'Monk')
+        g.synchronize()
+
+        # another node with an id which already exists on the server
+        g.create_node([ ('title', 'The Wire', None) ], [ Series ], _id = 0)
+        g.Series(title = 'Dexter')
+        self.assertRaises(Neo4jError, g.synchronize)
+
+        # none of the changes has been applied, and they are still pending
+        self.assertEqual(self.stub.node_ids(), [ 0 ])
+        self.assert_(g.has_pending_changes())
+
+    def testLostConnection(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        g.Series(title = 'Monk')
+
+        # connections closed by the server while idle are opened again
+        self.stub.close_connections()
+        g.Series(title = 'The Wire')
+        self.assertEqual(len(self.stub.node_ids('Series')), 2)
+
+        # a request whose response is lost is not sent again, as it has been executed
+        requests = len(self.stub.requests)
+        self.stub.drop_responses = 1
+        self.assertRaises(Neo4jError, g.Series, title = 'Dexter')
+        self.assertEqual(len(self.stub.requests), requests + 1)
+        self.assertEqual(len(self.stub.node_ids('Series')), 3)
+        self.assert_(g.has_pending_changes())
+
+        # sending the changes again doesn't duplicate them
+        self.assertRaises(Neo4jError, g.synchronize)
+        self.assertEqual(len(self.stub.node_ids('Series')), 3)
+
+        # the server can still be used afterwards
+        g2 = Neo4jObjectGraph(self.stub.url)
+        g2.Series(title = 'House')
+        self.assertEqual(len(g2.find_all(Series)), 4)
+
+    def testDeleteAndClasses(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        self.createData(g)
+
+        ep = g.find_one(Episode, series_title = 'The Wire')
+        g.delete_node(ep.subtitle.node)
+        self.assertEqual(len(self.stub.node_ids()), 16)
+        self.assertEqual(list(ep.node.get('subtitle')), [])
+        self.assertEqual(len(list(g.find_all(Subtitle))), 0)
+
+        ep.node.add_class(Movie)
+        self.assert_('Movie' in self.stub.nodes[self.stub.find(ep.node._id)]['labels'])
+        self.assert_(g.get_node(ep.node._id).isinstance(Movie))
+
+        g.clear()
+        self.assertEqual(self.stub.node_ids(), [])
+        self.assertEqual(len(self.stub.rels), 0)
+
+    def testIdReservation(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        g2 = Neo4jObjectGraph(self.stub.url)
+        n1 = g.Series(title = 'Monk').node
+        n2 = g2.Series(title = 'The Wire').node
+        n3 = g.Series(title = 'Dexter').node
+
+        # ids are reserved by blocks, and never given twice
+        self.assertEqual(len(set([ n1._id, n2._id, n3._id ])), 3)
+        self.assertEqual(g.get_node(n2._id).title, 'The Wire')
+        self.assertRaises(KeyError, g.get_node, 123456)
+
+    def testPagedIteration(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        self.createData(g)
+
+        fetch_size, cache_size = neo4jobjectgraph.FETCH_SIZE, neo4jobjectgraph.CACHE_SIZE
+        neo4jobjectgraph.FETCH_SIZE, neo4jobjectgraph.CACHE_SIZE = 4, 5
+        try:
+            g2 = Neo4jObjectGraph(self.stub.url)
+            queries = len(self.stub.queries())
+            nodes = list(g2.nodes())
+            self.assertEqual([ n._id for n in nodes ], self.stub.node_ids())
+
+            # nodes come in batches of FETCH_SIZE, not one request per node
+            self.assertEqual(len(self.stub.queries()), queries + 5)
+            self.assertEqual(len(g2._cache), 5)
+            self.assertEqual([ n._id for n in g2._cache.values() ], self.stub.node_ids()[-5:])
+
+            # cached nodes are not fetched again
+            queries = len(self.stub.queries())
+            self.assert_(g2.get_node(nodes[-1]._id) is nodes[-1])
+            self.assertEqual(len(self.stub.queries()), queries)
+
+            self.assertEqual(len(list(g2.find_all(Episode))), 7)
+            self.assert_(all(q.startswith('MATCH (n:PyGoo') and q.endswith('LIMIT {limit}')
+                             for q in self.stub.queries()[queries:]))
+            self.assertEqual(len(list(g2.scan_nodes(after = nodes[10]._id))), 6)
+        finally:
+            neo4jobjectgraph.FETCH_SIZE, neo4jobjectgraph.CACHE_SIZE = fetch_size, cache_size
+
+    def testQueryPushdown(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        self.createData(g)
+        g.Movie(title = 'Monk')
+
+        def query(*args, **kwargs):
+            queries = len(self.stub.queries())
+            result = sorted(obj.node._id for obj in g.find_all(*args, **kwargs))
+            return result, self.stub.queries()[queries:]
+
+        # classes and literals
+        result, queries = query(Episode, season = 2)
+        self.assertEqual(len(result), 4)
+        self.assertEqual(queries, [ 'MATCH (n:PyGoo:`Episode`) WHERE n.`season` = {p0} AND n._id > {after} '
+                                    'RETURN n._id, labels(n), n ORDER BY n._id LIMIT {limit}' ])
+        self.assertEqual(self.stub.requests[-1][0][1]['p0'], 2)
+
+        result, queries = query((Series, Movie), title = 'Monk')
+        self.assertEqual(len(result), 2)
+        self.assertEqual(len(queries), 1)
+        self.assert_('(n:`Series` OR n:`Movie`)' in queries[0])
+
+        # chained filters are checked again on the results
+        result, queries = query(Episode, series_title = 'The Wire', season = 2)
+        self.assertEqual(len(result), 1)
+        self.assert_('(n)-[:`series`]->({`title`: {p1}})' in queries[0])
+        self.assertEqual(g.get_node(result[0]).title, 'Ebb Tide')
+
+        # linked objects
+        wire = g.find_one(Series, title = 'The Wire')
+        result, queries = query(Episode, series = wire)
+        self.assertEqual(len(result), 1)
+        self.assert_('(n)-[:`series`]->(:PyGoo {_id: {p0}})' in queries[0])
+        self.assertEqual(query(File, subtitle_video_series = wire)[0],
+                         query(File, filename = 'The Wire.2x01.en.srt')[0])
+
+        # values stored as pickles can't be compared by the server
+        result, queries = query(Subtitle, language = 'en')
+        self.assertEqual(len(result), 1)
+        self.assert_('{p0}' not in queries[0])
+        result, queries = query(File, filesize = 2**70)
+        self.assertEqual(len(result), 1)
+        self.assert_('{p0}' not in queries[0])
+
+        # only the needed nodes are fetched, unless some filters are checked on them
+        def last_limit():
+            return [ params['limit'] for r in self.stub.requests for q, params in r if 'limit' in params ][-1]
+        self.assertEqual(g.find_one(Episode, series_title = 'Monk', season = 2).episodeNumber, 1)
+        self.assertEqual(last_limit(), neo4jobjectgraph.FETCH_SIZE)
+        self.assertEqual(len(list(g.query(Episode).limit(3))), 3)
+        self.assertEqual(last_limit(), 3)
+        self.assertEqual(g.query(Episode, season = 1).count(), 3)
+
+    def testRelationshipCache(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        self.createData(g)
+
+        g2 = Neo4jObjectGraph(self.stub.url)
+        ep = g2.find_one(Episode, series_title = 'The Wire')
+        monk = g2.find_one(Series, title = 'Monk')
+        ep.subtitle, ep.series
+
+        # relationships are only read once from the server
+        queries = len(self.stub.queries())
+        self.assertEqual(ep.series.title, 'The Wire')
+        self.assertEqual(ep.subtitle.language, 'en')
+        self.assertEqual(sorted(ep.node.edge_keys()), [ 'series', 'subtitle' ])
+        self.assertEqual(len(self.stub.queries()), queries)
+
+        # changing a link removes the old relationships by id
+        ep.series = monk
+        removals = [ params['ids'] for q, params in self.stub.requests[-1] if 'id(r) = id' in q ]
+        self.assertEqual(len(removals), 1)
+        self.assertEqual(len(removals[0]), 2)
+        self.assertEqual(self.stub.edges(ep.node._id)[-1], ('series', monk.node._id))
+        self.assertEqual(len(list(monk.episodes)), 7)
+        self.assertEqual(len(list(g2.find_one(Series, title = 'The Wire').episodes)), 0)
+
+        # created relationships get their id, and can be removed
+        rel = ep.node._relationships()['series'][0]
+        self.assertEqual(rel[1], monk.node._id)
+        self.assert_(rel[0] in self.stub.rels)
+        with g2.transaction():
+            ep.node.remove_directed_edge('series', monk.node)
+            monk.node.remove_directed_edge('episodes', ep.node)
+        self.assert_(rel[0] not in self.stub.rels)
+        self.assertEqual(len(list(monk.episodes)), 6)
+
+        # relationships added and removed before being sent are never sent
+        g3 = Neo4jObjectGraph(self.stub.url, sync = MANUAL)
+        ep = g3.find_one(Episode, title = 'Ebb Tide')
+        monk = g3.find_one(Series, title = 'Monk')
+        ep.node.add_directed_edge('series', monk.node)
+        ep.node.remove_directed_edge('series', monk.node)
+        self.assertEqual(g3._edge_changes, [])
+        self.assertEqual(len(list(g3.find_one(Series, title = 'Monk').episodes)), 6)
+
+    def testImportGraph(self):
+        mg = MemoryObjectGraph()
+        self.createData(mg)
+        nodes, edges, classes = mg.to_nodes_and_edges()
+
+        batch_size = neo4jobjectgraph.IMPORT_BATCH_SIZE
+        neo4jobjectgraph.IMPORT_BATCH_SIZE = 5
+        try:
+            g = Neo4jObjectGraph(self.stub.url)
+            requests = len(self.stub.requests)
+            ids = g.import_graph(mg)
+            self.assertEqual(ids, dict((i, i) for i in range(17)))
+
+            # one request to reserve the ids, then one request per batch
+            self.assertEqual(len(edges), 30)
+            self.assertEqual(len(self.stub.requests), requests + 1 + 4 + 6)
+            self.assertSameGraph(g, mg)
+
+            # nodes created later or imported again get new ids
+            g.Series(title = 'Dexter')
+            ids = g.import_graph(mg)
+            self.assertEqual(sorted(ids.values()), range(1017, 1034))
+            self.assertEqual(len(self.stub.node_ids()), 35)
+            self.assertEqual(len(list(g.find_all(Series, title = 'Monk'))), 2)
+            self.assertEqual(len(list(g.find_all(Episode, series_title = 'The Wire'))), 2)
+        finally:
+            neo4jobjectgraph.IMPORT_BATCH_SIZE = batch_size
+
+    def testIdentityMap(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        self.createData(g)
+
+        cache_size = neo4jobjectgraph.CACHE_SIZE
+        neo4jobjectgraph.CACHE_SIZE = 2
+        try:
+            g2 = Neo4jObjectGraph(self.stub.url)
+            nodes = list(g2.nodes())
+            # each node has a single node object, even after leaving the cache
+            self.assert_(all(n1 is n2 for n1, n2 in zip(nodes, g2.nodes())))
+            ep = g2.find_one(Episode, series_title = 'The Wire')
+            self.assert_(ep.node in nodes)
+            self.assert_(any(ep.node is n for n in nodes))
+            self.assert_(ep.series.node is g2.find_one(Series, title = 'The Wire').node)
+            self.assertEqual(len(set(nodes) | set(g2.nodes())), 17)
+
+            # modifications are seen by all the users of a node
+            ep.series.rating = 8.0
+            self.assertEqual(g2.find_one(Series, title = 'The Wire').rating, 8.0)
+
+            # unused node objects are not kept
+            nodes = ep = None
+            self.assert_(len(g2._nodes) <= 2)
+            self.assertEqual(g2.find_one(Series, title = 'The Wire').rating, 8.0)
+        finally:
+            neo4jobjectgraph.CACHE_SIZE = cache_size
+
+    def testUniqueProperties(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        self.createData(g)
+
+        # literal unique properties are indexed
+        self.assert_(('Series', 'title') in self.stub.indexes)
+        self.assert_(('Movie', 'title') in self.stub.indexes)
+        self.assert_(('Movie', 'year') in self.stub.indexes)
+        self.assert_(not any(label == 'Subtitle' for label, prop in self.stub.indexes))
+        self.assertEqual(self.stub.constraints, set([ ('PyGoo', '_id') ]))
+
+        # find_or_create is a single query
+        requests = len(self.stub.requests)
+        wire = g.find_or_create(Series, title = 'The Wire')
+        self.assertEqual(len(self.stub.requests), requests + 1)
+        self.assert_(self.stub.requests[-1][0][0].startswith('MERGE (n:PyGoo:`Series` {`title`: {p0}})'))
+        self.assert_(wire.node is g.find_one(Series, title = 'The Wire').node)
+
+        dexter = g.find_or_create(Series, title = 'Dexter')
+        self.assertEqual(len(self.stub.node_ids('Series')), 3)
+        self.assertEqual(g.find_or_create(Series, title = 'Dexter'), dexter)
+        self.assertEqual(len(self.stub.node_ids('Series')), 3)
+        self.assert_(dexter.node.isinstance(BaseObject))
+
+        # links can't be merged
+        ep = g.find_or_create(Episode, series = dexter, season = 1, episodeNumber = 1)
+        self.assertEqual(g.find_or_create(Episode, series = dexter, season = 1, episodeNumber = 1), ep)
+
+        # adding objects which are already there only looks for them with their unique literals
+        mg = MemoryObjectGraph()
+        monk = mg.Series(title = 'Monk')
+        queries = len(self.stub.queries())
+        self.assertEqual(g.add_object(monk, recurse = Equal.OnUnique), g.find_one(Series, title = 'Monk'))
+        self.assert_('n.`title` = {p0}' in self.stub.queries()[queries])
+        movie = mg.Movie(title = 'Monk', year = 2002)
+        self.assertEqual(g.add_object(movie, recurse = Equal.OnUnique).year, 2002)
+        self.assertEqual(g.add_object(movie, recurse = Equal.OnUnique), g.find_one(Movie))
+        self.assertEqual(len(self.stub.node_ids('Series')), 3)
+        self.assertEqual(len(self.stub.node_ids('Movie')), 1)
+
+        # uniqueness constraints make duplicates an error
+        g2 = Neo4jObjectGraph(self.stub.url, unique_constraints = True)
+        self.assert_(('Series', 'title') in self.stub.constraints)
+        self.assert_(('Movie', 'title') not in self.stub.constraints)
+        self.assertRaises(Neo4jError, g2.Series, title = 'Monk')
+        g3 = Neo4jObjectGraph(self.stub.url, unique_constraints = True)
+        self.assertEqual(g3.find_or_create(Series, title = 'Monk'), g3.find_one(Series, title = 'Monk'))
+
+    def testPrefetch(self):
+        g = Neo4jObjectGraph(self.stub.url)
+        self.createData(g)
+
+        def titles(g, **kwargs):
+            requests = len(self.stub.requests)
+            result = sorted((ep.series.title, sorted(f.filename for f in ep.files))
+                            for ep in g.find_all(Episode, **kwargs))
+            return result, len(self.stub.requests) - requests
+
+        # one request for the episodes, then two for each of them: its edges and its series
+        g2 = Neo4jObjectGraph(self.stub.url)
+        expected, requests = titles(g2)
+        self.assertEqual(len(expected), 7)
+        self.assertEqual(expected[0], ('Monk', [ 'Monk.1x01.avi' ]))
+        self.assertEqual(expected[-1], ('The Wire', []))
+        self.assertEqual(requests, 1 + 7 * 2 + 1)
+
+        # one request for the episodes, and one for their edges, series and files
+        g3 = Neo4jObjectGraph(self.stub.url)
+        self.assertEqual(titles(g3, prefetch = [ 'series', 'files' ]), (expected, 2))
+
+        # already loaded nodes and relationships are used as they are
+        g4 = Neo4jObjectGraph(self.stub.url)
+        monk = g4.find_one(Series, title = 'Monk')
+        ep = g4.Episode(series = monk, season = 3, episodeNumber = 1)
+        eps = g4.find_all(Episode, prefetch = 'series', series = monk)
+        self.assertEqual(len(eps), 7)
+        self.assert_(all(e.series.node is monk.node for e in eps))
+        self.assertEqual([ q for q, params in self.stub.requests[-1] ],
+                         [ neo4jobjectgraph._PREFETCH_EDGES, neo4jobjectgraph._PREFETCH_NODES ])
+        self.assertEqual(len(self.stub.requests[-1][0][1]['ids']), 6)
+
+
+suite = allTests(TestNeo4j)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+
+class TestQuery(TestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+
+    def createData(self, g):
+        monk = g.Series(title = 'Monk')
+        wire = g.Series(title = 'The Wire')
+
+        for season in range(1, 4):
+            for epnum in range(1, 6):
+                g.Episode(series = monk, season = season, episodeNumber = epnum)
+
+        g.Episode(series = wire, season = 2, episodeNumber = 1, title = 'Ebb Tide')
+        g.Episode(series = wire, season = 2, episodeNumber = 2, title = 'Collateral Damage')
+
+    def testQuerySet(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        q = g.query(Episode)
+        self.assertEqual(q.count(), 17)
+        self.assertEqual(len(list(q)), 17)
+        self.assertEqual(q.exists(), True)
+        self.assertEqual(type(q.first()), Episode)
+
+        # chaining doesn't modify the original query
+        q2 = q.filter(season = 2)
+        self.assertEqual(q.count(), 17)
+        self.assertEqual(q2.count(), 7)
+        self.assertEqual(q2.filter(lambda n: n.episodeNumber > 3).count(), 2)
+
+        self.assertEqual(q.limit(5).count(), 5)
+        self.assertEqual(len(list(q.limit(5))), 5)
+        self.assertEqual(q.offset(15).count(), 2)
+        self.assertEqual(q.offset(10).limit(20).count(), 7)
+        self.assertEqual(q.limit(10).offset(5).count(), 5)
+        self.assertEqual(q.limit(0).exists(), False)
+        self.assertRaises(TypeError, q.limit(5).filter, season = 1)
+
+        self.assertEqual(g.query(Episode, season = 12).exists(), False)
+        self.assertEqual(g.query(Episode, season = 12).first(), None)
+        self.assertEqual(g.query('Series').count(), 2)
+
+        # find_all and query should always agree
+        self.assertEqual(len(g.find_all(Episode, season = 2)), q2.count())
+
+    def testLazyEvaluation(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        seen = []
+        def valid_node(n):
+            seen.append(n)
+            return True
+
+        g.query(Episode, valid_node).first()
+        self.assertEqual(len(seen), 1)
+
+        self.assert_(g.query(Episode, valid_node).exists())
+        self.assertEqual(len(seen), 2)
+
+    def testChainedFilters(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        self.assertEqual(len(g.find_all(Episode, series_title = 'The Wire')), 2)
+        self.assertEqual(g.query(Episode, series_title = 'Monk', season = 1).count(), 5)
+
+        wire = g.find_one(Series, title = 'The Wire')
+        self.assertEqual(len(g.find_all(Episode, series = wire)), 2)
+
+    def testValues(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        rows = sorted(g.values(Episode, 'episodeNumber', 'title', 'series.title', season = 2))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[0], (1, None, 'Monk'))
+        self.assert_((1, 'Ebb Tide', 'The Wire') in rows)
+        self.assert_(all(type(row) is tuple for row in rows))
+
+        rows = list(g.query(Episode, series_title = 'The Wire').values('series.nonexistent', 'series'))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0][0], None)
+        self.assert_(rows[0][1] is g.find_one(Series, title = 'The Wire').node)
+
+    def testPrefetch(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        q = g.query(Episode, season = 2).prefetch('series')
+        self.assertEqual(q.prefetch('series', 'files')._prefetch, [ 'series', 'files' ])
+        self.assertEqual(q._prefetch, [ 'series' ])
+        self.assertEqual(sorted(ep.series.title for ep in q), [ 'Monk' ] * 5 + [ 'The Wire' ] * 2)
+        self.assertEqual(sorted(q.values('series.title', 'episodeNumber'))[-1], ('The Wire', 2))
+
+        eps = g.find_all(Episode, prefetch = 'series', order_by = 'episodeNumber', limit = 3)
+        self.assertEqual([ ep.episodeNumber for ep in eps ], [ 1, 1, 1 ])
+
+    def testAggregate(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        result = g.aggregate(Episode, group_by = 'series', count = True, max = 'season')
+        self.assertEqual(len(result), 2)
+        monk = g.find_one(Series, title = 'Monk')
+        wire = g.find_one(Series, title = 'The Wire')
+        self.assertEqual(result[monk], { 'count': 15, 'max_season': 3 })
+        self.assertEqual(result[wire], { 'count': 2, 'max_season': 2 })
+        self.assertEqual(type(result.keys()[0]), Series)
+
+        result = g.aggregate(Episode, group_by = 'series.title', count = True,
+                             min = 'episodeNumber', avg = [ 'season', 'episodeNumber' ], season = 2)
+        self.assertEqual(result['Monk'], { 'count': 5, 'min_episodeNumber': 1,
+                                           'avg_season': 2.0, 'avg_episodeNumber': 3.0 })
+        self.assertEqual(result['The Wire']['count'], 2)
+
+        result = g.aggregate(Episode, group_by = [ 'series.title', 'season' ], count = True)
+        self.assertEqual(result[('Monk', 3)], { 'count': 5 })
+
+        # groups with a None value are skipped
+        result = g.aggregate(Episode, group_by = 'title', count = True)
+        self.assertEqual(result, { 'Ebb Tide': { 'count': 1 }, 'Collateral Damage': { 'count': 1 } })
+
+        self.assertEqual(g.aggregate(Episode, count = True, sum = 'episodeNumber'),
+                         { 'count': 17, 'sum_episodeNumber': 48 })
+        self.assertEqual(g.aggregate(Episode, count = True, max = 'season', season = 12),
+                         { 'count': 0, 'max_season': None })
+        self.assertRaises(TypeError, g.query(Episode).aggregate, median = 'season')
+
+        # same result when using an index
+        expected = g.aggregate(Episode, group_by = 'season', count = True, max = 'episodeNumber')
+        g.create_index('season')
+        self.assertEqual(g.aggregate(Episode, group_by = 'season', count = True, max = 'episodeNumber'),
+                         expected)
+        self.assertEqual(expected[2], { 'count': 7, 'max_episodeNumber': 5 })
+
+    def testOrderBy(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        def key(ep):
+            return (ep.season, ep.episodeNumber)
+
+        eps = g.find_all(Episode, order_by = [ 'season', 'episodeNumber' ])
+        self.assertEqual([ key(ep) for ep in eps ], sorted(key(ep) for ep in eps))
+
+        eps = g.find_all(Episode, order_by = [ '-season', 'episodeNumber' ], limit = 4)
+        self.assertEqual([ key(ep) for ep in eps ], [ (3, 1), (3, 2), (3, 3), (3, 4) ])
+
+        eps = list(g.query(Episode).order_by('-episodeNumber', '-season').offset(1).limit(2))
+        self.assertEqual([ key(ep) for ep in eps ], [ (2, 5), (1, 5) ])
+
+        # missing values come last, in both directions
+        titles = list(g.query(Episode).order_by('title').values('title'))
+        self.assertEqual(titles[:3], [ ('Collateral Damage',), ('Ebb Tide',), (None,) ])
+        titles = list(g.query(Episode).order_by('-title').limit(3).values('title'))
+        self.assertEqual(titles, [ ('Ebb Tide',), ('Collateral Damage',), (None,) ])
+
+        rows = list(g.query(Episode, season = 2).order_by('-series.title', 'episodeNumber').values('series.title', 'episodeNumber'))
+        self.assertEqual(rows[:3], [ ('The Wire', 1), ('The Wire', 2), ('Monk', 1) ])
+
+        self.assertRaises(TypeError, g.query(Episode).limit(2).order_by, 'season')
+
+        # same results when walking a sorted index
+        expected = [ key(ep) for ep in g.find_all(Episode, order_by = '-episodeNumber', limit = 6, season = 2) ]
+        g.create_index('episodeNumber', sorted = True)
+        self.assertEqual([ key(ep) for ep in g.find_all(Episode, order_by = '-episodeNumber', limit = 6, season = 2) ],
+                         expected)
+        self.assertEqual(expected[:3], [ (2, 5), (2, 4), (2, 3) ])
+
+        g.create_index('title', sorted = True)
+        titles = list(g.query(Episode).order_by('-title').limit(3).values('title'))
+        self.assertEqual(titles, [ ('Ebb Tide',), ('Collateral Damage',), (None,) ])
+
+        # walking an index only looks at the needed nodes
+        seen = []
+        def valid_node(n):
+            seen.append(n)
+            return True
+        g.query(Episode, valid_node).order_by('episodeNumber').first()
+        self.assertEqual(len(seen), 1)
+
+    def testOptionClash(self):
+        class Poll(BaseObject):
+            schema = { 'text': unicode, 'limit': int, 'count': int }
+            valid = [ 'text' ]
+
+        g = MemoryObjectGraph()
+        for i in range(5):
+            g.Poll(text = 'poll %d' % i, limit = i % 2, count = i)
+
+        self.assertRaises(ValueError, g.find_all, Poll, limit = 1)
+        self.assertRaises(ValueError, g.aggregate, Poll, count = True)
+        self.assertRaises(ValueError, g.aggregate, 'Poll', max = 'limit', count = 3)
+        self.assertEqual(len(g.find_all(Poll, order_by = 'text')), 5)
+        self.assertEqual(g.aggregate(Poll, max = 'count'), { 'max_count': 4 })
+
+        # use the QuerySet to filter on those properties
+        self.assertEqual(g.query(Poll, limit = 1).count(), 2)
+        self.assertEqual(g.query(Poll).filter(count = 3).aggregate(count = True), { 'count': 1 })
+
+    def testNodeIds(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        nodes = list(g.nodes())
+        ids = [ n.node_id() for n in nodes ]
+        self.assertEqual(ids, range(len(nodes)))
+        for n in nodes:
+            self.assert_(g.get_node(n.node_id()) is n)
+
+        # ids are never reused
+        ep = g.find_one(Episode, season = 3, episodeNumber = 5)
+        epid = ep.node.node_id()
+        g.delete_node(ep.node)
+        self.assertRaises(KeyError, g.get_node, epid)
+        self.assertRaises(KeyError, g.get_node, 1000)
+        self.assertEqual(g.Series(title = 'Scrubs').node.node_id(), len(nodes))
+        self.assert_(g.get_node(0) is nodes[0])
+
+        # ids survive serialization
+        g2 = MemoryObjectGraph()
+        g2.from_nodes_and_edges(*g.to_nodes_and_edges())
+        self.assertEqual([ i for i, _ in g2.scan_nodes() ], [ i for i, _ in g.scan_nodes() ])
+        self.assertEqual(g2.get_node(1).title, g.get_node(1).title)
+        self.assertEqual(g2.Series(title = 'Bones').node.node_id(), len(nodes) + 1)
+
+    def testScan(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        batches = []
+        cursor = None
+        while True:
+            eps, cursor = g.scan(Episode, after = cursor, batch = 5)
+            batches.append(eps)
+            if cursor is None:
+                break
+
+        self.assertEqual([ len(b) for b in batches ], [ 5, 5, 5, 2 ])
+        self.assert_(all(type(ep) is Episode for b in batches for ep in b))
+        ids = [ ep.node.node_id() for b in batches for ep in b ]
+        self.assertEqual(ids, sorted(ids))
+
+        # resuming a scan after the graph has been modified
+        eps, cursor = g.scan(Episode, batch = 10, season = 2)
+        self.assertEqual(len(eps), 7)
+        self.assertEqual(cursor, None)
+
+        eps, cursor = g.scan(Episode, batch = 3)
+        g.delete_node(g.get_node(cursor))
+        g.Episode(series = g.find_one(Series, title = 'Monk'), season = 4, episodeNumber = 1)
+        eps2, _ = g.scan(Episode, after = cursor, batch = 100)
+        self.assertEqual(len(eps) + len(eps2), 18)
+        self.assertEqual(eps2[-1].season, 4)
+
+    def testIndexes(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        self.assertEqual(g.index('season'), None)
+        index = g.create_index('season')
+        self.assert_(g.index('season') is index)
+        self.assertEqual(len(index.lookup(2)), 7)
+
+        self.assertEqual(g.query(Episode, season = 2).count(), 7)
+        self.assertEqual(g.query(season = 2).count(), 7)
+        self.assertEqual(g.query(Episode, season = 2, episodeNumber = 1).count(), 2)
+        self.assertEqual(len(g.find_all(Episode, season = 3)), 5)
+
+        # indexes need to follow modifications of the nodes
+        ep = g.find_one(Episode, season = 3, episodeNumber = 5)
+        ep.season = 4
+        self.assertEqual(g.query(Episode, season = 3).count(), 4)
+        self.assertEqual(g.query(Episode, season = 4).count(), 1)
+
+        g.Episode(series = g.find_one(Series, title = 'Monk'), season = 4, episodeNumber = 1)
+        self.assertEqual(g.query(Episode, season = 4).count(), 2)
+
+        g.delete_node(ep.node)
+        self.assertEqual(g.query(Episode, season = 4).count(), 1)
+
+        ep = g.find_one(Episode, season = 4)
+        del ep.season
+        self.assertEqual(g.query(Episode, season = 4).count(), 0)
+
+        # sorted indexes are built by sorting their values once
+        index = g.create_index('episodeNumber', sorted = True)
+        self.assertEqual(index.keys(), [ 1, 2, 3, 4, 5 ])
+        self.assertEqual([ n.episodeNumber for n in index.walk() ][:3], [ 1, 1, 1 ])
+        index.add_all([ (ep.node, 12), (ep.node, 0) ])
+        self.assertEqual(index.keys(), [ 0, 1, 2, 3, 4, 5, 12 ])
+        index.add(ep.node, 7)
+        self.assertEqual(index.keys(), [ 0, 1, 2, 3, 4, 5, 7, 12 ])
+
+        g.drop_index('season')
+        self.assertEqual(g.index('season'), None)
+        self.assertEqual(g.query(Episode, season = 2).count(), 7)
+
+
+
+suite = allTests(TestQuery)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
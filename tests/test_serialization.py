@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+from pygoo import snapshot
+from pygoo.mmapobjectgraph import MmapObjectGraph
+from pygoo.objectnode import ObjectNode
+import cPickle as pickle
+import tempfile
+import shutil
+
+class TestSerialization(GraphTestCase):
+    maxDiff = None
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def tmpfile(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def createData(self, g):
+        monk = g.Series(title = 'Monk')
+        wire = g.Series(title = 'The Wire', rating = 9.5)
+
+        for season in range(1, 3):
+            for epnum in range(1, 4):
+                ep = g.Episode(series = monk, season = season, episodeNumber = epnum)
+                g.File(video = ep, filename = 'Monk.%dx%02d.avi' % (season, epnum))
+
+        ep = g.Episode(series = wire, season = 2, episodeNumber = 1, title = 'Ebb Tide')
+        sub = g.Subtitle(video = ep, language = 'en')
+        g.File(subtitle = sub, filename = 'The Wire.2x01.en.srt', filesize = 2**70)
+        g.BaseObject(count = 12L, nothing = None)
+
+    def assertSameGraph(self, g1, g2):
+        super(TestSerialization, self).assertSameGraph(g1, g2)
+
+        # literals also need to keep their type (eg: int and long)
+        for (i, n1), (j, n2) in zip(g1.scan_nodes(), g2.scan_nodes()):
+            self.assertEqual(i, j)
+            for name, value in n1.literal_items():
+                self.assertEqual(type(value), type(n2.get_literal(name)))
+
+    def testSnapshot(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        g.delete_node(g.find_one(Episode, season = 1, episodeNumber = 2).node)
+
+        filename = self.tmpfile('graph.db')
+        g.save(filename)
+        self.assert_(snapshot.is_snapshot(filename))
+
+        g2 = MemoryObjectGraph()
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+
+        ep = g2.find_one(Episode, series_title = 'The Wire')
+        self.assertEqual(ep.title, 'Ebb Tide')
+        self.assertEqual(ep.series.rating, 9.5)
+        self.assertEqual(len(g2.find_all(Episode, series_title = 'Monk')), 5)
+
+    def testLegacyPickle(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        filename = self.tmpfile('graph.pickle')
+        pickle.dump(g.to_nodes_and_edges(), open(filename, 'w'))
+        self.assert_(not snapshot.is_snapshot(filename))
+
+        g2 = MemoryObjectGraph()
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+
+    def testInvalidSnapshot(self):
+        from StringIO import StringIO
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        f = StringIO()
+        snapshot.write_snapshot(g, f)
+        data = f.getvalue()
+
+        self.assertRaises(ValueError, snapshot.read_snapshot, MemoryObjectGraph(), StringIO(b'PYGOO'))
+        self.assertRaises(ValueError, snapshot.read_snapshot, MemoryObjectGraph(), StringIO(b'X' + data[1:]))
+        self.assertRaises(ValueError, snapshot.read_snapshot, MemoryObjectGraph(), StringIO(data[:len(data) // 2]))
+
+        # unknown records are skipped
+        data = data[:10] + b'?' + snapshot._uint.pack(3) + b'abc' + data[10:]
+        g2 = MemoryObjectGraph()
+        snapshot.read_snapshot(g2, StringIO(data))
+        self.assertSameGraph(g, g2)
+
+    def testIncrementalSave(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        filename = self.tmpfile('graph.db')
+        delta = filename + '.delta'
+
+        # first save is a full one
+        g.save_incremental(filename)
+        self.assert_(not os.path.exists(delta))
+        base_size = os.path.getsize(filename)
+
+        monk = g.find_one(Series, title = 'Monk')
+        monk.rating = 8.5
+        del g.find_one(Series, title = 'The Wire').rating
+        g.delete_node(g.find_one(Episode, season = 1, episodeNumber = 2).node)
+        ep = g.Episode(series = monk, season = 3, episodeNumber = 1)
+        g.find_one(Episode, season = 2, episodeNumber = 1).series = g.find_one(Series, title = 'The Wire')
+        g.save_incremental(filename)
+        self.assert_(0 < os.path.getsize(delta) < base_size)
+
+        g2 = MemoryObjectGraph()
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+
+        # deltas stack onto each other, and a loaded graph can save its own deltas
+        ep.title = 'Mr. Monk and the Candidate'
+        g.Series(title = 'House')
+        g.save_incremental(filename)
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+
+        g2.delete_node(g2.find_one(Series, title = 'House').node)
+        g2.save_incremental(filename)
+        g3 = MemoryObjectGraph()
+        g3.load(filename)
+        self.assertSameGraph(g2, g3)
+
+        # an incomplete segment is ignored
+        with open(delta, 'ab') as f:
+            f.write(snapshot.MAGIC + b'\x01\x00S\x10')
+        g3.load(filename)
+        self.assertSameGraph(g2, g3)
+        g3.find_one(Series, title = 'Monk').rating = 9.0
+        g3.save_incremental(filename)
+        g4 = MemoryObjectGraph()
+        g4.load(filename)
+        self.assertSameGraph(g3, g4)
+
+        # when the delta becomes too big, the whole graph is written again
+        g4.find_one(Series, title = 'Monk').rating = 9.5
+        g4.save_incremental(filename, max_delta_ratio = 0)
+        self.assert_(not os.path.exists(delta))
+        g.load(filename)
+        self.assertSameGraph(g, g4)
+
+    def testStaleDelta(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        filename = self.tmpfile('graph.db')
+        g.save(filename)
+        g.find_one(Series, title = 'Monk').rating = 8.5
+        g.save_incremental(filename)
+
+        # a crash between writing a new snapshot and removing the old delta file
+        # doesn't apply the old delta to the new snapshot
+        shutil.copy(filename + '.delta', self.tmpfile('backup.delta'))
+        g.find_one(Series, title = 'Monk').rating = 9.0
+        g.save(filename)
+        shutil.copy(self.tmpfile('backup.delta'), filename + '.delta')
+
+        g2 = MemoryObjectGraph()
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+
+    def testPartialLoad(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        filename = self.tmpfile('graph.db')
+        g.save(filename)
+
+        g2 = MemoryObjectGraph()
+        g2.load(filename, classes = [ Series, Episode ])
+        self.assertEqual(len(g2.find_all(Series)), 2)
+        self.assertEqual(len(g2.find_all(Episode)), 7)
+        self.assertEqual(len(g2.find_all(File)), 0)
+        self.assertEqual(len(g2.find_all(Subtitle)), 0)
+
+        # edges between loaded nodes are kept, and so are node ids
+        ep = g2.find_one(Episode, series_title = 'The Wire')
+        self.assertEqual(ep.series.rating, 9.5)
+        self.assertEqual(len(g2.find_all(Episode, series_title = 'Monk')), 6)
+        self.assertEqual(ep.node.node_id(), g.find_one(Episode, title = 'Ebb Tide').node.node_id())
+        nodes, edges, classes = g2.to_nodes_and_edges()
+        self.assertEqual(len(edges), 2 * 7)
+
+        # classes can also be given by name, and deltas only add the requested nodes
+        g.save_incremental(filename)
+        g.File(video = g.find_one(Episode, title = 'Ebb Tide'), filename = 'The Wire.2x01.avi')
+        g.find_one(Series, title = 'Monk').rating = 8.5
+        g.save_incremental(filename)
+        g2.load(filename, classes = [ 'Series', 'Subtitle' ])
+        self.assertEqual(len(g2.find_all(BaseObject)), 3)
+        self.assertEqual(g2.find_one(Series, title = 'Monk').rating, 8.5)
+        self.assertEqual(g2.find_one(Subtitle).language, 'en')
+
+        g3 = MemoryObjectGraph()
+        g3.load(filename)
+        self.assertSameGraph(g, g3)
+
+        # a partial graph can't overwrite the file it has been loaded from
+        g2.load(filename, classes = [ Series ])
+        self.assertRaises(ValueError, g2.save_incremental, filename)
+        self.assertRaises(ValueError, g2.save, filename)
+        g3.load(filename)
+        self.assertSameGraph(g, g3)
+
+        # but it can be saved to another file, and a full load makes it savable again
+        other = self.tmpfile('series.db')
+        g2.save(other)
+        g3.load(other)
+        self.assertEqual(len(g3.find_all(BaseObject)), 2)
+        g2.load(filename)
+        g2.save_incremental(filename)
+        g3.load(filename)
+        self.assertSameGraph(g, g3)
+
+    def testVersion1Snapshot(self):
+        from StringIO import StringIO
+        g = MemoryObjectGraph()
+        self.createData(g)
+
+        # write a snapshot as the first version of the format did: no sections and one
+        # adjacency record per node
+        f = StringIO()
+        writer = snapshot.SnapshotWriter(f)
+        writer._buffer[0] = snapshot._header.pack(snapshot.MAGIC, 1)
+        for node_id, node in g.scan_nodes():
+            writer.write_node(node_id, [ cls.__name__ for cls in node.classes() ], list(node.literal_items()))
+        for node_id, node in g.scan_nodes():
+            edges = [ (name, other.node_id()) for name, others in node.edge_items() for other in others ]
+            if edges:
+                writer.write_adjacency(node_id, edges)
+        writer.close()
+
+        g2 = MemoryObjectGraph()
+        snapshot.read_snapshot(g2, StringIO(f.getvalue()))
+        self.assertSameGraph(g, g2)
+
+        g2 = MemoryObjectGraph()
+        snapshot.read_snapshot(g2, StringIO(f.getvalue()), classes = [ Episode, Series ])
+        self.assertEqual(len(g2.find_all(BaseObject)), 9)
+
+    def testSections(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        g.delete_node(g.find_one(Episode, season = 1, episodeNumber = 2).node)
+
+        section_size = snapshot.SECTION_SIZE
+        snapshot.SECTION_SIZE = 2
+        try:
+            filename = self.tmpfile('graph.db')
+            g.save(filename)
+        finally:
+            snapshot.SECTION_SIZE = section_size
+
+        g2 = MemoryObjectGraph()
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+
+        g2.load(filename, classes = [ Series, Episode ])
+        self.assertEqual(len(g2.find_all(BaseObject)), 8)
+        self.assertEqual(len(g2.find_all(Episode, series_title = 'Monk')), 5)
+
+        # the mmap backend also finds the edges split across several sections
+        g3 = MmapObjectGraph(filename)
+        self.assertEqual(len(g3.find_all(Episode, series_title = 'Monk')), 5)
+        g3.close()
+
+    def testStreamingSnapshot(self):
+        g = MemoryObjectGraph()
+        self.createData(g)
+        g.delete_node(g.find_one(Episode, season = 1, episodeNumber = 2).node)
+
+        # snapshots can be written to files which are not seekable
+        class Output(object):
+            def __init__(self):
+                self.data = []
+            def write(self, data):
+                self.data.append(data)
+
+        # use tiny buffers so that sections, spools and index tables are all split
+        sizes = snapshot.SECTION_SIZE, snapshot.WRITE_BUFFER_SIZE, snapshot._IntSpool.CHUNK_SIZE
+        snapshot.SECTION_SIZE, snapshot.WRITE_BUFFER_SIZE, snapshot._IntSpool.CHUNK_SIZE = 2, 64, 4
+        try:
+            out = Output()
+            snapshot.write_snapshot(g, out)
+        finally:
+            snapshot.SECTION_SIZE, snapshot.WRITE_BUFFER_SIZE, snapshot._IntSpool.CHUNK_SIZE = sizes
+
+        filename = self.tmpfile('graph.db')
+        with open(filename, 'wb') as f:
+            f.write(b''.join(out.data))
+
+        g2 = MemoryObjectGraph()
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+
+        g2.load(filename, classes = [ Series, Episode ])
+        self.assertEqual(len(g2.find_all(Episode, series_title = 'Monk')), 5)
+
+        g3 = MmapObjectGraph(filename)
+        self.assertSameGraph(g, g3)
+        g3.close()
+
+    def testOntologyFingerprint(self):
+        g = MemoryObjectGraph()
+        g.create_index('title')
+        self.createData(g)
+        filename = self.tmpfile('graph.db')
+        g.save(filename)
+
+        g2 = MemoryObjectGraph()
+        g2.create_index('title')
+        revalidated = []
+        g2.revalidate_objects = lambda: revalidated.append(True)
+
+        # same ontology: nodes are restored as they were saved, without validation
+        set_prop = ObjectNode.set
+        def fail(*args, **kwargs):
+            raise AssertionError('ObjectNode.set() should not be called')
+        ObjectNode.set = fail
+        try:
+            g2.load(filename)
+        finally:
+            ObjectNode.set = set_prop
+        self.assertSameGraph(g, g2)
+        self.assertEqual(revalidated, [])
+        self.assertEqual(len(g2.index('title').lookup('Monk')), 1)
+        self.assertEqual(g2.find_one(Series, title = 'The Wire').rating, 9.5)
+
+        # the ontology has changed since the graph was saved: objects are revalidated
+        fingerprint = ontology.fingerprint()
+        class RatedSeries(Series):
+            schema = { 'rating': float }
+            valid = [ 'title', 'rating' ]
+        self.assertNotEqual(ontology.fingerprint(), fingerprint)
+
+        del revalidated[:]
+        g2.load(filename)
+        self.assertSameGraph(g, g2)
+        self.assertEqual(revalidated, [ True ])
+
+
+suite = allTests(TestSerialization)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)
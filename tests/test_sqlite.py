@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyGoo - An Object-Graph mapper
+# Copyright (c) 2013 Nicolas Wack <wackou@gmail.com>
+#
+# PyGoo is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGoo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from pygootest import *
+import tempfile
+import sqlite3
+import shutil
+
+from pygoo.sqliteobjectgraph import SQLiteObjectGraph
+from pygoo.baseobject import get_node
+
+class TestSQLite(GraphTestCase):
+
+    def setUp(self):
+        ontology.reload_saved_ontology('media')
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'graph.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testBasicGraph(self):
+        g = SQLiteObjectGraph(self.filename)
+        mg = MemoryObjectGraph()
+        self.createData(g)
+        self.createData(mg)
+        self.assertSameGraph(g, mg)
+
+        ep = g.find_one(Episode, series_title = 'The Wire')
+        self.assertEqual(ep.title, 'Ebb Tide')
+        self.assertEqual(ep.series.rating, 9.5)
+        self.assertEqual(ep.subtitle.language, 'en')
+        self.assertEqual(ep.subtitle.files.next().filesize, 2**70)
+        self.assert_(ep.node in g)
+
+        # modifications
+        ep.title = 'Ebb Tide (pilot)'
+        ep.series.rating = 9.7
+        del ep.series.rating
+        monk = g.find_one(Series, title = 'Monk')
+        g.delete_node(g.find_one(Episode, season = 1, episodeNumber = 2).node)
+        g.find_one(Episode, season = 2, episodeNumber = 3).series = g.find_one(Series, title = 'The Wire')
+        self.assertEqual(len(list(monk.episodes)), 4)
+        self.assertRaises(KeyError, g.get_node, 1000)
+        g.close()
+
+        # everything is still there after reopening the database
+        g = SQLiteObjectGraph(self.filename)
+        self.assertEqual(g.find_one(Episode, series_title = 'The Wire', season = 2, episodeNumber = 1).title,
+                         'Ebb Tide (pilot)')
+        self.assert_('rating' not in g.find_one(Series, title = 'The Wire').node)
+        self.assertEqual(len(g.find_all(Episode)), 6)
+        self.assertEqual(len(g.find_all(Episode, series_title = 'Monk')), 4)
+        self.assertEqual(len(g.find_all(Episode, series_title = 'The Wire')), 2)
+
+        # new nodes don't reuse the ids of deleted ones
+        ids = [ node_id for node_id, _ in g.scan_nodes() ]
+        self.assert_(g.Series(title = 'House').node.node_id() > max(ids))
+        g.close()
+
+    def testCommitEvery(self):
+        g = SQLiteObjectGraph(self.filename, commit_every = 10)
+        monk = g.Series(title = 'Monk')
+        g.commit()
+
+        # modifications of the nodes are committed regularly too
+        for i in range(100):
+            monk.title = 'Monk %d' % i
+        self.assert_(g._writes < 10)
+        db = sqlite3.connect(self.filename)
+        titles = [ title for title, in db.execute("SELECT value FROM literals WHERE name = 'title'") ]
+        db.close()
+        self.assertEqual(len(titles), 1)
+        self.assert_(titles[0] != 'Monk')
+        g.close()
+
+    def testQueries(self):
+        g = SQLiteObjectGraph()
+        mg = MemoryObjectGraph()
+        self.createData(g)
+        self.createData(mg)
+
+        def ids(objs):
+            return sorted(get_node(o).node_id() for o in objs)
+
+        monk = g.find_one(Series, title = 'Monk')
+        queries = [ (Episode, {}),
+                    (Episode, { 'season': 2 }),
+                    (Episode, { 'season': 2, 'episodeNumber': 1 }),
+                    (Episode, { 'series_title': 'Monk', 'season': 1 }),
+                    (Episode, { 'series_title': 'The Wire' }),
+                    (File, { 'video_series_title': 'Monk' }),
+                    (Series, { 'rating': 9.5 }),
+                    (Series, { 'title': 'House' }),
+                    (File, { 'filesize': 2**70 }),
+                    (Subtitle, { 'language': 'en' }),
+                    ((Series, File), {}),
+                    (None, { 'season': 1 }) ]
+
+        for node_type, filters in queries:
+            self.assertEqual(ids(g.query(node_type, **filters)), ids(mg.query(node_type, **filters)))
+
+        self.assertEqual(len(g.find_all(Episode, series = monk)), 6)
+        self.assertEqual(len(g.find_all(Episode, series = monk, season = 2)), 3)
+
+        # literal filters are done in SQL, chained ones are only pre-filtered
+        _, remaining = g._candidate_nodes(Episode, { 'season': 2, 'series_title': 'Monk',
+                                                     'series': monk, 'title': None })
+        self.assertEqual(sorted(remaining.keys()), [ 'series_title', 'title' ])
+
+        self.assertEqual(g.aggregate(Episode, count = True, max = 'season', series_title = 'Monk'),
+                         mg.aggregate(Episode, count = True, max = 'season', series_title = 'Monk'))
+        self.assertEqual(sorted(g.values(Episode, 'episodeNumber', season = 1)),
+                         [ (1,), (2,), (3,) ])
+
+    def testCountAndLimit(self):
+        g = SQLiteObjectGraph()
+        self.createData(g)
+
+        executed = []
+        execute = g._execute
+        def traced_execute(sql, params = ()):
+            executed.append((sql, params))
+            return execute(sql, params)
+        g._execute = traced_execute
+        loaded = []
+        get_node = g.get_node
+        def traced_get_node(node_id):
+            loaded.append(node_id)
+            return get_node(node_id)
+        g.get_node = traced_get_node
+
+        # counting is done in SQL, without loading the nodes
+        self.assertEqual(g.query(Episode, season = 2).count(), 4)
+        self.assertEqual(g.query(Episode, season = 2).offset(1).limit(2).count(), 2)
+        self.assert_(executed[-1][0].startswith('SELECT COUNT(DISTINCT c.node)'))
+        self.assertEqual(loaded, [])
+
+        # the limit is applied in SQL when all the filters are
+        self.assertEqual(len(g.find_all(Episode, season = 2, limit = 2)), 2)
+        queries = [ params for sql, params in executed if sql.startswith('SELECT DISTINCT') ]
+        self.assertEqual(queries[-1][-1], 2)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(g.query(Episode, series_title = 'Monk').limit(4).count(), 4)
+
+    def testSnapshot(self):
+        mg = MemoryObjectGraph()
+        self.createData(mg)
+        filename = os.path.join(self.tmpdir, 'graph.db')
+        mg.save(filename)
+
+        g = SQLiteObjectGraph(self.filename)
+        g.load(filename)
+        self.assertSameGraph(g, mg)
+        g.close()
+
+
+
+suite = allTests(TestSQLite)
+
+if __name__ == '__main__':
+    TextTestRunner(verbosity=2).run(suite)